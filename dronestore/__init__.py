@@ -31,7 +31,15 @@ from merge import MaxStrategy
 
 # drones
 from drone import Drone
+from drone import ThreadSafeDrone
+from drone import AsyncDrone
+from drone import MergeConflictError
 from query import Query
+from ancestry import AncestryIndex
+from history import VersionHistory
+from feed import Change
+from feed import ChangeLog
+from feed import ChangeFeed
 
 # basic datastores
 from datastore import Datastore
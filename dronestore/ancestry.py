@@ -0,0 +1,119 @@
+
+import collections
+
+from model import Key, Version
+
+
+class AncestryIndex(object):
+  '''An AncestryIndex remembers recent versions of objects, indexed by hash.
+
+  Every version records its `parent` hash, so the versions of an object form a
+  graph. Keeping a bounded window of recent versions per key allows finding
+  the common ancestor of two versions, which in turn enables three-way merges
+  (see merge.merge): only attributes that actually changed since the common
+  ancestor need to be considered.
+
+  Merged versions may be added with extra parents (the remote version that was
+  merged in), so subsequent merges find the most recent common ancestor.
+
+  WARNING: the index is bounded. Ancestors that have been evicted cannot be
+           found, in which case merges fall back to two-way merging.
+  '''
+
+  DEFAULT_SIZE = 100
+
+  def __init__(self, size=DEFAULT_SIZE):
+    '''Initializes the index, keeping at most `size` versions per key.'''
+    if size < 1:
+      raise ValueError('size must be at least 1')
+
+    self.size = size
+    self._versions = {} # key -> OrderedDict(hash -> (version, parents))
+
+  def __len__(self):
+    return sum(map(len, self._versions.values()))
+
+  def _entries(self, key):
+    return self._versions.get(str(key), {})
+
+  def add(self, version, parents=None):
+    '''Adds `version` to the index. `parents` defaults to the version parent.'''
+    if not isinstance(version, Version):
+      raise TypeError('expected input of type %s' % Version)
+
+    if parents is None:
+      parents = [version.parent]
+    parents = tuple(p for p in parents if p != Version.BLANK_HASH)
+
+    entries = self._versions.setdefault(str(version.key),
+      collections.OrderedDict())
+
+    # re-adding merges parents, and refreshes the entry's recency.
+    if version.hash in entries:
+      old_parents = entries.pop(version.hash)[1]
+      parents += tuple(p for p in old_parents if p not in parents)
+
+    entries[version.hash] = (version, parents)
+    while len(entries) > self.size:
+      entries.popitem(last=False)
+
+  def remove(self, key):
+    '''Forgets all the versions of the object named by `key`.'''
+    self._versions.pop(str(key), None)
+
+  def contains(self, key, hash):
+    '''Returns whether the version `hash` of `key` is in the index.'''
+    return hash in self._entries(key)
+
+  def version(self, key, hash):
+    '''Returns the version `hash` of `key`, or None if not indexed.'''
+    entry = self._entries(key).get(hash)
+    return entry[0] if entry else None
+
+  def parents(self, key, hash):
+    '''Returns the hashes of the parents of version `hash` of `key`.'''
+    entry = self._entries(key).get(hash)
+    return entry[1] if entry else ()
+
+  def ancestors(self, key, hash):
+    '''Yields the hashes of indexed ancestors of `hash` (inclusive), nearest
+    first (breadth-first).
+    '''
+    entries = self._entries(key)
+    seen = set()
+    frontier = collections.deque([hash])
+    while frontier:
+      curr = frontier.popleft()
+      if curr in seen or curr not in entries:
+        continue
+      seen.add(curr)
+      yield curr
+      frontier.extend(entries[curr][1])
+
+  def commonAncestor(self, key, hash1, hash2):
+    '''Returns the lowest common ancestor Version of versions `hash1` and
+    `hash2` of `key`, or None if none is indexed.
+    '''
+    if hash1 == hash2:
+      return self.version(key, hash1)
+
+    # walk both histories in lockstep, so the search stops as soon as the
+    # nearest shared version is found, without walking whole histories.
+    walk1, walk2 = self.ancestors(key, hash1), self.ancestors(key, hash2)
+    seen1, seen2 = set(), set()
+    while walk1 or walk2:
+      for walk, seen, other in [(walk1, seen1, seen2), (walk2, seen2, seen1)]:
+        if walk is None:
+          continue
+        try:
+          curr = walk.next()
+        except StopIteration:
+          if walk is walk1:
+            walk1 = None
+          else:
+            walk2 = None
+          continue
+        if curr in other:
+          return self.version(key, curr)
+        seen.add(curr)
+    return None
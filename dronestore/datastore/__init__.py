@@ -1,5 +1,6 @@
 
 from basic import Datastore
 from basic import DictDatastore
+from basic import ShimDatastore
 from basic import TieredDatastore
 from basic import ShardedDatastore
@@ -0,0 +1,320 @@
+
+import time
+from multiprocessing.pool import ThreadPool
+
+import basic
+
+
+def _remaining(timeout):
+  '''Returns a function returning the time left of `timeout`, overall.'''
+  if timeout is None:
+    return lambda: None
+  deadline = time.time() + timeout
+  return lambda: max(0, deadline - time.time())
+
+
+class AsyncResult(object):
+  '''An AsyncResult represents the eventual result of an asynchronous call.
+  It follows the interface of multiprocessing's AsyncResult, so the results
+  of pool calls (`apply_async`) can be used directly.
+  '''
+
+  def get(self, timeout=None):
+    '''Returns the result, waiting for it if necessary. Raises the exception
+    raised by the call, if any.
+    '''
+    raise NotImplementedError
+
+  def wait(self, timeout=None):
+    '''Waits until the result is available.'''
+    raise NotImplementedError
+
+  def ready(self):
+    '''Returns whether the call has completed.'''
+    raise NotImplementedError
+
+
+class ValueResult(AsyncResult):
+  '''An AsyncResult that is already available.'''
+
+  def __init__(self, value):
+    self.value = value
+
+  def get(self, timeout=None):
+    return self.value
+
+  def wait(self, timeout=None):
+    pass
+
+  def ready(self):
+    return True
+
+
+class MappedResult(AsyncResult):
+  '''An AsyncResult that transforms the value of another with `fn`.'''
+
+  def __init__(self, result, fn):
+    self.result = result
+    self.fn = fn
+
+  def get(self, timeout=None):
+    return self.fn(self.result.get(timeout))
+
+  def wait(self, timeout=None):
+    self.result.wait(timeout)
+
+  def ready(self):
+    return self.result.ready()
+
+
+class GatheredResult(AsyncResult):
+  '''An AsyncResult combining the values of several others with `fn`.'''
+
+  def __init__(self, results, fn=list):
+    self.results = list(results)
+    self.fn = fn
+
+  def get(self, timeout=None):
+    remaining = _remaining(timeout)
+    return self.fn([r.get(remaining()) for r in self.results])
+
+  def wait(self, timeout=None):
+    remaining = _remaining(timeout)
+    for result in self.results:
+      result.wait(remaining())
+
+  def ready(self):
+    return all([r.ready() for r in self.results])
+
+
+class ChainedResult(AsyncResult):
+  '''An AsyncResult for a sequence of calls, where each call is only made if
+  needed. `calls` are functions returning AsyncResults, and `done` decides
+  (given a value) whether to stop. Only the first call is made right away.
+  '''
+
+  def __init__(self, calls, done):
+    self.calls = list(calls)
+    self.done = done
+    self.index = 0
+    self.result = self.calls[0]()
+
+  def _advance(self):
+    '''Makes the next calls, as long as the current one completed and did not
+    end the chain. Returns whether the chain completed.
+    '''
+    while self.result.ready():
+      if self.index + 1 == len(self.calls):
+        return True
+      try:
+        if self.done(self.result.get()):
+          return True
+      except Exception:
+        return True # the call failed. get raises its exception.
+      self.index += 1
+      self.result = self.calls[self.index]()
+    return False
+
+  def get(self, timeout=None):
+    remaining = _remaining(timeout)
+    value = self.result.get(remaining())
+    while not self.done(value) and self.index + 1 < len(self.calls):
+      self.index += 1
+      self.result = self.calls[self.index]()
+      value = self.result.get(remaining())
+    return value
+
+  def wait(self, timeout=None):
+    remaining = _remaining(timeout)
+    while not self._advance() and remaining() != 0:
+      self.result.wait(remaining())
+
+  def ready(self):
+    return self._advance()
+
+
+
+
+class AsyncDatastore(object):
+  '''An AsyncDatastore is a Datastore whose calls do not block.
+  Each call starts the operation, and returns an AsyncResult for its value.
+  This allows issuing many calls (e.g. lookups of many keys) concurrently:
+
+    results = [store.get(key) for key in keys]
+    values = [result.get() for result in results]
+  '''
+
+  def get(self, key):
+    '''Returns an AsyncResult for the object named by key.'''
+    raise NotImplementedError
+
+  def put(self, key, value):
+    '''Stores the object. Returns an AsyncResult for completion.'''
+    raise NotImplementedError
+
+  def delete(self, key):
+    '''Removes the object. Returns an AsyncResult for completion.'''
+    raise NotImplementedError
+
+  def contains(self, key):
+    '''Returns an AsyncResult for whether the object is in this datastore.'''
+    raise NotImplementedError
+
+  def query(self, query):
+    '''Returns an AsyncResult for the list of objects matching `query`'''
+    raise NotImplementedError
+
+
+
+class ThreadedDatastore(AsyncDatastore):
+  '''Adapts a (blocking) Datastore to the AsyncDatastore interface, running
+  its calls in a pool of threads. Best suited to network-backed datastores,
+  whose calls spend most of their time waiting on I/O. Call `close` to stop
+  the threads.
+  '''
+
+  DEFAULT_THREADS = 16
+
+  def __init__(self, datastore, threads=DEFAULT_THREADS, pool=None):
+    '''Initializes with `datastore` and a new pool of `threads` (or `pool`).'''
+    if not isinstance(datastore, basic.Datastore):
+      raise TypeError('datastore must be of type %s' % basic.Datastore)
+
+    self.datastore = datastore
+    self._ownsPool = pool is None
+    self.pool = pool if pool is not None else ThreadPool(threads)
+
+  def close(self):
+    '''Stops the threads of the pool (once pending calls complete), unless
+    the pool was given: pools passed in are closed by their owners.
+    '''
+    if self._ownsPool:
+      self.pool.close()
+      self.pool.join()
+
+  def get(self, key):
+    '''Returns an AsyncResult for the object named by key.'''
+    return self.pool.apply_async(self.datastore.get, (key,))
+
+  def put(self, key, value):
+    '''Stores the object. Returns an AsyncResult for completion.'''
+    return self.pool.apply_async(self.datastore.put, (key, value))
+
+  def delete(self, key):
+    '''Removes the object. Returns an AsyncResult for completion.'''
+    return self.pool.apply_async(self.datastore.delete, (key,))
+
+  def contains(self, key):
+    '''Returns an AsyncResult for whether the object is in this datastore.'''
+    return self.pool.apply_async(self.datastore.contains, (key,))
+
+  def query(self, query):
+    '''Returns an AsyncResult for the list of objects matching `query`'''
+    # consume results in the pool too, as datastores may return lazy cursors.
+    run = lambda query: list(self.datastore.query(query))
+    return self.pool.apply_async(run, (query,))
+
+
+
+class AsyncDatastoreCollection(AsyncDatastore):
+  '''Represents a collection of async datastores.'''
+
+  def __init__(self, stores=[]):
+    '''Initialize the datastore with any provided async datastores.'''
+    stores = list(stores)
+    for store in stores:
+      if not isinstance(store, AsyncDatastore):
+        raise TypeError("all stores must be of type %s" % AsyncDatastore)
+
+    self._stores = stores
+
+  def datastore(self, index):
+    return self._stores[index]
+
+
+
+class AsyncTieredDatastore(AsyncDatastoreCollection):
+  '''Represents a hierarchical collection of async datastores.
+
+  Gets consult each datastore in order, only if the ones before missed (so
+  caches keep shielding databases). Writes hit all datastores concurrently.
+  '''
+
+  def get(self, key):
+    '''Returns an AsyncResult for the object named by key.'''
+    def lookup(index):
+      return lambda: self._stores[index].get(key)
+
+    calls = [lookup(i) for i in range(0, len(self._stores))]
+    chain = ChainedResult(calls, lambda value: value is not None)
+
+    def fill(value):
+      # add model to lower stores only
+      if value is not None:
+        stores = self._stores[:chain.index]
+        GatheredResult([store.put(key, value) for store in stores]).get()
+      return value
+
+    return MappedResult(chain, fill)
+
+  def put(self, key, value):
+    '''Stores the object in all stores.'''
+    return GatheredResult([s.put(key, value) for s in self._stores])
+
+  def delete(self, key):
+    '''Removes the object from all stores.'''
+    return GatheredResult([s.delete(key) for s in self._stores])
+
+  def contains(self, key):
+    '''Returns an AsyncResult for whether the object is in this datastore.'''
+    return GatheredResult([s.contains(key) for s in self._stores], any)
+
+  def query(self, query):
+    '''Returns an AsyncResult for the list of objects matching `query`'''
+    # queries hit the last (most complete) datastore
+    return self._stores[-1].query(query)
+
+
+
+class AsyncShardedDatastore(AsyncDatastoreCollection):
+  '''Represents a collection of async datastore shards. Queries are issued
+  to all the shards concurrently. See ShardedDatastore.
+  '''
+
+  def __init__(self, stores=[], shardingfn=hash):
+    '''Initialize the datastore with any provided async datastores.'''
+    if not callable(shardingfn):
+      raise TypeError('shardingfn (type %s) is not callable' % type(shardingfn))
+
+    super(AsyncShardedDatastore, self).__init__(stores)
+    self._shardingfn = shardingfn
+
+  def shard(self, key):
+    return self._shardingfn(key) % len(self._stores)
+
+  def shardDatastore(self, key):
+    return self.datastore(self.shard(key))
+
+  def get(self, key):
+    '''Returns an AsyncResult for the object named by key.'''
+    return self.shardDatastore(key).get(key)
+
+  def put(self, key, value):
+    '''Stores the object to the corresponding datastore.'''
+    return self.shardDatastore(key).put(key, value)
+
+  def delete(self, key):
+    '''Removes the object from the corresponding datastore.'''
+    return self.shardDatastore(key).delete(key)
+
+  def contains(self, key):
+    '''Returns an AsyncResult for whether the object is in this datastore.'''
+    return self.shardDatastore(key).contains(key)
+
+  def query(self, query):
+    '''Returns an AsyncResult for the list of objects matching `query`'''
+    combine = lambda results: list(query.merge(results))
+
+    # each shard returns its share of the page, from its first object.
+    prefix = query.prefix()
+    return GatheredResult([s.query(prefix) for s in self._stores], combine)
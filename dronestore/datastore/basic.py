@@ -1,6 +1,22 @@
 
 
 
+import threading
+from multiprocessing.pool import ThreadPool
+
+import parallel
+from ..query import Aggregate
+
+
+def storedHash(value):
+  '''Returns the version hash of a stored `value`, None if there is no value.'''
+  if value is None:
+    return None
+  try:
+    return value['hash']
+  except (TypeError, KeyError):
+    raise TypeError('stored value is not version data: %r' % (value,))
+
 
 class Datastore(object):
   '''A Datastore represents storage for serialized dronestore versions.
@@ -40,17 +56,72 @@ class Datastore(object):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
     raise NotImplementedError
 
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` (see Query.aggregate) of the objects matching
+    the filters of `query`, optionally grouped by field `groupby`.
+
+    This default implementation streams all matching objects through the
+    query. Datastores that can aggregate natively override it.
+    '''
+    return query.aggregate(self.query(query.scan()), aggregates, groupby,
+      filtered=True)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the hash of the stored version is
+    `expected_hash` (or, if `expected_hash` is None, only if nothing is
+    stored). Returns whether the object was stored.
+
+    Versions record their parent hash, so a writer passing the hash it read
+    detects (rather than overwrites) concurrent writes, without locking.
+
+    WARNING: this default implementation is not atomic. Datastores that can
+             compare-and-set atomically override it.
+    '''
+    if storedHash(self.get(key)) != expected_hash:
+      return False
+    self.put(key, value)
+    return True
+
+  # batched operations. these loop over the single-key calls by default;
+  # datastores that can batch natively (i.e. fewer round trips) override them.
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    return [self.get(key) for key in keys]
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    for key in keys:
+      self.delete(key)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return [self.contains(key) for key in keys]
+
 
 
 class DictDatastore(Datastore):
   '''Simple straw-man in-memory datastore backed by a dict.
 
+  Queries over at least PARALLEL_SCAN_SIZE objects can be run in parallel, in
+  `processes` forked processes (see parallel.scan). Opt-in: by default, they
+  run in this process.
+
   WARNING: it does not evict entries so it will grow indefinitely. use this for
     testing, short-lived, or small working-set programs.
   '''
 
-  def __init__(self):
+  PARALLEL_SCAN_SIZE = 10000
+
+  def __init__(self, processes=1):
     self._items = {}
+    self._lock = threading.Lock()
+    self.processes = processes
 
   def get(self, key):
     '''Return the object named by key.'''
@@ -79,14 +150,111 @@ class DictDatastore(Datastore):
 
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
+    # keys-only queries without criteria need not touch the objects.
+    if query.keysonly and not query.filters and not query.orders:
+      return query.slice(self._items.keys())
+
     # entire dataset already in memory, so ok to apply query naively
-    return query(self._items.values())
+    values = self._items.values()
+    if self.processes > 1 and len(values) >= self.PARALLEL_SCAN_SIZE:
+      return parallel.scan(query, values, self.processes)
+    return query(values)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    with self._lock:
+      if storedHash(self._items.get(key)) != expected_hash:
+        return False
+      self.put(key, value)
+      return True
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    return map(self._items.get, keys)
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    for key, value in items:
+      if value is None:
+        self._items.pop(key, None)
+      else:
+        self._items[key] = value
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    for key in keys:
+      self._items.pop(key, None)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return map(self._items.__contains__, keys)
 
   def __len__(self):
     return len(self._items)
 
 
 
+class ShimDatastore(Datastore):
+  '''Represents a non-concrete datastore that adds functionality between the
+  client and a lower level datastore. Shim datastores do not actually store
+  data themselves; instead, they delegate storage to an underlying child
+  datastore. The default implementation just passes all calls to the child.
+  '''
+
+  def __init__(self, datastore):
+    '''Initializes this ShimDatastore with child `datastore`.'''
+    if not isinstance(datastore, Datastore):
+      raise TypeError('datastore must be of type %s' % Datastore)
+
+    self.child_datastore = datastore
+
+  def get(self, key):
+    '''Return the object named by key.'''
+    return self.child_datastore.get(key)
+
+  def put(self, key, value):
+    '''Stores the object.'''
+    self.child_datastore.put(key, value)
+
+  def delete(self, key):
+    '''Removes the object.'''
+    self.child_datastore.delete(key)
+
+  def contains(self, key):
+    '''Returns whether the object is in this datastore.'''
+    return self.child_datastore.contains(key)
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    return self.child_datastore.query(query)
+
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`.'''
+    return self.child_datastore.aggregate(query, aggregates, groupby)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    return self.child_datastore.put_if(key, value, expected_hash)
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    return self.child_datastore.get_many(keys)
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    self.child_datastore.delete_many(keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return self.child_datastore.contains_many(keys)
+
+
+
+
 class DatastoreCollection(Datastore):
   '''Represents a collection of datastores.'''
 
@@ -151,6 +319,20 @@ class TieredDatastore(DatastoreCollection):
     for store in self._stores:
       store.put(key, value)
 
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object in all stores, only if the stored version hash in
+    the last (most complete, authoritative) store is `expected_hash`.
+    '''
+    if not self._stores[-1].put_if(key, value, expected_hash):
+      # upper stores may hold a stale version. drop it so retries see fresh.
+      for store in self._stores[:-1]:
+        store.delete(key)
+      return False
+
+    for store in self._stores[:-1]:
+      store.put(key, value)
+    return True
+
   def delete(self, key):
     '''Removes the object from all stores.'''
     for store in self._stores:
@@ -168,6 +350,67 @@ class TieredDatastore(DatastoreCollection):
     # queries hit the last (most complete) datastore
     return self._stores[-1].query(query)
 
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`.'''
+    return self._stores[-1].aggregate(query, aggregates, groupby)
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).
+    Each store is asked (in one batch) only for the keys not found so far.
+    '''
+    keys = list(keys)
+    values = [None] * len(keys)
+    missing = range(0, len(keys))
+
+    for index, store in enumerate(self._stores):
+      if not missing:
+        break
+
+      found = store.get_many([keys[i] for i in missing])
+      hits = [(i, v) for i, v in zip(missing, found) if v is not None]
+      if not hits:
+        continue
+
+      for i, value in hits:
+        values[i] = value
+
+      # add models to lower stores only
+      items = [(keys[i], value) for i, value in hits]
+      for store2 in self._stores[:index]:
+        store2.put_many(items)
+
+      missing = [i for i, v in zip(missing, found) if v is None]
+
+    return values
+
+  def put_many(self, items):
+    '''Stores the objects in all stores.'''
+    items = list(items)
+    for store in self._stores:
+      store.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects from all stores.'''
+    keys = list(keys)
+    for store in self._stores:
+      store.delete_many(keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    keys = list(keys)
+    contained = [False] * len(keys)
+    missing = range(0, len(keys))
+
+    for store in self._stores:
+      if not missing:
+        break
+      found = store.contains_many([keys[i] for i in missing])
+      for i, isIn in zip(missing, found):
+        contained[i] = isIn
+      missing = [i for i, isIn in zip(missing, found) if not isIn]
+
+    return contained
+
 
 
 
@@ -177,19 +420,28 @@ class ShardedDatastore(DatastoreCollection):
 
   sharding functions should take a Key and return an integer.
 
+  Queries fan out to all shards concurrently, on `pool` (by default, a pool
+  of a thread per shard, created on the first query). Each shard returns its
+  share of the page, in order, and the shard results are merged lazily (see
+  Query.merge). Latency thus tracks the slowest shard, not the sum of all.
+  Call `close` to stop the threads of the default pool.
+
   WARNING: adding or removing datastores while running may severely affect
            consistency. Also ensure the order is correct upon initialization.
            While this is not as important for caches, it is crucial for
            persistent atastore.
   '''
 
-  def __init__(self, stores=[], shardingfn=hash):
+  def __init__(self, stores=[], shardingfn=hash, pool=None):
     '''Initialize the datastore with any provided datastore.'''
     if not callable(shardingfn):
       raise TypeError('shardingfn (type %s) is not callable' % type(shardingfn))
 
     super(ShardedDatastore, self).__init__(stores)
     self._shardingfn = shardingfn
+    self._pool = pool
+    self._ownsPool = pool is None
+    self._poolLock = threading.Lock()
 
 
   def shard(self, key):
@@ -207,6 +459,12 @@ class ShardedDatastore(DatastoreCollection):
     '''Stores the object to the corresponding datastore.'''
     self.shardDatastore(key).put(key, value)
 
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object to the corresponding datastore, if it has the
+    expected version.
+    '''
+    return self.shardDatastore(key).put_if(key, value, expected_hash)
+
   def delete(self, key):
     '''Removes the object from the corresponding datastore.'''
     self.shardDatastore(key).delete(key)
@@ -215,13 +473,82 @@ class ShardedDatastore(DatastoreCollection):
     '''Returns whether the object is in this datastore.'''
     return self.shardDatastore(key).contains(key)
 
+  def _shardIndices(self, keys):
+    '''Returns a dict mapping each shard to the indices of its `keys`.'''
+    shards = {}
+    for i, key in enumerate(keys):
+      shards.setdefault(self.shard(key), []).append(i)
+    return shards
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, one batch per datastore.'''
+    keys = list(keys)
+    values = [None] * len(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      found = self.datastore(shard).get_many([keys[i] for i in indices])
+      for i, value in zip(indices, found):
+        values[i] = value
+    return values
+
+  def put_many(self, items):
+    '''Stores the objects to the corresponding datastores, one batch each.'''
+    items = list(items)
+    shards = self._shardIndices([key for key, value in items])
+    for shard, indices in shards.items():
+      self.datastore(shard).put_many([items[i] for i in indices])
+
+  def delete_many(self, keys):
+    '''Removes the objects from the corresponding datastores, one batch each.'''
+    keys = list(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      self.datastore(shard).delete_many([keys[i] for i in indices])
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    keys = list(keys)
+    contained = [False] * len(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      found = self.datastore(shard).contains_many([keys[i] for i in indices])
+      for i, isIn in zip(indices, found):
+        contained[i] = isIn
+    return contained
+
+  def pool(self):
+    '''Returns the pool of threads running shard queries.'''
+    with self._poolLock:
+      if self._pool is None:
+        self._pool = ThreadPool(max(1, len(self._stores)))
+      return self._pool
+
+  def close(self):
+    '''Stops the threads of the default pool (once pending queries complete).
+    Pools passed in are closed by their owners.
+    '''
+    with self._poolLock:
+      if self._ownsPool and self._pool is not None:
+        self._pool.close()
+        self._pool.join()
+        self._pool = None # created again, if queried again.
+
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
-    items = []
-    results = [s.query(query) for s in self._stores]
-    map(items.extend, results)
-    items = sorted(items, cmp=query.orderFn)
-    return items[:query.limit]
+    if len(self._stores) == 1:
+      return self._stores[0].query(query)
+
+    # each shard returns its share of the page, from its first object.
+    # consume results in the pool too, as datastores may return lazy cursors.
+    prefix = query.prefix()
+    run = lambda store: list(store.query(prefix))
+    return query.merge(self.pool().map(run, self._stores))
+
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`. Each shard
+    computes the partial aggregates of its objects, concurrently.
+    '''
+    partials = Aggregate.expand(map(Aggregate.make, aggregates))
+    run = lambda store: store.aggregate(query, partials, groupby)
+    results = self.pool().map(run, self._stores)
+    return Aggregate.gather(aggregates, results, groupby is not None)
 
 
 
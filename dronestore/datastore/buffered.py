@@ -0,0 +1,234 @@
+
+import sys
+import threading
+import collections
+
+import basic
+
+
+_DELETED = object() # marks buffered deletions.
+
+
+class WriteBehindDatastore(basic.ShimDatastore):
+  '''Represents a write-behind buffer in front of a (slow) datastore.
+
+  Writes are kept in memory and coalesced: writing a key many times between
+  flushes only writes its last value. Buffered writes are flushed to the child
+  datastore in batches (put_many, delete_many):
+
+    * when `flushsize` keys are buffered. The writer that fills the buffer
+      performs the flush, so fast writers are held back by the child datastore
+      (backpressure) rather than growing the buffer without bound.
+    * every `interval` seconds, by a background thread (if `interval` given).
+      If a background flush fails, the writes stay buffered, the thread keeps
+      flushing, and the error is raised by the next call to `flush` (or
+      `close`), unless a background flush succeeds first.
+    * on explicit calls to `flush` (and `close`).
+
+  Reads see buffered writes. Queries flush first, as the child evaluates them.
+  Compare-and-set writes (put_if, e.g. Drone merges) compare against buffered
+  writes (or the child's value), and are buffered too.
+
+  WARNING: buffered writes are lost if the process dies before they are
+           flushed, i.e. up to one flush interval (or buffer) of writes.
+  '''
+
+  DEFAULT_FLUSHSIZE = 1000
+
+  def __init__(self, datastore, flushsize=DEFAULT_FLUSHSIZE, interval=None):
+    '''Initializes the buffer in front of `datastore`.'''
+    super(WriteBehindDatastore, self).__init__(datastore)
+    if flushsize < 1:
+      raise ValueError('flushsize must be at least 1')
+
+    self.flushsize = flushsize
+    self.interval = interval
+
+    self._buffer = collections.OrderedDict()
+    self._flushing = {} # writes being flushed. still visible to reads.
+    self._writes = 0 # changes to the buffers (and, by flushes, the child).
+    self._lock = threading.RLock() # guards the buffers.
+    self._flushLock = threading.Lock() # one flush at a time.
+
+    self._closed = threading.Event()
+    self._error = None # exc_info of the last failed background flush.
+    self._thread = None
+    if interval is not None:
+      self._thread = threading.Thread(target=self._flushPeriodically)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def pending(self):
+    '''Returns the number of buffered (unflushed) writes.'''
+    with self._lock:
+      return len(self._buffer)
+
+  def _flushPeriodically(self):
+    while not self._closed.wait(self.interval):
+      try:
+        self._flush()
+        self._error = None
+      except Exception:
+        self._error = sys.exc_info()
+
+  def _buffered(self, key):
+    '''Returns the buffered value for `key`, or None if not buffered.'''
+    with self._lock:
+      if key in self._buffer:
+        return self._buffer[key]
+      return self._flushing.get(key)
+
+  def _write(self, key, value):
+    with self._lock:
+      full = self._bufferWrite(key, value)
+
+    if full:
+      self.flush()
+
+  def _bufferWrite(self, key, value):
+    '''Buffers the write. Returns whether the buffer is full. Lock held.'''
+    self._buffer.pop(key, None) # keep the buffer in write order.
+    self._buffer[key] = value
+    self._writes += 1
+    return len(self._buffer) >= self.flushsize
+
+  def flush(self):
+    '''Writes all buffered writes to the child datastore. Raises the error of
+    the last failed background flush, if any (the writes stay buffered).
+    '''
+    error, self._error = self._error, None
+    if error is not None:
+      raise error[0], error[1], error[2]
+    self._flush()
+
+  def _flush(self):
+    with self._flushLock:
+      with self._lock:
+        if not self._buffer:
+          return
+        self._flushing = self._buffer
+        self._buffer = collections.OrderedDict()
+
+      try:
+        items = self._flushing.items()
+        puts = [(k, v) for k, v in items if v is not _DELETED]
+        deletes = [k for k, v in items if v is _DELETED]
+        if puts:
+          self.child_datastore.put_many(puts)
+        if deletes:
+          self.child_datastore.delete_many(deletes)
+
+      except:
+        # keep the writes buffered (unless overwritten since), and re-raise.
+        with self._lock:
+          for key, value in self._flushing.items():
+            if key not in self._buffer:
+              self._buffer[key] = value
+        raise
+
+      finally:
+        with self._lock:
+          self._flushing = {}
+          self._writes += 1
+
+  def close(self):
+    '''Stops the background flushes, and flushes buffered writes.'''
+    self._closed.set()
+    if self._thread is not None:
+      self._thread.join()
+    self.flush()
+
+
+  def get(self, key):
+    '''Return the object named by key.'''
+    value = self._buffered(key)
+    if value is _DELETED:
+      return None
+    if value is not None:
+      return value
+    return self.child_datastore.get(key)
+
+  def put(self, key, value):
+    '''Stores the object (in the buffer).'''
+    self._write(key, _DELETED if value is None else value)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object (in the buffer) only if the stored version hash is
+    `expected_hash`. The stored version is the buffered one, if any.
+
+    WARNING: this is atomic with writes through this datastore, but not with
+             writes bypassing it (e.g. by other processes) to the child.
+    '''
+    while True:
+      with self._lock:
+        writes = self._writes
+        stored = self._buffered(key)
+      if stored is None:
+        stored = self.child_datastore.get(key)
+
+      with self._lock:
+        if writes != self._writes:
+          continue # written or flushed meanwhile. compare again.
+        if stored is _DELETED:
+          stored = None
+        if basic.storedHash(stored) != expected_hash:
+          return False
+        full = self._bufferWrite(key, _DELETED if value is None else value)
+
+      if full:
+        self.flush()
+      return True
+
+  def delete(self, key):
+    '''Removes the object (in the buffer).'''
+    self._write(key, _DELETED)
+
+  def contains(self, key):
+    '''Returns whether the object is in this datastore.'''
+    value = self._buffered(key)
+    if value is not None:
+      return value is not _DELETED
+    return self.child_datastore.contains(key)
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    self.flush()
+    return self.child_datastore.query(query)
+
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`.'''
+    self.flush()
+    return self.child_datastore.aggregate(query, aggregates, groupby)
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    keys = list(keys)
+    values = map(self._buffered, keys)
+    missing = [i for i, value in enumerate(values) if value is None]
+    if missing:
+      found = self.child_datastore.get_many([keys[i] for i in missing])
+      for i, value in zip(missing, found):
+        values[i] = value
+    return [None if value is _DELETED else value for value in values]
+
+  def put_many(self, items):
+    '''Stores the objects (in the buffer).'''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects (in the buffer).'''
+    for key in keys:
+      self.delete(key)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    keys = list(keys)
+    values = map(self._buffered, keys)
+    contained = [value is not None and value is not _DELETED for value in values]
+    missing = [i for i, value in enumerate(values) if value is None]
+    if missing:
+      found = self.child_datastore.contains_many([keys[i] for i in missing])
+      for i, isIn in zip(missing, found):
+        contained[i] = isIn
+    return contained
@@ -0,0 +1,426 @@
+
+import array
+import itertools
+import threading
+
+import basic
+from ..query import Filter, _compiled_getattr
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+_MAXINT = 2 ** 63
+_MAXEXACT = 2 ** 53 # largest integer floats represent exactly.
+
+
+def _kind(value):
+  '''Returns the kind of column that stores `value`.'''
+  if isinstance(value, (bool, int, long)):
+    return 'int' if -_MAXINT < value < _MAXINT else 'obj'
+  if isinstance(value, float):
+    return 'float'
+  if isinstance(value, basestring):
+    return 'str'
+  return 'obj'
+
+
+class _Column(object):
+  '''A Column stores the values of one field of the rows of a _Table, in a
+  contiguous array (array module, viewed through numpy if available):
+
+    * 'int' and 'float' columns store numbers (missing values as 0).
+    * 'str' columns are dictionary-encoded: they store the code of each value
+      in `strings` (missing values as -1).
+    * 'obj' columns store nothing: their fields hold other values (or mixed
+      kinds), so queries on them read the documents.
+
+  The kind is that of the first value stored, and it changes (ints become
+  floats, anything else becomes 'obj') as other values are stored.
+  '''
+
+  def __init__(self, field, values=[]):
+    self.field = field
+    self.getter = _compiled_getattr(field, dict)
+    self.kind = None       # until a (non-missing) value is stored.
+    self.values = None
+    self.present = array.array('b')
+    self.strings = []      # code -> str
+    self.codes = {}        # str -> code
+    self.inexact = False   # whether an int column holds ints beyond 2**53.
+    for value in values:
+      self.append(value)
+
+  def __len__(self):
+    return len(self.present)
+
+  def value(self, doc):
+    '''Returns the value of this column's field in `doc`.'''
+    return self.getter(doc) if isinstance(doc, dict) else None
+
+  def _encode(self, value):
+    if self.kind == 'str':
+      code = self.codes.get(value)
+      if code is None:
+        code = self.codes[value] = len(self.strings)
+        self.strings.append(value)
+      return code
+    if self.kind == 'int' and not -_MAXEXACT < value < _MAXEXACT:
+      self.inexact = True
+    if self.kind == 'float':
+      return float(value)
+    return value
+
+  def _convert(self, value):
+    '''Converts this column to the kind that stores both its values and
+    `value`. Returns whether values of its kind can be stored.
+    '''
+    kind = _kind(value)
+    if self.kind is None:
+      self.kind = kind
+      if kind != 'obj':
+        typecode = 'd' if kind == 'float' else 'l'
+        self.values = array.array(typecode, [0] * len(self.present))
+        if kind == 'str':
+          self.values = array.array('l', [-1] * len(self.present))
+      return kind != 'obj'
+
+    if self.kind == kind or self.kind == 'obj':
+      return self.kind != 'obj'
+
+    # float columns store exact ints as they are. int columns widen to floats
+    # (once) if all their ints are exact.
+    exact = lambda v: -_MAXEXACT < v < _MAXEXACT
+    numbers = set([self.kind, kind]) == set(['int', 'float'])
+    if numbers and self.kind == 'float' and exact(value):
+      return True
+    if numbers and exact(value) and all(exact(v) for v in self.values):
+      self.kind = 'float'
+      self.values = array.array('d', self.values)
+      return True
+
+    self.kind = 'obj'
+    self.values = None
+    self.strings = []
+    self.codes = {}
+    return False
+
+  def append(self, doc):
+    '''Appends the value of `doc` as a new row.'''
+    value = self.value(doc)
+    if value is None or not self._convert(value):
+      self.present.append(0)
+      if self.values is not None:
+        self.values.append(-1 if self.kind == 'str' else 0)
+      return
+    self.present.append(1)
+    self.values.append(self._encode(value))
+
+  def set(self, row, doc):
+    '''Stores the value of `doc` in `row`.'''
+    value = self.value(doc)
+    if value is None or not self._convert(value):
+      self.present[row] = 0
+      if self.values is not None:
+        self.values[row] = -1 if self.kind == 'str' else 0
+      return
+    self.present[row] = 1
+    self.values[row] = self._encode(value)
+
+
+
+class _Table(object):
+  '''A Table stores the documents of one type, in rows, and columns of their
+  fields (built on first use). Deleted rows are tombstones (not `alive`),
+  until the table is compacted.
+  '''
+
+  def __init__(self):
+    self.docs = []              # row -> document (None if deleted)
+    self.keys = []              # row -> str key
+    self.rows = {}              # str key -> row
+    self.alive = array.array('b')
+    self.columns = {}           # field -> _Column
+    self.dead = 0
+
+  def __len__(self):
+    return len(self.rows)
+
+  def column(self, field):
+    '''Returns the column of `field`, building it if needed.'''
+    column = self.columns.get(field)
+    if column is None:
+      column = self.columns[field] = _Column(field, self.docs)
+    return column
+
+  def put(self, key, doc):
+    row = self.rows.get(key)
+    if row is not None:
+      self.docs[row] = doc
+      for column in self.columns.values():
+        column.set(row, doc)
+      return
+
+    self.rows[key] = len(self.docs)
+    self.docs.append(doc)
+    self.keys.append(key)
+    self.alive.append(1)
+    for column in self.columns.values():
+      column.append(doc)
+
+  def delete(self, key):
+    row = self.rows.pop(key, None)
+    if row is None:
+      return
+    self.docs[row] = None
+    self.alive[row] = 0
+    for column in self.columns.values():
+      column.set(row, None)
+
+    # compact when tombstones outnumber live rows.
+    self.dead += 1
+    if self.dead > max(1000, len(self.rows)):
+      self.compact()
+
+  def compact(self):
+    '''Drops the rows of deleted documents (and the columns, rebuilt later).'''
+    live = [(k, d) for k, d in zip(self.keys, self.docs) if d is not None]
+    self.__init__()
+    for key, doc in live:
+      self.put(key, doc)
+
+
+
+class ColumnarDatastore(basic.Datastore):
+  '''Represents an in-memory datastore for analytical queries. Alongside the
+  documents, it keeps a column for each (type, field) queried: a contiguous
+  array of numbers, or of dictionary-encoded strings (see _Column). Columns
+  are built on first use, and updated on every put and delete.
+
+  Query filters on columns are evaluated as vectorized masks and orders as
+  an argsort (numpy.lexsort), without probing the documents, if numpy is
+  available. Without numpy, filters loop over the flat columns, and orders
+  sort the matching documents. Filters the columns cannot evaluate (values
+  of other or mixed kinds, filters on None) and cursors read the documents
+  of the remaining rows. Results match those of DictDatastore.
+
+  Unlike DictDatastore, queries only return objects of the query's type.
+  '''
+
+  def __init__(self):
+    self._items = {}
+    self._tables = {} # type -> _Table
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._items)
+
+  @staticmethod
+  def _type(key):
+    try:
+      return key.type()
+    except ValueError:
+      return None # keys without types are stored, but never queried.
+
+  def get(self, key):
+    '''Return the object named by key.'''
+    return self._items.get(key)
+
+  def put(self, key, value):
+    '''Stores the object.'''
+    with self._lock:
+      if value is None:
+        return self.delete(key)
+      self._items[key] = value
+      type = self._type(key)
+      if type is not None:
+        if type not in self._tables:
+          self._tables[type] = _Table()
+        self._tables[type].put(str(key), value)
+
+  def delete(self, key):
+    '''Removes the object.'''
+    with self._lock:
+      self._items.pop(key, None)
+      type = self._type(key)
+      if type in self._tables:
+        self._tables[type].delete(str(key))
+
+  def contains(self, key):
+    '''Returns whether the object is in this datastore.'''
+    return key in self._items
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    with self._lock:
+      if basic.storedHash(self._items.get(key)) != expected_hash:
+        return False
+      self.put(key, value)
+      return True
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    return map(self._items.get, keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return map(self._items.__contains__, keys)
+
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    with self._lock:
+      table = self._tables.get(query.type)
+      if table is None or not table.rows:
+        return []
+
+      rows, filters = self._mask(table, query.filters)
+      docs = table.docs
+      if filters or query.start_cursor is not None:
+        passes = query.filterFn # all filters, as the others already passed.
+        rows = [row for row in rows if passes(docs[row])]
+
+      if not query.orders:
+        return query.project(query.slice([docs[row] for row in rows]))
+
+      ordered = self._argsort(table, rows, query.totalOrders())
+      if ordered is None:
+        return query.project(query.page([docs[row] for row in rows]))
+
+      stop = query.offset + query.limit if query.limit else None
+      return query.project([docs[row] for row in ordered[query.offset:stop]])
+
+  @staticmethod
+  def _view(values):
+    '''Returns a numpy view (no copy) of the array module array `values`.'''
+    dtypes = { 'b' : numpy.int8, 'l' : numpy.int_, 'd' : numpy.float64 }
+    return numpy.frombuffer(values, dtype=dtypes[values.typecode])
+
+  def _columnMask(self, column, filter, alive):
+    '''Returns the mask of the rows of `column` passing `filter`, or None if
+    the column cannot evaluate it. `alive` are the table's live rows.
+    '''
+    value = filter.value
+    if value is None:
+      return None
+
+    if column.kind in ['int', 'float']:
+      if not isinstance(value, (bool, int, long, float)) \
+        or not -_MAXINT < value < _MAXINT:
+        return None
+
+      # numpy compares ints to floats as floats: exact only below 2**53.
+      exact = lambda v: -_MAXEXACT < v < _MAXEXACT
+      inexact = column.inexact if column.kind == 'int' else not exact(value)
+      if isinstance(value, float) != (column.kind == 'float') and inexact:
+        return None
+    elif column.kind == 'str':
+      if not isinstance(value, basestring):
+        return None
+    elif column.kind is not None:
+      return None # 'obj'
+
+    # missing values compare as the filter does: None, or 'None' for strings.
+    op = Filter.CONDITIONAL_OPERATORS[filter.op]
+    missing = filter.predicate(dict)({})
+
+    if column.kind is None:
+      if numpy is not None:
+        return numpy.repeat(missing, len(column))
+      return [missing] * len(column)
+
+    if column.kind == 'str':
+      # evaluate the dictionary, then look up each row's code (-1: missing).
+      # as Filter.predicate, str values compare to str(unicode) strings,
+      # which fails for non-ascii ones. those of live rows read the documents
+      # (and fail there too). those of deleted rows are irrelevant.
+      passes, failed = [], []
+      for code, s in enumerate(column.strings):
+        try:
+          if isinstance(value, str) and not isinstance(s, str):
+            s = str(s)
+          passes.append(op(s, value))
+        except UnicodeError:
+          passes.append(False)
+          failed.append(code)
+      passes.append(missing)
+
+      if numpy is not None:
+        codes = self._view(column.values)
+        if failed and numpy.in1d(codes[alive], failed).any():
+          return None
+        return numpy.array(passes, dtype=bool)[codes]
+
+      if failed and any(a and c in failed \
+          for c, a in itertools.izip(column.values, alive)):
+        return None
+      return [passes[code] for code in column.values]
+
+    if numpy is not None:
+      present = self._view(column.present).astype(bool)
+      mask = op(self._view(column.values), value)
+      return numpy.where(present, mask, missing)
+    return [op(v, value) if p else missing \
+      for v, p in itertools.izip(column.values, column.present)]
+
+  def _mask(self, table, filters):
+    '''Returns (rows, filters): the live rows passing the filters the columns
+    evaluate, and the filters they could not.
+    '''
+    if numpy is not None:
+      alive = self._view(table.alive).astype(bool)
+    else:
+      alive = list(table.alive)
+
+    mask = alive.copy() if numpy is not None else alive
+    remaining = []
+    for filter in filters:
+      column = table.column(filter.field)
+      passes = self._columnMask(column, filter, alive)
+      if passes is None:
+        remaining.append(filter)
+      elif numpy is not None:
+        mask &= passes
+      else:
+        mask = [m and p for m, p in itertools.izip(mask, passes)]
+
+    if numpy is not None:
+      return numpy.flatnonzero(mask), remaining
+    return [row for row, m in enumerate(mask) if m], remaining
+
+  def _argsort(self, table, rows, orders):
+    '''Returns `rows` sorted by `orders` (vectorized), or None if the columns
+    cannot sort them.
+    '''
+    if numpy is None:
+      return None
+
+    rows = numpy.asarray(rows, dtype=numpy.int_)
+    keys = [] # least significant first, for lexsort.
+    for order in reversed(orders):
+      column = table.column(order.field)
+      if column.kind == 'obj':
+        return None
+      if column.kind is None:
+        continue # all missing: no effect on the order.
+
+      values = self._view(column.values)[rows]
+      if column.kind == 'str':
+        # codes sort as their strings' ranks. missing codes (-1) rank as 0.
+        ranks = numpy.zeros(len(column.strings) + 1, dtype=numpy.int_)
+        ordered = sorted(range(len(column.strings)),
+          key=column.strings.__getitem__)
+        ranks[ordered] = numpy.arange(len(ordered))
+        values = ranks[values]
+
+      # missing values (None) sort before all others.
+      present = self._view(column.present)[rows]
+      sign = 1 if order.isAscending() else -1
+      keys.append(values * sign)
+      keys.append(present * sign)
+
+    if not keys:
+      return rows
+    return rows[numpy.lexsort(keys)]
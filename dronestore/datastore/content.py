@@ -0,0 +1,178 @@
+
+import json
+import hashlib
+import itertools
+
+import basic
+from ..model import Key
+from ..query import Query
+
+__version__ = '1'
+
+kATTRIBUTES = 'attributes'
+kREFS = 'attributerefs'
+kBLOB = 'blob'
+kREFCOUNT = 'refcount'
+
+
+class ContentAddressedDatastore(basic.ShimDatastore):
+  '''Represents a datastore that deduplicates version attributes by content.
+
+  Attribute data (e.g. { 'value' : ..., 'updated' : ... }) is stored once per
+  distinct content, named by its sha1 hash, in `blob_datastore`. The records
+  stored in the child datastore carry the attribute hashes instead:
+
+    { 'key' : ..., 'hash' : ..., ..., 'attributerefs' : { name : sha1 } }
+
+  Blobs are reference counted, and removed when no record refers to them.
+  Values that are not version data are stored as they are.
+
+  WARNING: records do not carry attribute values, so queries are evaluated
+           here, on resolved versions, rather than pushed down to the child.
+  '''
+
+  BLOB_TYPE = 'ContentBlob'
+
+  def __init__(self, datastore, blob_datastore=None):
+    '''Initializes the datastore. Blobs are stored in `datastore` by default.'''
+    super(ContentAddressedDatastore, self).__init__(datastore)
+
+    if blob_datastore is None:
+      blob_datastore = datastore
+    if not isinstance(blob_datastore, basic.Datastore):
+      raise TypeError('blob_datastore must be of type %s' % basic.Datastore)
+    self.blob_datastore = blob_datastore
+
+  @staticmethod
+  def contentHash(data):
+    '''Returns the hash naming the content `data`.'''
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+  @classmethod
+  def blobKey(cls, hash):
+    '''Returns the key of the blob named by `hash`.'''
+    return Key('/%s/%s' % (cls.BLOB_TYPE, hash))
+
+  @staticmethod
+  def _isVersionData(value):
+    return isinstance(value, dict) and isinstance(value.get(kATTRIBUTES), dict)
+
+  @staticmethod
+  def _isBlob(value):
+    return isinstance(value, dict) and kBLOB in value and kREFCOUNT in value
+
+  @staticmethod
+  def _refs(record):
+    if isinstance(record, dict) and kREFS in record:
+      return record[kREFS].values()
+    return []
+
+
+  def _incref(self, hash, data):
+    '''Adds a reference to blob `hash`, storing `data` if it is new.'''
+    key = self.blobKey(hash)
+    blob = self.blob_datastore.get(key)
+    if blob is None:
+      blob = { kBLOB : data, kREFCOUNT : 0 }
+    blob[kREFCOUNT] += 1
+    self.blob_datastore.put(key, blob)
+
+  def _decref(self, hash):
+    '''Removes a reference to blob `hash`, deleting it if unreferenced.'''
+    key = self.blobKey(hash)
+    blob = self.blob_datastore.get(key)
+    if blob is None:
+      return
+
+    blob[kREFCOUNT] -= 1
+    if blob[kREFCOUNT] > 0:
+      self.blob_datastore.put(key, blob)
+    else:
+      self.blob_datastore.delete(key)
+
+  def _resolve(self, record):
+    '''Returns the version data for `record`, fetching the referenced blobs.'''
+    if not isinstance(record, dict) or kREFS not in record:
+      return record
+
+    value = dict(record)
+    refs = value.pop(kREFS)
+    value[kATTRIBUTES] = {}
+    for name, hash in refs.items():
+      blob = self.blob_datastore.get(self.blobKey(hash))
+      if blob is None:
+        raise KeyError('missing blob %s for %s' % (hash, record['key']))
+      value[kATTRIBUTES][name] = blob[kBLOB]
+    return value
+
+
+  def get(self, key):
+    '''Return the object named by key.'''
+    return self._resolve(self.child_datastore.get(key))
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    return map(self._resolve, self.child_datastore.get_many(keys))
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    for key in keys:
+      self.delete(key)
+
+  def put(self, key, value):
+    '''Stores the object.'''
+    if value is None:
+      self.delete(key)
+      return
+
+    old_refs = self._refs(self.child_datastore.get(key))
+
+    record = value
+    if self._isVersionData(value):
+      record = dict(value)
+      attributes = record.pop(kATTRIBUTES)
+      record[kREFS] = {}
+      for name, data in attributes.items():
+        hash = self.contentHash(data)
+        record[kREFS][name] = hash
+        self._incref(hash, data)
+
+    self.child_datastore.put(key, record)
+
+    # release old references only after adding new ones, so blobs shared by
+    # both versions are never deleted in between.
+    for hash in old_refs:
+      self._decref(hash)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.
+    Records keep the version hash, so the check needs no blobs. Not atomic.
+    '''
+    if basic.storedHash(self.child_datastore.get(key)) != expected_hash:
+      return False
+    self.put(key, value)
+    return True
+
+  def delete(self, key):
+    '''Removes the object.'''
+    old_refs = self._refs(self.child_datastore.get(key))
+    self.child_datastore.delete(key)
+    for hash in old_refs:
+      self._decref(hash)
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    records = self.child_datastore.query(Query(query.type, limit=0))
+    records = itertools.ifilter(lambda r: not self._isBlob(r), records)
+    return query(itertools.imap(self._resolve, records))
+
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`. The child
+    stores attribute references, not values: aggregate the resolved objects.
+    '''
+    return basic.Datastore.aggregate(self, query, aggregates, groupby)
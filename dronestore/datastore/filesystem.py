@@ -1,11 +1,19 @@
 
 import os
 import json
+import time
+import fcntl
+import uuid
+import hashlib
 import basic
 
 class FSDatastore(basic.Datastore):
   '''Represents a flat-file datastore.'''
 
+  # scratch directory for atomic writes. dot-prefixed, so no type maps to it.
+  SCRATCH_DIR = '.scratch'
+  LOCK_TIMEOUT = 10 # seconds
+
   def __init__(self, directory, serializer=json):
     if len(directory) < 1:
       raise ValueError('directory must be a sring of at least length 1')
@@ -55,10 +63,69 @@ class FSDatastore(basic.Datastore):
       os.makedirs(directory)
 
 
+  def lock_path(self, key):
+    '''Returns the path of the lock file guarding `key`'''
+    name = hashlib.sha1(self.relative_path(key)).hexdigest()
+    return os.path.join(self.directory, self.SCRATCH_DIR, name + '.lock')
+
+  def acquire_lock(self, path):
+    '''Acquires the lock file at `path`, returning its open descriptor (see
+    `release_lock`). Locks are flock()s, which also exclude other processes,
+    and which the OS releases when a process dies: a crashed writer does not
+    leave the key locked.
+
+    Lock files are left in place: removing them would let a waiter lock the
+    removed file while another locks its replacement.
+    '''
+    self.ensure_directory_exists(os.path.dirname(path))
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY)
+    deadline = time.time() + self.LOCK_TIMEOUT
+    while True:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+      except IOError:
+        if time.time() > deadline:
+          os.close(fd)
+          raise IOError('timed out waiting for lock %s' % path)
+        time.sleep(0.001)
+
+  @staticmethod
+  def release_lock(fd):
+    '''Releases the lock acquired (see `acquire_lock`) on descriptor `fd`.'''
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+  def replace_object_in_file(self, path, value):
+    '''write out `object` to a scratch file, and rename it to `path`.
+    Renaming is atomic, so readers never see a partially written file.
+    '''
+    self.ensure_directory_exists(os.path.dirname(path))
+    scratch = os.path.join(self.directory, self.SCRATCH_DIR, uuid.uuid4().hex)
+    with open(scratch, 'w') as f:
+      f.write(self.serializer.dumps(value))
+    os.rename(scratch, path)
+
+
   def get(self, key):
     '''Return the object named by key.'''
     return self.read_object_from_file(self.path(key))
 
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.
+    Atomic across processes sharing the directory: the comparison happens
+    under a lock file, and the write is an atomic rename.
+    '''
+    path = self.path(key)
+    lock = self.acquire_lock(self.lock_path(key))
+    try:
+      if basic.storedHash(self.read_object_from_file(path)) != expected_hash:
+        return False
+      self.replace_object_in_file(path, value)
+      return True
+    finally:
+      self.release_lock(lock)
+
   def put(self, key, value):
     '''Stores the object.'''
     self.write_object_to_file(self.path(key), value)
@@ -82,10 +149,76 @@ class FSDatastore(basic.Datastore):
     if not os.path.exists(path):
       return []
 
-    filenames = os.listdir(path)
-    paths = map(lambda f: os.path.join(path, f), filenames)
-    objects = map(lambda f: self.read_object_from_file(f), paths)
-    return query(objects)
+    # read objects lazily, so unordered queries stop reading at their limit.
+    def objects(filenames):
+      for filename in filenames:
+        value = self.read_object_from_file(os.path.join(path, filename))
+        if value is not None: # deleted since listed.
+          yield value
+
+    return query(objects(os.listdir(path)))
+
+  def _listings(self, paths):
+    '''Returns the filenames in the parent directories of `paths`, listing
+    each directory once.
+    '''
+    listings = {}
+    for path in paths:
+      directory = os.path.dirname(path)
+      if directory not in listings:
+        try:
+          listings[directory] = set(os.listdir(directory))
+        except OSError:
+          listings[directory] = set()
+    return listings
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    # list each directory once, rather than stat every missing file.
+    paths = map(self.path, keys)
+    listings = self._listings(paths)
+    values = []
+    for path in paths:
+      if os.path.basename(path) in listings[os.path.dirname(path)]:
+        values.append(self.read_object_from_file(path))
+      else:
+        values.append(None)
+    return values
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    directories = set()
+    for key, value in items:
+      path = self.path(key)
+      directory = os.path.dirname(path)
+      if directory not in directories:
+        self.ensure_directory_exists(directory)
+        directories.add(directory)
+
+      with open(path, 'w') as f:
+        f.write(self.serializer.dumps(value))
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    paths = map(self.path, keys)
+    listings = self._listings(paths)
+    for path in paths:
+      filename = os.path.basename(path)
+      listing = listings[os.path.dirname(path)]
+      if filename in listing:
+        os.remove(path)
+        listing.remove(filename)
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.
+    Missing keys are answered from directory listings, without a stat. Listed
+    ones are checked to be files, as in `contains`: the directory holding the
+    children of a key is not the key.
+    '''
+    paths = map(self.path, keys)
+    listings = self._listings(paths)
+    return [os.path.basename(p) in listings[os.path.dirname(p)] \
+      and os.path.isfile(p) for p in paths]
 
 
 
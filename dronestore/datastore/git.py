@@ -34,6 +34,15 @@ class GitDatastore(filesystem.FSDatastore):
     self.git('add "%s"' % self.relative_path(key))
     self.commit('put %s' % key)
 
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    if not super(GitDatastore, self).put_if(key, value, expected_hash):
+      return False
+
+    self.git('add "%s"' % self.relative_path(key))
+    self.commit('put %s' % key)
+    return True
+
   def delete(self, key):
     '''Removes the object.'''
     path = self.path(key)
@@ -43,4 +52,24 @@ class GitDatastore(filesystem.FSDatastore):
     self.git('rm %s' % self.relative_path(key))
     self.commit('delete %s' % key)
 
+  def put_many(self, items):
+    '''Stores the objects, in a single git commit.'''
+    items = list(items)
+    if not items:
+      return
+
+    super(GitDatastore, self).put_many(items)
+    paths = ' '.join(['"%s"' % self.relative_path(k) for k, v in items])
+    self.git('add %s' % paths)
+    self.commit('put %d objects' % len(items))
+
+  def delete_many(self, keys):
+    '''Removes the objects, in a single git commit.'''
+    keys = [k for k, isIn in zip(keys, self.contains_many(keys)) if isIn]
+    if not keys:
+      return
+
+    self.git('rm %s' % ' '.join(['"%s"' % self.relative_path(k) for k in keys]))
+    self.commit('delete %d objects' % len(keys))
+
 
@@ -0,0 +1,418 @@
+
+import bisect
+import itertools
+import threading
+
+import basic
+from ..model import Key
+from ..query import Query, _compiled_getattr
+
+
+class _Last(object):
+  '''Sorts after any key, to bound (value, key) index entries by value.'''
+  def __cmp__(self, other):
+    return 0 if other is self else 1
+
+_LAST = _Last()
+
+
+class _SortedList(object):
+  '''A sorted list, kept in blocks of up to 2 * LOAD items. Adding and
+  removing items bisects (O(log n)) and moves at most a block of items,
+  rather than O(n) items of a single list. Positions are (block, offset).
+  '''
+
+  LOAD = 500
+
+  def __init__(self, items=[]):
+    items = sorted(items)
+    self._blocks = [items[i:i + self.LOAD] \
+      for i in range(0, len(items), self.LOAD)]
+    self._maxes = [block[-1] for block in self._blocks]
+    self._len = len(items)
+
+  def __len__(self):
+    return self._len
+
+  def __iter__(self):
+    return itertools.chain.from_iterable(self._blocks)
+
+  def add(self, item):
+    '''Inserts `item`, in order.'''
+    self._len += 1
+    if not self._blocks:
+      self._blocks.append([item])
+      self._maxes.append(item)
+      return
+
+    i = min(bisect.bisect_left(self._maxes, item), len(self._blocks) - 1)
+    block = self._blocks[i]
+    bisect.insort(block, item)
+    self._maxes[i] = block[-1]
+    if len(block) > 2 * self.LOAD:
+      self._blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+      self._maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+
+  def remove(self, item):
+    '''Removes `item`. Raises ValueError if it is not in the list.'''
+    i, j = self.position(item)
+    if i == len(self._blocks) or self._blocks[i][j] != item:
+      raise ValueError('%r not in list' % (item,))
+
+    self._len -= 1
+    block = self._blocks[i]
+    del block[j]
+    if block:
+      self._maxes[i] = block[-1]
+    else:
+      del self._blocks[i]
+      del self._maxes[i]
+
+  def position(self, item):
+    '''Returns the position of the first item not less than `item`.'''
+    i = bisect.bisect_left(self._maxes, item)
+    if i == len(self._blocks):
+      return (i, 0)
+    return (i, bisect.bisect_left(self._blocks[i], item))
+
+  def end(self):
+    '''Returns the position after the last item.'''
+    return (len(self._blocks), 0)
+
+  def slice(self, start, stop, reverse=False):
+    '''Returns an iterator over the items from position `start` up to (not
+    including) `stop`, reversed if `reverse`.
+    '''
+    if stop <= start:
+      return iter([])
+
+    (first, offset), (last, limit) = start, stop
+    indices = range(first, min(last, len(self._blocks) - 1) + 1)
+    def chunk(i):
+      block = self._blocks[i]
+      items = block[offset if i == first else 0:limit if i == last else None]
+      return reversed(items) if reverse else items
+
+    indices = reversed(indices) if reverse else indices
+    return itertools.chain.from_iterable(itertools.imap(chunk, indices))
+
+
+
+class Index(object):
+  '''An Index maps the values of one field of the objects of one type to
+  their keys. It is both a hash index (for `=` lookups) and a sorted index
+  (for ranges and ordering) of (value, key) entries: equal values are in key
+  order, as in Query.totalOrders.
+
+  Unhashable values (e.g. lists) cannot be looked up by hash; their keys are
+  kept apart, and returned as candidates for every equality lookup.
+  '''
+
+  def __init__(self, type, field):
+    self.type = type
+    self.field = field
+    self._getter = _compiled_getattr(field, dict)
+
+    self._hash = {}          # value -> set of keys
+    self._unhashable = set() # keys with unhashable values
+    self._entries = _SortedList() # (value, key), sorted
+    self._current = {}       # key -> indexed value
+    self._strings = True     # whether all values are strings
+
+  def __len__(self):
+    return len(self._current)
+
+  def value(self, obj):
+    '''Returns the value of this index's field in `obj`.'''
+    return self._getter(obj) if isinstance(obj, dict) else None
+
+  def _hashEntry(self, key, value):
+    self._current[key] = value
+    if value is not None and not isinstance(value, basestring):
+      self._strings = False
+
+    try:
+      self._hash.setdefault(value, set()).add(key)
+    except TypeError:
+      self._unhashable.add(key)
+
+  def add(self, key, obj):
+    '''Indexes `obj`, stored under (string) `key`.'''
+    self.remove(key)
+    value = self.value(obj)
+    self._hashEntry(key, value)
+    self._entries.add((value, key))
+
+  def load(self, items):
+    '''Indexes the objects in `items`, (string key, object) pairs, at once.
+    Sorting them all once is much faster than adding them one by one.
+    '''
+    entries = []
+    for key, obj in items:
+      self.remove(key)
+      value = self.value(obj)
+      self._hashEntry(key, value)
+      entries.append((value, key))
+
+    entries.extend(self._entries)
+    self._entries = _SortedList(entries)
+
+  def remove(self, key):
+    '''Removes the entry of (string) `key`, if indexed.'''
+    if key not in self._current:
+      return
+    value = self._current.pop(key)
+
+    try:
+      keys = self._hash[value]
+      keys.discard(key)
+      if not keys:
+        del self._hash[value]
+    except TypeError:
+      self._unhashable.discard(key)
+
+    self._entries.remove((value, key))
+
+  def usable(self, filter):
+    '''Returns whether this index can serve `filter`. Filters with string
+    values compare stringified object values, so they can only use indexes
+    of strings.
+    '''
+    if filter.field != self.field or filter.op == '!=':
+      return False
+    return self._strings or not isinstance(filter.value, str)
+
+  def lookup(self, value):
+    '''Returns the keys of the objects whose value might equal `value`.'''
+    try:
+      keys = self._hash.get(value, set())
+    except TypeError:
+      keys = set()
+    return keys | self._unhashable
+
+  def count(self, value):
+    '''Returns the number of keys `lookup(value)` returns, without them.'''
+    try:
+      keys = self._hash.get(value, ())
+    except TypeError:
+      keys = ()
+    return len(keys) + len(self._unhashable)
+
+  def range(self, filters, descending=False, after=None):
+    '''Returns the keys of the objects whose values pass the range `filters`,
+    in (value, key) order (reversed if `descending`). If given, `after` is a
+    (value, key) entry: only the keys after it, in that order, are returned.
+    '''
+    entries = self._entries
+    start, stop = (0, 0), entries.end()
+    for f in filters:
+      if f.op == '>':
+        start = max(start, entries.position((f.value, _LAST)))
+      elif f.op == '>=':
+        start = max(start, entries.position((f.value,)))
+      elif f.op == '<':
+        stop = min(stop, entries.position((f.value,)))
+      elif f.op == '<=':
+        stop = min(stop, entries.position((f.value, _LAST)))
+
+    if after is not None:
+      if descending:
+        stop = min(stop, entries.position(after))
+      else:
+        start = max(start, entries.position(after + (_LAST,)))
+
+    return [key for value, key in entries.slice(start, stop, descending)]
+
+
+
+class IndexedDatastore(basic.ShimDatastore):
+  '''Represents a datastore that maintains secondary indexes on the fields of
+  the objects stored in its child datastore.
+
+  Indexes are declared as (type, field) pairs, where type is a model class or
+  type name, and field is an attribute (or version field, e.g. 'committed').
+  They are kept in memory, built from the child datastore on initialization,
+  and updated on every put and delete through this datastore.
+
+  Queries are planned (see `plan`) to use an index when they can:
+
+    * an `=` filter on an indexed field looks up the matching keys.
+    * range filters (<, <=, >, >=) on an indexed field select a slice of its
+      sorted index, in order.
+    * an order on an indexed field walks its sorted index, in order. Walks
+      with a `start_cursor` start after it, rather than skipping to it.
+
+  Only the candidate objects are fetched from the child, and the query is
+  applied to them (so filters not served by the index still apply). Ordered
+  walks stream: they stop fetching once the limit is reached. Queries no
+  index serves fall back to the child's query.
+
+  WARNING: writes to the child datastore that bypass this datastore leave the
+           indexes stale. Call `rebuild` after them.
+  '''
+
+  FETCH_BATCH = 100
+
+  def __init__(self, datastore, indexes=[]):
+    '''Initializes the datastore, indexing the (type, field) pairs `indexes`.'''
+    super(IndexedDatastore, self).__init__(datastore)
+
+    self._indexes = {} # type -> { field -> Index }
+    for type, field in indexes:
+      type = type if isinstance(type, basestring) else type.__dstype__
+      self._indexes.setdefault(type, {})[field] = Index(type, field)
+
+    self._lock = threading.RLock()
+    self.rebuild()
+
+  def index(self, type, field):
+    '''Returns the Index on `field` of `type`, or None.'''
+    type = type if isinstance(type, basestring) else type.__dstype__
+    return self._indexes.get(type, {}).get(field)
+
+  def rebuild(self):
+    '''Rebuilds all indexes from the objects in the child datastore.'''
+    with self._lock:
+      for type, indexes in self._indexes.items():
+        for field in indexes:
+          indexes[field] = Index(type, field)
+
+        items = []
+        for obj in self.child_datastore.query(Query(type, limit=0)):
+          key = self._objectKey(obj)
+          if key is not None and Key(key).type() == type:
+            items.append((key, obj))
+
+        for index in indexes.values():
+          index.load(items)
+
+  @staticmethod
+  def _objectKey(obj):
+    try:
+      return str(obj['key'])
+    except (KeyError, TypeError):
+      return None
+
+  def _typeIndexes(self, key):
+    try:
+      return self._indexes.get(key.type(), {}).values()
+    except ValueError:
+      return [] # keys without types are never indexed.
+
+  def _index(self, key, value):
+    indexes = self._typeIndexes(Key(key))
+    for index in indexes:
+      if value is None:
+        index.remove(key)
+      else:
+        index.add(key, value)
+
+
+  def put(self, key, value):
+    '''Stores the object, and indexes it.'''
+    with self._lock:
+      self.child_datastore.put(key, value)
+      self._index(str(key), value)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    with self._lock:
+      stored = self.child_datastore.put_if(key, value, expected_hash)
+      if stored:
+        self._index(str(key), value)
+      return stored
+
+  def delete(self, key):
+    '''Removes the object, and its index entries.'''
+    with self._lock:
+      self.child_datastore.delete(key)
+      self._index(str(key), None)
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    items = list(items)
+    with self._lock:
+      self.child_datastore.put_many(items)
+      for key, value in items:
+        self._index(str(key), value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    keys = list(keys)
+    with self._lock:
+      self.child_datastore.delete_many(keys)
+      for key in keys:
+        self._index(str(key), None)
+
+
+  def plan(self, query):
+    '''Returns how `query` would be run, as a dict:
+
+      { 'scan' : True } for a query served by the child datastore.
+      { 'index' : field, 'lookup' : value } for an equality lookup.
+      { 'index' : field, 'range' : [filters], 'ordered' : bool } for a walk
+        of a range (or all) of the sorted index, which is in the query's
+        order if `ordered`.
+    '''
+    indexes = self._indexes.get(query.type, {})
+    usable = lambda f: f.field in indexes and indexes[f.field].usable(f)
+
+    # equality lookups are the most selective. pick the fewest candidates.
+    lookups = [f for f in query.filters if f.op == '=' and usable(f)]
+    if lookups:
+      sizes = [indexes[f.field].count(f.value) for f in lookups]
+      best = lookups[sizes.index(min(sizes))]
+      return { 'index' : best.field, 'lookup' : best.value }
+
+    # a single order on an indexed field is served by walking the index.
+    order = query.orders[0] if len(query.orders) == 1 else None
+    ranges = [f for f in query.filters if f.op != '=' and usable(f)]
+    if order is not None and order.field in indexes:
+      filters = [f for f in ranges if f.field == order.field]
+      return { 'index' : order.field, 'range' : filters, 'ordered' : True }
+
+    if ranges:
+      field = ranges[0].field
+      filters = [f for f in ranges if f.field == field]
+      return { 'index' : field, 'range' : filters, 'ordered' : False }
+
+    return { 'scan' : True }
+
+  def _fetch(self, keys):
+    '''Yields the objects named by (string) `keys`, fetched in batches.'''
+    keys = iter(keys)
+    while True:
+      batch = [Key(k) for k in itertools.islice(keys, self.FETCH_BATCH)]
+      if not batch:
+        return
+      for value in self.child_datastore.get_many(batch):
+        if value is not None:
+          yield value
+
+  @staticmethod
+  def _after(query):
+    '''Returns the (value, key) index entry of the `start_cursor` of `query`,
+    a walk of an index in its order, or None. The walk starts after it.
+    '''
+    values = [v for equal, (f, op, v) in query.cursorFilters()]
+    return tuple(values) if len(values) == 2 else None
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    plan = self.plan(query)
+    if 'scan' in plan:
+      return self.child_datastore.query(query)
+
+    with self._lock:
+      index = self._indexes[query.type][plan['index']]
+      if 'lookup' in plan:
+        keys = list(index.lookup(plan['lookup']))
+        return query(self._fetch(keys))
+
+      descending, after = False, None
+      if plan['ordered']:
+        descending = query.orders[0].isDescending()
+        after = self._after(query)
+      keys = list(index.range(plan['range'], descending, after))
+
+    return query(self._fetch(keys), ordered=plan['ordered'])
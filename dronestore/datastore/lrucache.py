@@ -1,12 +1,20 @@
 
 import basic
 import pylru
+import parallel
 
 class LRUCache(basic.Datastore):
-  '''Represents an LRU cache datastore. backed by pylru.'''
+  '''Represents an LRU cache datastore. backed by pylru.
 
-  def __init__(self, size):
+  Like DictDatastore, queries over many objects can run in parallel in
+  `processes` forked processes (opt-in).
+  '''
+
+  PARALLEL_SCAN_SIZE = basic.DictDatastore.PARALLEL_SCAN_SIZE
+
+  def __init__(self, size, processes=1):
     self._cache = pylru.lrucache(size)
+    self.processes = processes
 
   def __len__(self):
     return len(self._cache)
@@ -36,5 +44,35 @@ class LRUCache(basic.Datastore):
 
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
+    # pylru iterates its live list, which reads reorder: snapshot it first.
+    # keys-only queries without criteria need not touch the objects.
+    if query.keysonly and not query.filters and not query.orders:
+      return query.slice(list(self._cache.keys()))
+
     # entire dataset already in memory, so ok to apply query naively
-    return query(self._cache.values())
+    values = list(self._cache.values())
+    if self.processes > 1 and len(values) >= self.PARALLEL_SCAN_SIZE:
+      return parallel.scan(query, values, self.processes)
+    return query(values)
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`, in order (None if missing).'''
+    cache = self._cache
+    return [cache[key] if key in cache else None for key in keys]
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    cache = self._cache
+    for key, value in items:
+      cache[key] = value
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    cache = self._cache
+    for key in keys:
+      if key in cache:
+        del cache[key]
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return map(self._cache.__contains__, keys)
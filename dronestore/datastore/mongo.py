@@ -3,9 +3,13 @@ import basic
 import pymongo
 import bson
 
+from ..model import Key
+from ..query import Filter, Aggregate
+
 __version__ = '1'
 
 kKEY = 'key'
+kCOMMITTED = 'committed'
 kVAL = 'val'
 kMONGOID = '_id'
 kWRAPPED = 'dswrapped'
@@ -24,9 +28,12 @@ class MongoDatastore(basic.Datastore):
     # place objects in collections based on the keyType
     collection = self.database[type]
 
-    # ensure there is an index, at least once per run.
+    # ensure there are indexes, at least once per run. the committed index
+    # serves queries for versions committed since a time (replication).
     if type not in self._indexed:
       collection.create_index(kKEY, unique=True)
+      collection.create_index([(kCOMMITTED, pymongo.ASCENDING),
+        (kKEY, pymongo.ASCENDING)])
       self._indexed[type] = True
 
     return collection
@@ -72,6 +79,27 @@ class MongoDatastore(basic.Datastore):
     # update (or insert) the relevant document matching key
     self._collection(key).update( { kKEY:sKey }, value, upsert=True, safe=True)
 
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.
+    Atomic: the hash is part of the update's match, and inserts rely on the
+    unique index on key.
+    '''
+    sKey = str(key)
+    value = self._wrap(sKey, value)
+    collection = self._collection(key)
+
+    if expected_hash is None:
+      try:
+        # insert adds an _id to the document. copy it: it is the caller's.
+        collection.insert(dict(value), safe=True)
+      except pymongo.errors.DuplicateKeyError:
+        return False
+      return True
+
+    match = { kKEY:sKey, 'hash':expected_hash }
+    result = collection.update(match, value, upsert=False, safe=True)
+    return result['n'] == 1
+
   def delete(self, key):
     '''Removes the object.'''
     self._collection(key).remove( { kKEY:str(key) } )
@@ -85,6 +113,46 @@ class MongoDatastore(basic.Datastore):
     coll = self._collectionForType(query.type)
     return QueryTranslate.collectionQuery(coll, query)
 
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` of the objects matching `query`, computed by
+    mongodb's aggregation pipeline (only the results are transferred).
+    '''
+    coll = self._collectionForType(query.type)
+    return QueryTranslate.collectionAggregate(coll, query, aggregates, groupby)
+
+  @staticmethod
+  def _keysByType(keys):
+    '''Returns a dict mapping each key type to its (stringified) keys.'''
+    types = {}
+    for key in keys:
+      types.setdefault(key.type(), []).append(str(key))
+    return types
+
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`. One query per collection.'''
+    keys = list(keys)
+    found = {}
+    for type, sKeys in self._keysByType(keys).items():
+      cursor = self._collectionForType(type).find( { kKEY:{'$in':sKeys} } )
+      for value in cursor:
+        found[value[kKEY]] = self._unwrap(value)
+    return [found.get(str(key)) for key in keys]
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`. One request per collection.'''
+    for type, sKeys in self._keysByType(keys).items():
+      self._collectionForType(type).remove( { kKEY:{'$in':sKeys} } )
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    keys = list(keys)
+    found = set()
+    for type, sKeys in self._keysByType(keys).items():
+      coll = self._collectionForType(type)
+      cursor = coll.find( { kKEY:{'$in':sKeys} }, fields=[kKEY])
+      found.update([value[kKEY] for value in cursor])
+    return [str(key) in found for key in keys]
+
 
 class UnwrapperCursor(object):
   '''An iterator object to wrap around the mongodb cursor.
@@ -101,6 +169,15 @@ class UnwrapperCursor(object):
     return MongoDatastore._unwrap(self.cursor.next())
 
 
+class KeyCursor(UnwrapperCursor):
+  '''An iterator object to wrap around a mongodb cursor of keys-only query
+  results (documents projected to their key). Returns Keys.
+  '''
+
+  def next(self):
+    return Key(self.cursor.next()[kKEY])
+
+
 
 class QueryTranslate(object):
   '''Translates queries from dronestore queries to mongodb queries.'''
@@ -110,14 +187,54 @@ class QueryTranslate(object):
 
   @classmethod
   def collectionQuery(self, collection, query):
-    cursor = collection.find(self.filters(query.filters))
+    if query.keysonly:
+      cursor = collection.find(self.spec(query), fields=[kKEY])
+    else:
+      cursor = collection.find(self.spec(query))
     if len(query.orders) > 0:
-      cursor.sort(self.orders(query.orders))
+      cursor.sort(self.orders(query.totalOrders()))
     if query.offset > 0:
       cursor.skip(query.offset)
     cursor.limit(query.limit)
+    if query.keysonly:
+      return KeyCursor(cursor)
     return UnwrapperCursor(cursor)
 
+  @classmethod
+  def collectionAggregate(cls, collection, query, aggregates, groupby=None):
+    aggregates = map(Aggregate.make, aggregates)
+    partials = Aggregate.expand(aggregates)
+
+    group = { kMONGOID : '$' + cls.field(groupby) if groupby else None }
+    for i, partial in enumerate(partials):
+      group['a%d' % i] = cls.accumulator(partial)
+    pipeline = [ { '$match' : cls.spec(query.scan()) }, { '$group' : group } ]
+
+    # pymongo 2 returns the command response; later versions a cursor.
+    result = collection.aggregate(pipeline)
+    docs = result['result'] if isinstance(result, dict) else list(result)
+
+    def results(doc):
+      values = dict([(str(p), doc['a%d' % i] if doc else p.initial()) \
+        for i, p in enumerate(partials)])
+      return Aggregate.results(aggregates, values)
+
+    if groupby:
+      return dict([(doc[kMONGOID], results(doc)) for doc in docs])
+    return results(docs[0] if docs else None)
+
+  @classmethod
+  def accumulator(cls, aggregate):
+    '''Returns the $group accumulator computing (partial) `aggregate`.'''
+    if aggregate.op != 'count':
+      return { '$' + aggregate.op : '$' + cls.field(aggregate.field) }
+    if aggregate.field is None:
+      return { '$sum' : 1 }
+
+    # count the documents with a (non-null) value.
+    value = { '$ifNull' : ['$' + cls.field(aggregate.field), None] }
+    return { '$sum' : { '$cond' : [ { '$eq' : [value, None] }, 0, 1] } }
+
   @classmethod
   def field(cls, field):
     if field in cls.VERSION_FIELDS:
@@ -136,6 +253,18 @@ class QueryTranslate(object):
     vals = [cls.filter(f) for f in filters]
     return dict(zip(keys, vals))
 
+  @classmethod
+  def spec(cls, query):
+    '''Returns the mongodb query document selecting the objects that pass the
+    filters of `query`, after its start_cursor (as an $or of ranges).
+    '''
+    spec = cls.filters(query.filters)
+    ranges = query.cursorFilters()
+    if ranges:
+      spec['$or'] = [cls.filters([Filter(*f) for f in equal + [bound]]) \
+        for equal, bound in ranges]
+    return spec
+
   @classmethod
   def orders(cls, orders):
     keys = [cls.field(o.field) for o in orders]
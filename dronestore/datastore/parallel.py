@@ -0,0 +1,57 @@
+
+import itertools
+import multiprocessing
+
+
+# values being scanned, by scan token. forked workers inherit them (copy on
+# write), so values are never pickled to the workers -- only results back.
+_scans = {}
+_tokens = itertools.count()
+
+
+def _scanPartition(args):
+  # slice (rather than iterate up to `start`), so workers only touch the
+  # reference counts, and so copy the pages, of the objects they scan.
+  token, query, start, stop = args
+  return list(query(_scans[token][start:stop]))
+
+
+def scan(query, values, processes, partitions=None):
+  '''Applies `query` to the sequence `values` in parallel, in `processes`
+  forked worker processes. Returns an iterator over the results.
+
+  The values are split in `partitions` (default: one per process) contiguous
+  ranges. Workers apply the query's prefix (see Query.prefix) to their ranges:
+  they filter, and keep only the first offset + limit matching objects (in a
+  bounded heap, for ordered queries). The partial results are merged (see
+  Query.merge) in this process.
+
+  Workers are forked for each scan, so they see the current values without
+  pickling them, and no workers linger between scans. Forking costs a few
+  milliseconds, and reference counting makes workers copy the memory pages of
+  the objects they scan: only worthwhile for large scans, expensive filters,
+  and idle cores (see test/bench_query.py).
+
+  WARNING: this relies on fork (POSIX). Results must be picklable.
+  '''
+  values = values if isinstance(values, list) else list(values)
+  partitions = partitions or processes
+  size = (len(values) + partitions - 1) // partitions or 1
+
+  token = next(_tokens)
+  _scans[token] = values
+  try:
+    pool = multiprocessing.Pool(processes) # forks, inheriting _scans.
+  finally:
+    del _scans[token]
+
+  try:
+    prefix = query.prefix()
+    tasks = [(token, prefix, start, start + size) \
+      for start in range(0, len(values), size)]
+    results = pool.map(_scanPartition, tasks)
+  finally:
+    pool.terminate()
+    pool.join()
+
+  return query.merge(results)
@@ -3,6 +3,8 @@ import basic
 import json
 import requests
 
+from ..model import Key
+from ..query import Filter
 from ..attribute import DateTimeAttribute
 
 
@@ -165,6 +167,8 @@ def _parse_field_for_field(field):
 class ParseDatastore(basic.Datastore):
   '''Represents a Parse (parse.com) database as a datastore.'''
 
+  MAX_LIMIT = 1000 # objects per query response.
+
   def __init__(self, appid, masterkey):
     self.parseconn = ParseConnection(appid, masterkey)
 
@@ -203,10 +207,34 @@ class ParseDatastore(basic.Datastore):
     '''Returns whether the object is in this datastore.'''
     return self.get(key) is not None
 
+  def get_many(self, keys):
+    '''Returns the objects named by `keys`. One request per class, for every
+    MAX_LIMIT keys (Parse returns at most that many objects per request).
+    '''
+    keys = list(keys)
+    types = {}
+    for key in keys:
+      types.setdefault(key.type(), []).append(str(key))
+
+    found = {}
+    for type, sKeys in types.items():
+      for i in range(0, len(sKeys), self.MAX_LIMIT):
+        chunk = sKeys[i:i + self.MAX_LIMIT]
+        query = {'where' : {'key': {'$in' : chunk}}, 'limit' : len(chunk)}
+        for pobj in self.parseconn.query(type, query)['results']:
+          found[pobj['key']] = _version_data_from_parse_object(pobj)
+    return [found.get(str(key)) for key in keys]
+
+  def contains_many(self, keys):
+    '''Returns whether each object named by `keys` is in this datastore.'''
+    return [value is not None for value in self.get_many(keys)]
+
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
     pquery = QueryTranslate.query(query)
     res = self.parseconn.query(query.type, pquery)
+    if query.keysonly:
+      return [Key(pobj['key']) for pobj in res['results']]
     return UnParseIterator(res['results'])
 
 
@@ -231,8 +259,15 @@ class QueryTranslate(object):
   @classmethod
   def query(self, dsquery):
     pquery = {}
+    where = self.filters(dsquery.filters)
+    ranges = dsquery.cursorFilters()
+    if ranges:
+      where['$or'] = [self.filters([Filter(*f) for f in equal + [bound]]) \
+        for equal, bound in ranges]
+    if where:
+      pquery['where'] = where
     if len(dsquery.orders) > 0:
-      pquery['order'] = self.orders(dsquery.orders)
+      pquery['order'] = self.orders(dsquery.totalOrders())
     if dsquery.offset > 0:
       pquery['skip'] = dsquery.offset
     if dsquery.limit > 0:
@@ -251,9 +286,32 @@ class QueryTranslate(object):
 
   @classmethod
   def filters(cls, filters):
-    keys = [cls.field(f.field) for f in filters]
-    vals = [cls.filter(f) for f in filters]
-    return dict(zip(keys, vals))
+    '''Returns the `where` of `filters`, merging the filters on each field:
+    e.g. {'n' : {'$gt' : 1, '$lt' : 5}}. Among others, equalities become
+    `$in` (of the value, or of nothing if they disagree).
+    '''
+    fields = {}
+    for f in filters:
+      fields.setdefault(cls.field(f.field), []).append(f)
+
+    where = {}
+    for field, filters in fields.items():
+      if len(filters) == 1:
+        where[field] = cls.filter(filters[0])
+        continue
+
+      where[field] = condition = {}
+      for f in filters:
+        if f.op == '=':
+          same = condition.get('$in', [f.value]) == [f.value]
+          condition['$in'] = [f.value] if same else []
+        elif f.op == '!=':
+          condition.setdefault('$nin', []).append(f.value)
+        else:
+          op = cls.COND_OPS[f.op]
+          tightest = max if f.op in ['>', '>='] else min
+          condition[op] = tightest(condition.get(op, f.value), f.value)
+    return where
 
   @classmethod
   def orders(cls, orders):
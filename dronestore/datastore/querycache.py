@@ -0,0 +1,196 @@
+
+import json
+import itertools
+import threading
+
+import basic
+import pylru
+
+
+class _CachedQuery(object):
+  '''A cached query result, with what is needed to invalidate it.'''
+  __slots__ = ('query', 'results', 'keys', 'complete', 'filterFn')
+
+  def __init__(self, query, results):
+    self.query = query
+    self.results = results
+    self.keys = set(_resultKey(r) for r in results)
+    self.filterFn = query.filterFn
+
+    # the results are all the objects passing the filters (so an object not
+    # in them does not pass) unless they were cut by the offset or limit.
+    self.complete = query.offset == 0 and \
+      (not query.limit or len(results) < query.limit)
+
+  def affectedBy(self, key, value, old):
+    '''Returns whether writing `value` (None for deletions) to `key` might
+    change these results. `old` returns the value previously stored.
+    '''
+    if value is not None and self.filterFn(value):
+      return True
+    if key in self.keys:
+      return True
+    if self.complete:
+      return False # the old value did not pass the filters.
+
+    # the old value might have passed, outside the page (e.g. past the limit).
+    old = old()
+    return old is not None and self.filterFn(old)
+
+
+def _resultKey(result):
+  try:
+    return str(result['key'])
+  except (KeyError, TypeError):
+    return str(result)
+
+
+
+class QueryCacheDatastore(basic.ShimDatastore):
+  '''Represents a cache of query results in front of a datastore.
+
+  Results are cached by query (canonical `Query.dict()`) in an LRU cache of
+  `size` queries. Results longer than `maxresults` are not cached, so memory
+  use is bounded by size * maxresults objects.
+
+  Writes through this datastore invalidate precisely: a put or delete of an
+  object of type T only drops the cached queries for type T whose results it
+  might change, i.e. queries the new (or old) object passes the filters of, or
+  whose results contain it. The old object is only read if needed: when a
+  query's results were cut by its offset or limit.
+
+  Hits, misses, and invalidations are counted (see `stats`).
+
+  WARNING: writes to the child datastore that bypass this datastore leave
+           cached results stale. Call `clear` after them.
+  '''
+
+  DEFAULT_SIZE = 100
+  DEFAULT_MAXRESULTS = 2000
+
+  def __init__(self, datastore, size=DEFAULT_SIZE,
+    maxresults=DEFAULT_MAXRESULTS):
+    '''Initializes the cache of `size` queries in front of `datastore`.'''
+    super(QueryCacheDatastore, self).__init__(datastore)
+    if size < 1:
+      raise ValueError('size must be at least 1')
+
+    self.maxresults = maxresults
+    self._lock = threading.RLock()
+    self._cache = pylru.lrucache(size, self._evicted)
+    self._byType = {}     # type -> { cachekey -> _CachedQuery }
+    self._generations = {} # type -> count of writes to the type
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def __len__(self):
+    return len(self._cache)
+
+  @staticmethod
+  def cacheKey(query):
+    '''Returns the key caching the results of `query`.'''
+    return json.dumps(query.dict(), sort_keys=True)
+
+  def _evicted(self, cachekey, cached):
+    entries = self._byType.get(cached.query.type, {})
+    entries.pop(cachekey, None)
+
+  def clear(self):
+    '''Drops all cached results.'''
+    with self._lock:
+      self._cache.clear()
+      self._byType = {}
+      for type in self._generations:
+        self._generations[type] += 1
+
+  def stats(self):
+    '''Returns a dict with the hits, misses, invalidations, and size.'''
+    with self._lock:
+      lookups = self.hits + self.misses
+      return { 'hits' : self.hits, 'misses' : self.misses,
+        'invalidations' : self.invalidations, 'size' : len(self._cache),
+        'hitrate' : float(self.hits) / lookups if lookups else None }
+
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`'''
+    cachekey = self.cacheKey(query)
+    with self._lock:
+      if cachekey in self._cache:
+        self.hits += 1
+        return list(self._cache[cachekey].results)
+      self.misses += 1
+      generation = self._generations.get(query.type, 0)
+
+    results = iter(self.child_datastore.query(query))
+    head = list(itertools.islice(results, self.maxresults + 1))
+    if len(head) > self.maxresults:
+      return itertools.chain(head, results) # too large to cache.
+
+    with self._lock:
+      # writes to the type while querying may have been missed. don't cache.
+      if self._generations.get(query.type, 0) == generation:
+        cached = _CachedQuery(query, head)
+        self._cache[cachekey] = cached
+        self._byType.setdefault(query.type, {})[cachekey] = cached
+    return list(head)
+
+  def _invalidate(self, key, value):
+    '''Drops the cached results that writing `value` to `key` might change.'''
+    try:
+      types = [key.type()]
+    except ValueError:
+      types = self._byType.keys() # untyped keys might match anything.
+
+    strkey = str(key)
+    olds = []
+    def old():
+      if not olds:
+        olds.append(self.child_datastore.get(key))
+      return olds[0]
+
+    for type in types:
+      self._generations[type] = self._generations.get(type, 0) + 1
+      entries = self._byType.get(type, {})
+      for cachekey, cached in entries.items():
+        if cached.affectedBy(strkey, value, old):
+          del entries[cachekey]
+          del self._cache[cachekey]
+          self.invalidations += 1
+
+
+  def put(self, key, value):
+    '''Stores the object, invalidating the results it might change.'''
+    with self._lock:
+      self._invalidate(key, value)
+      self.child_datastore.put(key, value)
+
+  def put_if(self, key, value, expected_hash):
+    '''Stores the object only if the stored version hash is `expected_hash`.'''
+    with self._lock:
+      # invalidate first (the old value may be needed), even if not stored.
+      self._invalidate(key, value)
+      return self.child_datastore.put_if(key, value, expected_hash)
+
+  def delete(self, key):
+    '''Removes the object, invalidating the results it might change.'''
+    with self._lock:
+      self._invalidate(key, None)
+      self.child_datastore.delete(key)
+
+  def put_many(self, items):
+    '''Stores the objects in `items`, a sequence of (key, value) pairs.'''
+    items = list(items)
+    with self._lock:
+      for key, value in items:
+        self._invalidate(key, value)
+      self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    keys = list(keys)
+    with self._lock:
+      for key in keys:
+        self._invalidate(key, None)
+      self.child_datastore.delete_many(keys)
@@ -1,30 +1,147 @@
 
+import time
+import functools
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
 from model import Key, Version, Model
+from ancestry import AncestryIndex
+from history import VersionHistory
+from feed import Change, ChangeFeed
 from query import Query, InstanceIterator
 from datastore import Datastore, DictDatastore
+from datastore.asynchronous import AsyncDatastore, MappedResult, GatheredResult
 from .util.serial import SerialRepresentation
+from .util.lock import StripedLock
+from .util.stats import Stats
+
+class MergeConflictError(Exception):
+  pass
+
+
+def _timed(name):
+  '''Decorates a Drone method to record its latency in stats `name`.'''
+  def decorator(fn):
+    @functools.wraps(fn)
+    def timed(self, *args, **kwargs):
+      with self._stats.timer(name):
+        return fn(self, *args, **kwargs)
+    return timed
+  return decorator
+
+
+class _TimedIterator(object):
+  '''Wraps an iterator, recording in `histogram` the time spent producing all
+  its items (plus `elapsed` seconds, e.g. spent creating it) once exhausted.
+  '''
+
+  def __init__(self, iterable, histogram, elapsed=0):
+    self._iter = iter(iterable)
+    self._histogram = histogram
+    self._elapsed = elapsed
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    start = time.time()
+    try:
+      item = self._iter.next()
+    except StopIteration:
+      if self._histogram is not None:
+        elapsed = self._elapsed + time.time() - start
+        self._histogram.record(elapsed * 1000000)
+        self._histogram = None
+      raise
+    self._elapsed += time.time() - start
+    return item
+
 
 class Drone(object):
   '''Drone represents the logical unit of storage in dronestore.
   Each drone consists of a datastore (or set of datastores) and an id.
   '''
 
+  # times a merge is retried when the stored version changes underneath it.
+  MERGE_ATTEMPTS = 10
+
   #FIXME(jbenet): remove DictDatastore as a default?
-  def __init__(self, droneid, store=DictDatastore()):
-    '''Initializes drone with given id and datastore.'''
+  def __init__(self, droneid, store=DictDatastore(), ancestry=None,
+    history=None, cachesize=0, feed=None):
+    '''Initializes drone with given id and datastore.
+
+    If an AncestryIndex `ancestry` is given, the drone records the versions it
+    sees, and merges three-way against the common ancestor when it is known.
+
+    If a VersionHistory `history` is given, the drone records every version it
+    stores, enabling reads of past versions (see `get` and `history`).
+
+    If `cachesize` is positive, the drone keeps up to that many decoded
+    versions of recently read objects. Reads still go to the datastore, but
+    skip decoding when the stored version matches the cached one.
+
+    If a ChangeFeed `feed` is given, the drone publishes a Change to it for
+    every put, merge, and delete, after it is stored. A feed is created if
+    none is given, see `subscribe`.
+
+    The drone records the latency of its operations, and the time spent
+    decoding versions, merging, and in datastore calls. See `stats`.
+    '''
     if not isinstance(droneid, Key):
       droneid = Key(droneid)
     if not isinstance(store, Datastore):
       raise ValueError('store must be an instance of %s' % Datastore)
+    if ancestry is not None and not isinstance(ancestry, AncestryIndex):
+      raise ValueError('ancestry must be an instance of %s' % AncestryIndex)
+    if history is not None and not isinstance(history, VersionHistory):
+      raise ValueError('history must be an instance of %s' % VersionHistory)
+    if cachesize < 0:
+      raise ValueError('cachesize must not be negative')
+    if feed is None:
+      feed = ChangeFeed()
+    if not isinstance(feed, ChangeFeed):
+      raise ValueError('feed must be an instance of %s' % ChangeFeed)
 
     self._droneid = droneid
     self._store = store
+    self._ancestry = ancestry
+    self._history = history
+    self._cachesize = cachesize
+    self._cache = collections.OrderedDict() # key -> Version, in LRU order.
+    self._feed = feed
+    self._stats = Stats()
 
   @property
   def droneid(self):
     '''This drone's identifier.'''
     return self._droneid
 
+  @property
+  def feed(self):
+    '''The ChangeFeed this drone publishes its changes to.'''
+    return self._feed
+
+  def subscribe(self, fn):
+    '''Calls `fn(change)` for every Change made through this drone.'''
+    self._feed.subscribe(fn)
+
+  def unsubscribe(self, fn):
+    '''Stops calling `fn` with changes.'''
+    self._feed.unsubscribe(fn)
+
+  def stats(self, reset=False):
+    '''Returns a snapshot of this drone's latency histograms (microseconds):
+    one per operation (get, put, merge, ...), and the breakdown of time spent
+    `decoding` versions, `merging` them, and `storing` (in datastore calls).
+    Each has a count, min, max, mean, percentiles, and rate (per second since
+    the last reset). If `reset` is True, starts recording anew.
+    '''
+    snapshot = self._stats.snapshot()
+    if reset:
+      self._stats.reset()
+    return snapshot
+
   def __str__(self):
     return '<dronestore.drone.Drone object at %s %s>' % (id(self), self.droneid)
 
@@ -40,71 +157,487 @@ class Drone(object):
 
     raise TypeError('expected input of type %s or %s' % (Version, Model))
 
+  @classmethod
+  def _cleanKey(cls, key):
+    '''Ensures `key` is a Key.'''
+    if not isinstance(key, Key):
+      raise ValueError('key must be of type %s' % Key)
+    return key
+
+  def _version(self, data):
+    '''Returns the Version represented by stored `data`, reusing the cached
+    version if it is the same (same hash and committed time).
+    '''
+    if not self._cachesize:
+      with self._stats.timer('decoding'):
+        return Version(SerialRepresentation(data, trusted=True))
+
+    key = str(data['key'])
+    version = self._cache.pop(key, None)
+    if version is None or version.hash != data['hash'] \
+      or version.serialRepresentation['committed'] != data['committed']:
+      with self._stats.timer('decoding'):
+        version = Version(SerialRepresentation(data, trusted=True))
+
+    self._cache[key] = version
+    if len(self._cache) > self._cachesize:
+      self._cache.popitem(last=False)
+    return version
+
+  def _uncache(self, key):
+    '''Invalidates the cached version of `key`.'''
+    if self._cache:
+      self._cache.pop(str(key), None)
+
+  def _call(self, method, *args):
+    '''Calls datastore `method`, recording its latency in `storing`.'''
+    with self._stats.timer('storing'):
+      return getattr(self._store, method)(*args)
+
+  def _record(self, version, parents=None, op=Change.PUT):
+    '''Records a newly stored `version` in the ancestry index and history,
+    and publishes its change.
+    '''
+    self._uncache(version.key)
+    if self._ancestry is not None:
+      self._ancestry.add(version, parents)
+    if self._history is not None:
+      self._history.append(version)
+    self._feed.publish(Change.from_version(version, op))
+
+  def _instance(self, data):
+    '''Returns the entity represented by stored `data`.'''
+    if data is None:
+      return data
+
+    # handle the data. if any conversion fails, propagate the exception up.
+    version = self._version(data)
+    if self._ancestry is not None:
+      self._ancestry.add(version)
+    return Model.from_version(version)
+
+  def _mergeInto(self, curr_instance, new_version):
+    '''Merges `new_version` into `curr_instance`. Returns the parents of the
+    merged version, or None if nothing changed.
+    '''
+    # merge three-way if the common ancestor of both versions is known.
+    curr_version = curr_instance.version
+    ancestor = None
+    if self._ancestry is not None:
+      self._ancestry.add(new_version)
+      ancestor = self._ancestry.commonAncestor(curr_version.key,
+        curr_version.hash, new_version.hash)
+
+    # NOTE: semantically, we must merge into the current instance in the drone
+    # so that merge strategies favor the incumbent version.
+    with self._stats.timer('merging'):
+      curr_instance.merge(new_version, ancestor)
+    if curr_instance.version is curr_version:
+      return None # nothing changed.
+    return [curr_version.hash, new_version.hash]
+
 
+  @_timed('put')
   def put(self, versionOrEntity):
     '''Stores the current version of `entity` in the datastore.'''
     version = self._cleanVersion(versionOrEntity)
-    self._store.put(version.key, version.serialRepresentation.data())
+    self._call('put', version.key, version.serialRepresentation.data())
+    self._record(version)
     return versionOrEntity
 
+  @_timed('put_many')
+  def put_many(self, versionsOrEntities):
+    '''Stores the current versions of `entities` in the datastore.'''
+    versions = map(self._cleanVersion, versionsOrEntities)
+    items = [(v.key, v.serialRepresentation.data()) for v in versions]
+    self._call('put_many', items)
+    for version in versions:
+      self._record(version)
+    return versionsOrEntities
 
-  def get(self, key):
-    '''Retrieves the current entity addressed by `key`'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
+
+  @_timed('get')
+  def get(self, key, at=None):
+    '''Retrieves the current entity addressed by `key`.
+    If `at` (a nanotime) is given, retrieves the entity as it was at that time,
+    which requires the drone to keep a VersionHistory.
+    '''
+    self._cleanKey(key)
+
+    if at is not None:
+      if self._history is None:
+        raise ValueError('cannot read past versions without a history')
+      version = self._history.versionAt(key, at)
+      return Model.from_version(version) if version is not None else None
 
     # lookup the key in the datastore
-    data = self._store.get(key)
-    if data is None:
-      return data
+    return self._instance(self._call('get', key))
 
-    # handle the data. if any conversion fails, propagate the exception up.
-    serialRep = SerialRepresentation(data)
-    version = Version(serialRep)
-    return Model.from_version(version)
+  @_timed('get_many')
+  def get_many(self, keys):
+    '''Retrieves the current entities addressed by `keys` (None if missing).'''
+    keys = map(self._cleanKey, keys)
+    return map(self._instance, self._call('get_many', keys))
 
 
+  @_timed('merge')
   def merge(self, newVersionOrEntity):
-    '''Merges a new version of an instance with the current one in the store.'''
+    '''Merges a new version of an instance with the current one in the store.
+
+    The merged version is stored only if the stored version is still the one
+    merged into (see Datastore.put_if). If another writer (e.g. another
+    process) stored a version in between, the merge is redone against it.
+    '''
 
     # get the new version
     new_version = self._cleanVersion(newVersionOrEntity)
+    new_data = new_version.serialRepresentation.data()
+
+    key = new_version.key
+    for attempt in range(0, self.MERGE_ATTEMPTS):
+
+      # get the instance
+      #THINKME(jbenet): try contains first?
+      curr_instance = self._instance(self._call('get', key))
+
+      # brand new version. just store it.
+      if curr_instance is None:
+        if self._call('put_if', key, new_data, None):
+          self._record(new_version, op=Change.MERGE)
+          return Model.from_version(new_version)
+        continue
+
+      curr_hash = curr_instance.version.hash
+      parents = self._mergeInto(curr_instance, new_version)
+      if parents is None:
+        return curr_instance # nothing changed. no need to store it back.
+
+      # store it back, recording that it descends from both versions.
+      data = curr_instance.version.serialRepresentation.data()
+      if self._call('put_if', key, data, curr_hash):
+        self._record(curr_instance.version, parents, Change.MERGE)
+        return curr_instance
+
+    errstr = 'merging %s conflicted %d times with concurrent writes'
+    raise MergeConflictError(errstr % (key, self.MERGE_ATTEMPTS))
+
+  @_timed('merge_many')
+  def merge_many(self, newVersionsOrEntities):
+    '''Merges new versions of instances with the current ones in the store.
+    Fetches and merges all the instances in batches. As in `merge`, each one
+    is stored only if the stored version is still the one merged into; the
+    keys other writers stored in between are merged again, in a batch.
+    '''
+    new_versions = map(self._cleanVersion, newVersionsOrEntities)
+    results = [None] * len(new_versions)
+    pending = range(0, len(new_versions))
+    for attempt in range(0, self.MERGE_ATTEMPTS):
+      conflicts = self._mergeBatch(new_versions, pending, results)
+      if not conflicts:
+        return results
+      pending = [i for i in pending if new_versions[i].key in conflicts]
+
+    errstr = 'merging %s conflicted %d times with concurrent writes'
+    key = new_versions[pending[0]].key
+    raise MergeConflictError(errstr % (key, self.MERGE_ATTEMPTS))
+
+  def _mergeBatch(self, new_versions, indices, results):
+    '''Merges the `new_versions` at `indices` into the stored instances,
+    setting their `results`. Returns the keys that conflicted with writes
+    made since they were read (and were not stored).
+    '''
+    curr_instances = self.get_many([new_versions[i].key for i in indices])
+
+    merged = {} # key -> (instance, parents) of instances to store back.
+    read = {}   # key -> hash of the version read (None if new).
+    for i, curr_instance in zip(indices, curr_instances):
+      new_version = new_versions[i]
+      key = new_version.key
+      if key not in read:
+        read[key] = curr_instance.version.hash if curr_instance else None
+
+      # a key may appear more than once. merge into the latest instance.
+      if key in merged:
+        curr_instance = merged[key][0]
+
+      # brand new version. just store it.
+      if curr_instance is None:
+        instance = Model.from_version(new_version)
+        merged[key] = (instance, None)
+        results[i] = instance
+        continue
+
+      parents = self._mergeInto(curr_instance, new_version)
+      if parents is not None:
+        if key in merged and merged[key][1] is not None:
+          parents = merged[key][1] + parents[1:] # skip unstored versions.
+        merged[key] = (curr_instance, parents)
+      results[i] = curr_instance
+
+    conflicts = set()
+    for key, (instance, parents) in merged.items():
+      data = instance.version.serialRepresentation.data()
+      if self._call('put_if', key, data, read[key]):
+        self._record(instance.version, parents, Change.MERGE)
+      else:
+        conflicts.add(key)
+    return conflicts
+
+
+  @_timed('contains')
+  def contains(self, key):
+    '''Returns whether the datastore contains the entity addressed by `key`.'''
+    self._cleanKey(key)
+    return self._call('contains', key)
+
+
+  @_timed('delete')
+  def delete(self, key):
+    '''Deletes the entity addressed by `key` from the datastore.'''
+    self._cleanKey(key)
+
+    self._call('delete', key)
+    self._uncache(key)
+    if self._ancestry is not None:
+      self._ancestry.remove(key)
+    change = Change.deletion(key)
+    if self._history is not None:
+      self._history.delete(key, change.committed)
+    self._feed.publish(change)
+
+  def history(self, key):
+    '''Returns the recorded entities addressed by `key`, oldest first.'''
+    self._cleanKey(key)
+    if self._history is None:
+      raise ValueError('cannot read past versions without a history')
+
+    return InstanceIterator(self._history.versions(key))
+
+  def query(self, query):
+    '''Queries the datastore for objects matching `query`. Its latency is
+    the time spent in the datastore running the query and producing all its
+    results, recorded once they are exhausted.
+    '''
+    start = time.time()
+    results = self._call('query', query)
+    results = _TimedIterator(results, self._stats.histogram('query'),
+      time.time() - start)
+    return InstanceIterator(results, query, self)
+
+  @_timed('aggregate')
+  def aggregate(self, query, aggregates, groupby=None):
+    '''Returns the `aggregates` (e.g. 'count', ('sum', 'age')) of the objects
+    matching the filters of `query`, optionally grouped by field `groupby`.
+    See Query.aggregate.
+    '''
+    return self._call('aggregate', query, aggregates, groupby)
+
+  def committedSince(self, type, watermark=None, limit=1000):
+    '''Returns up to `limit` stored versions of `type` committed after
+    `watermark`, in (committed, key) order. A watermark is the (committed,
+    key) pair of the last version seen (see replication.Replicator), and None
+    means from the beginning. Datastores should index the `committed` field.
+
+    NOTE: deletions are not versions, so they are not returned.
+    '''
+    if limit < 1:
+      raise ValueError('limit must be at least 1')
+
+    watermark = tuple(watermark) if watermark is not None else None
+    after = lambda data: watermark is None or \
+      (data['committed'], data['key']) > watermark
+
+    # versions committed at the watermark time may be the ones already seen.
+    # fetch larger pages until they are past them (or the data runs out).
+    fetch = limit
+    while True:
+      query = Query(type, limit=fetch).order('committed').order('key')
+      query.filter('type', '=', query.type)
+      if watermark is not None:
+        query.filter('committed', '>=', watermark[0])
+
+      results = list(self._call('query', query))
+      versions = filter(after, results)
+      if versions or len(results) < fetch:
+        return map(self._version, versions[:limit])
+      fetch *= 2
+
+
+
+
+class ThreadSafeDrone(Drone):
+  '''ThreadSafeDrone is a Drone safe to share between threads.
+
+  Drone.merge reads, merges, and writes back the current version, so two
+  unguarded concurrent merges of the same key may lose one side's changes.
+  ThreadSafeDrone guards each key with a StripedLock: operations on the same
+  key serialize, while operations on different keys proceed in parallel.
+
+  NOTE: locks are per process. Drones in different processes sharing one
+        datastore need to coordinate through the datastore itself.
+  '''
+
+  def __init__(self, droneid, store=DictDatastore(),
+    stripes=StripedLock.DEFAULT_STRIPES, **kwargs):
+    '''Initializes drone with given id, datastore, and number of lock stripes.
+    Other arguments are as in Drone.
+    '''
+    super(ThreadSafeDrone, self).__init__(droneid, store, **kwargs)
+    self._locks = StripedLock(stripes)
+    self._cacheLock = threading.Lock()
+
+  def __str__(self):
+    return '<dronestore.drone.ThreadSafeDrone object at %s %s>' % \
+      (id(self), self.droneid)
+
+  def _version(self, data):
+    with self._cacheLock:
+      return super(ThreadSafeDrone, self)._version(data)
+
+  def _uncache(self, key):
+    with self._cacheLock:
+      super(ThreadSafeDrone, self)._uncache(key)
+
+
+  def put(self, versionOrEntity):
+    '''Stores the current version of `entity` in the datastore.'''
+    version = self._cleanVersion(versionOrEntity)
+    with self._locks.lock(version.key):
+      return super(ThreadSafeDrone, self).put(versionOrEntity)
+
+  def put_many(self, versionsOrEntities):
+    '''Stores the current versions of `entities` in the datastore.'''
+    versions = map(self._cleanVersion, versionsOrEntities)
+    with self._locks.locks([v.key for v in versions]):
+      return super(ThreadSafeDrone, self).put_many(versionsOrEntities)
+
+  def get(self, key, at=None):
+    '''Retrieves the current entity addressed by `key`.'''
+    self._cleanKey(key)
+    with self._locks.lock(key):
+      return super(ThreadSafeDrone, self).get(key, at)
+
+  def get_many(self, keys):
+    '''Retrieves the current entities addressed by `keys` (None if missing).'''
+    keys = map(self._cleanKey, keys)
+    with self._locks.locks(keys):
+      return super(ThreadSafeDrone, self).get_many(keys)
+
+  def merge(self, newVersionOrEntity):
+    '''Merges a new version of an instance with the current one in the store.'''
+    new_version = self._cleanVersion(newVersionOrEntity)
+    with self._locks.lock(new_version.key):
+      return super(ThreadSafeDrone, self).merge(newVersionOrEntity)
+
+  def merge_many(self, newVersionsOrEntities):
+    '''Merges new versions of instances with the current ones in the store.'''
+    new_versions = map(self._cleanVersion, newVersionsOrEntities)
+    with self._locks.locks([v.key for v in new_versions]):
+      return super(ThreadSafeDrone, self).merge_many(newVersionsOrEntities)
+
+  def delete(self, key):
+    '''Deletes the entity addressed by `key` from the datastore.'''
+    self._cleanKey(key)
+    with self._locks.lock(key):
+      super(ThreadSafeDrone, self).delete(key)
+
+
+
+class AsyncDrone(object):
+  '''AsyncDrone is a Drone whose calls do not block.
+  It is backed by an AsyncDatastore (e.g. a ThreadedDatastore wrapping a
+  network-backed datastore). Each call starts the operation and returns an
+  AsyncResult, so many lookups can be in flight at once:
+
+    results = [drone.get(key) for key in keys]
+    entities = [result.get() for result in results]
+  '''
+
+  DEFAULT_THREADS = 16
+
+  def __init__(self, droneid, store, threads=DEFAULT_THREADS):
+    '''Initializes drone with given id and async datastore. Merges (which
+    chain a get and a put) run on a pool of `threads`.
+    '''
+    if not isinstance(droneid, Key):
+      droneid = Key(droneid)
+    if not isinstance(store, AsyncDatastore):
+      raise ValueError('store must be an instance of %s' % AsyncDatastore)
+
+    self._droneid = droneid
+    self._store = store
+    self._pool = ThreadPool(threads)
+
+  def close(self):
+    '''Stops the threads running merges (once pending merges complete). The
+    datastore is left open: it is closed by its owner.
+    '''
+    self._pool.close()
+    self._pool.join()
+
+  @property
+  def droneid(self):
+    '''This drone's identifier.'''
+    return self._droneid
+
+  def __str__(self):
+    return '<dronestore.drone.AsyncDrone object at %s %s>' % \
+      (id(self), self.droneid)
+
+  @staticmethod
+  def _instance(data):
+    '''Returns the entity represented by stored `data`.'''
+    if data is None:
+      return data
+    version = Version(SerialRepresentation(data, trusted=True))
+    return Model.from_version(version)
+
+
+  def put(self, versionOrEntity):
+    '''Stores the current version of `entity` in the datastore.'''
+    version = Drone._cleanVersion(versionOrEntity)
+    result = self._store.put(version.key, version.serialRepresentation.data())
+    return MappedResult(result, lambda _: versionOrEntity)
 
-    # get the instance
+  def get(self, key):
+    '''Retrieves the current entity addressed by `key`'''
+    Drone._cleanKey(key)
+    return MappedResult(self._store.get(key), self._instance)
+
+  def get_many(self, keys):
+    '''Retrieves the current entities addressed by `keys`, concurrently.'''
+    return GatheredResult([self.get(key) for key in keys])
+
+  def merge(self, newVersionOrEntity):
+    '''Merges a new version of an instance with the current one in the store.'''
+    new_version = Drone._cleanVersion(newVersionOrEntity)
+    return self._pool.apply_async(self._merge, (new_version,))
+
+  def _merge(self, new_version):
     key = new_version.key
-    curr_instance = self.get(key) #THINKME(jbenet): try contains first?
+    curr_instance = self.get(key).get()
 
     # brand new version. just store it.
     if curr_instance is None:
-      self.put(new_version)
+      self.put(new_version).get()
       return Model.from_version(new_version)
 
-    # NOTE: semantically, we must merge into the current instance in the drone
-    # so that merge strategies favor the incumbent version.
+    curr_version = curr_instance.version
     curr_instance.merge(new_version)
-
-    # store it back
-    self.put(curr_instance)
+    if curr_instance.version is not curr_version:
+      self.put(curr_instance).get()
     return curr_instance
 
-
   def contains(self, key):
     '''Returns whether the datastore contains the entity addressed by `key`.'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
-
+    Drone._cleanKey(key)
     return self._store.contains(key)
 
-
   def delete(self, key):
     '''Deletes the entity addressed by `key` from the datastore.'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
-
-    self._store.delete(key)
+    Drone._cleanKey(key)
+    return self._store.delete(key)
 
   def query(self, query):
     '''Queries the datastore for objects matching `query`.'''
-    return InstanceIterator(self._store.query(query))
-
-
+    return MappedResult(self._store.query(query), InstanceIterator)
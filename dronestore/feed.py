@@ -0,0 +1,151 @@
+
+import os
+import json
+import threading
+import collections
+import nanotime
+
+from model import Key
+
+
+class Change(collections.namedtuple('Change', 'key hash committed op')):
+  '''A Change records one write to a drone: the `key` written, the `hash` and
+  `committed` time (in nanoseconds) of the version stored, and the operation
+  `op` (one of Change.OPS). Deletions carry no hash, and the deletion time.
+  '''
+
+  PUT = 'put'
+  MERGE = 'merge'
+  DELETE = 'delete'
+  OPS = (PUT, MERGE, DELETE)
+
+  def data(self):
+    '''Returns the (json-serializable) data representing this change.'''
+    return { 'key' : str(self.key), 'hash' : self.hash,
+      'committed' : self.committed, 'op' : self.op }
+
+  @classmethod
+  def from_data(cls, data):
+    '''Returns the change represented by `data`.'''
+    return cls(Key(data['key']), data['hash'], data['committed'], data['op'])
+
+  @classmethod
+  def from_version(cls, version, op):
+    '''Returns the change storing `version`.'''
+    committed = version.serialRepresentation['committed']
+    return cls(version.key, version.hash, committed, op)
+
+  @classmethod
+  def deletion(cls, key, when=None):
+    '''Returns the change deleting `key` at time `when` (default: now).'''
+    when = nanotime.now() if when is None else when
+    if isinstance(when, nanotime.nanotime):
+      when = when.nanoseconds()
+    return cls(key, None, int(when), cls.DELETE)
+
+
+
+class ChangeLog(object):
+  '''A ChangeLog is a durable, append-only log of changes, kept in a file.
+
+  Changes are stored one per line, as json. A cursor is the byte offset of a
+  position in the log, so readers resume from where they left off by keeping
+  the cursor returned by `read`, and reading from it later (even after a
+  restart). Cursor 0 is the beginning of the log.
+
+  If `sync` is True, each append is fsync'd before returning.
+  '''
+
+  def __init__(self, path, sync=False):
+    '''Initializes the log stored at `path`, creating it if needed.'''
+    self.path = path
+    self.sync = sync
+    self._lock = threading.Lock()
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+      os.makedirs(dirname)
+    self._file = open(path, 'ab')
+
+  def close(self):
+    '''Closes the log file.'''
+    with self._lock:
+      self._file.close()
+
+  def cursor(self):
+    '''Returns the cursor at the end of the log.'''
+    with self._lock:
+      self._file.seek(0, os.SEEK_END)
+      return self._file.tell()
+
+  def append(self, change):
+    '''Appends `change` to the log. Returns the cursor after it.'''
+    line = json.dumps(change.data()) + '\n'
+    with self._lock:
+      self._file.write(line)
+      self._file.flush()
+      if self.sync:
+        os.fsync(self._file.fileno())
+      return self._file.tell()
+
+  def read(self, cursor=0, limit=None):
+    '''Returns (changes, cursor): up to `limit` changes after `cursor`, and the
+    cursor to resume reading from.
+    '''
+    changes = []
+    with open(self.path, 'rb') as f:
+      f.seek(cursor)
+      while limit is None or len(changes) < limit:
+        line = f.readline()
+        if not line.endswith('\n'):
+          break # end of log (or a partially written line).
+        changes.append(Change.from_data(json.loads(line)))
+        cursor += len(line)
+    return changes, cursor
+
+  def __iter__(self):
+    return iter(self.read()[0])
+
+
+
+class ChangeFeed(object):
+  '''A ChangeFeed publishes the changes made through a drone, in order.
+
+  In-process subscribers are called (in the writing thread) with each Change,
+  after it is stored. If a ChangeLog `log` is given, changes are appended to it
+  before subscribers are called, so consumers in other processes (or that were
+  down) can catch up by reading the log from their cursor.
+
+  NOTE: changes to each key are published in the order they are stored, as
+        long as writes to the key are serialized (e.g. by a ThreadSafeDrone).
+  '''
+
+  def __init__(self, log=None):
+    '''Initializes the feed, appending changes to `log` (if given).'''
+    if log is not None and not isinstance(log, ChangeLog):
+      raise ValueError('log must be an instance of %s' % ChangeLog)
+
+    self.log = log
+    self._subscribers = []
+    self._lock = threading.Lock()
+
+  def subscribe(self, fn):
+    '''Calls `fn(change)` for every change published from now on.'''
+    if not callable(fn):
+      raise TypeError('subscriber (type %s) is not callable' % type(fn))
+    with self._lock:
+      self._subscribers = self._subscribers + [fn]
+
+  def unsubscribe(self, fn):
+    '''Stops calling `fn`.'''
+    with self._lock:
+      self._subscribers = [s for s in self._subscribers if s != fn]
+
+  def publish(self, change):
+    '''Publishes `change` to the log and all subscribers.'''
+    if self.log is not None:
+      self.log.append(change)
+
+    # the subscriber list is replaced (never mutated), so iterate a snapshot.
+    for subscriber in self._subscribers:
+      subscriber(change)
@@ -0,0 +1,174 @@
+
+import bisect
+import nanotime
+
+from model import Key, Version
+from datastore import Datastore, DictDatastore
+from util.serial import SerialRepresentation
+
+
+class VersionHistory(object):
+  '''A VersionHistory is an append-only record of the versions of objects.
+
+  Versions are kept per key, ordered by their committed time, which allows
+  indexed (binary search) lookups of the version current at any given time.
+  Deletions are recorded as tombstones, so reads before a deletion still work.
+
+  Each version is stored as one record in the given datastore, under the key
+  of its object (e.g. /Person/A/<committed>-<hash>), and indexed by one entry
+  per key (e.g. /Person/A/index), which lists the records in order:
+  { 'hash' : revision, 'committed' : [ns, ...], 'records' : [name or None] }
+
+  Appends write one record, and update the index with put_if (retrying if
+  another writer updated it meanwhile), so concurrent appends are all kept.
+
+  Retention is bounded by `maxVersions` (enforced on append) and `maxAge`
+  (enforced on compact). Compacting never drops the newest version older than
+  the retention window, so reads at the edge of the window still resolve.
+  '''
+
+  DEFAULT_MAX_VERSIONS = 1000
+
+  def __init__(self, store=None, maxVersions=DEFAULT_MAX_VERSIONS, maxAge=None):
+    '''Initializes the history. `maxAge` is in nanoseconds (or a nanotime).'''
+    if store is None:
+      store = DictDatastore()
+    if not isinstance(store, Datastore):
+      raise ValueError('store must be an instance of %s' % Datastore)
+    if maxVersions < 1:
+      raise ValueError('maxVersions must be at least 1')
+
+    self._store = store
+    self.maxVersions = maxVersions
+    self.maxAge = _nanoseconds(maxAge) if maxAge is not None else None
+
+  @staticmethod
+  def _indexKey(key):
+    return Key(key).child('index')
+
+  def _index(self, key):
+    '''Returns (a copy of) the index of `key`, to update in place.'''
+    index = self._store.get(self._indexKey(key))
+    if index is None:
+      return { 'hash' : None, 'committed' : [], 'records' : [] }
+    return { 'hash' : index['hash'], 'committed' : list(index['committed']),
+      'records' : list(index['records']) }
+
+  def _update(self, key, fn):
+    '''Applies `fn` to the index of `key` (in place), and stores it if `fn`
+    returns the names of the records it dropped (deleting them, once the
+    index no longer lists them). Retries if the index was updated meanwhile.
+    '''
+    while True:
+      index = self._index(key)
+      revision = index['hash']
+      dropped = fn(index)
+      if dropped is None:
+        return
+
+      index['hash'] = (revision or 0) + 1
+      if self._store.put_if(self._indexKey(key), index, revision):
+        names = [name for name in dropped if name is not None]
+        self._store.delete_many([Key(key).child(n) for n in names])
+        return
+
+  def _append(self, key, committed, data):
+    name = None
+    if data is not None:
+      name = '%d-%s' % (committed, data['hash'])
+      self._store.put(Key(key).child(name), data)
+
+    def append(index):
+      committeds, records = index['committed'], index['records']
+
+      # normally at the end, but older versions (e.g. merged) may arrive late.
+      i = bisect.bisect_right(committeds, committed)
+      if name is not None and i > 0 and records[i - 1] == name:
+        return None # already recorded.
+
+      committeds.insert(i, committed)
+      records.insert(i, name)
+
+      overflow = max(0, len(committeds) - self.maxVersions)
+      dropped = records[:overflow]
+      del committeds[:overflow]
+      del records[:overflow]
+      return dropped
+
+    self._update(key, append)
+
+  def append(self, version):
+    '''Records `version` in the history of its object.'''
+    if not isinstance(version, Version):
+      raise TypeError('expected input of type %s' % Version)
+    if version.isBlank:
+      raise ValueError('cannot record uncommitted versions')
+
+    data = version.serialRepresentation.data()
+    self._append(version.key, data['committed'], data)
+
+  def delete(self, key, when=None):
+    '''Records the deletion of the object named by `key` at time `when`.'''
+    when = nanotime.now() if when is None else when
+    self._append(key, _nanoseconds(when), None)
+
+  def versions(self, key):
+    '''Returns the recorded versions of `key`, oldest first.'''
+    names = [n for n in self._index(key)['records'] if n is not None]
+    records = self._store.get_many([Key(key).child(n) for n in names])
+    return [_version(data) for data in records if data is not None]
+
+  def versionAt(self, key, when):
+    '''Returns the version of `key` current at time `when`, or None.'''
+    index = self._index(key)
+    i = bisect.bisect_right(index['committed'], _nanoseconds(when))
+    if i == 0 or index['records'][i - 1] is None:
+      return None
+    return _version(self._store.get(Key(key).child(index['records'][i - 1])))
+
+  def compact(self, key, now=None):
+    '''Drops the versions of `key` that fall out of the retention window.'''
+    if self.maxAge is None:
+      return
+
+    now = nanotime.now() if now is None else now
+    cutoff = _nanoseconds(now) - self.maxAge
+
+    def compact(index):
+      # keep the newest version before the cutoff: it is current at the cutoff.
+      committeds, records = index['committed'], index['records']
+      i = bisect.bisect_right(committeds, cutoff) - 1
+      if i > 0 and records[i] is None:
+        i += 1 # a tombstone at the cutoff needs no predecessor.
+
+      if i <= 0:
+        return None
+
+      if i < len(records) and records[i] is None:
+        i += 1 # nor does a leading tombstone need keeping.
+      dropped = records[:i]
+      del committeds[:i]
+      del records[:i]
+      return dropped
+
+    self._update(key, compact)
+
+  def remove(self, key):
+    '''Forgets the entire history of `key`.'''
+    def remove(index):
+      dropped = index['records']
+      index['committed'], index['records'] = [], []
+      return dropped
+
+    self._update(key, remove)
+
+
+def _nanoseconds(when):
+  if isinstance(when, nanotime.nanotime):
+    return when.nanoseconds()
+  return int(when)
+
+def _version(data):
+  if data is None:
+    return None
+  return Version(SerialRepresentation(data, trusted=True))
@@ -1,7 +1,13 @@
 
+import copy
 import nanotime
 
-def merge(instance, version):
+def merge(instance, version, ancestor=None):
+  '''Merges `version` into `instance`, committing if anything changed.
+
+  If the common `ancestor` version is provided, the merge is three-way: only
+  the attributes changed in `version` since `ancestor` are considered.
+  '''
   if instance.isDirty():
     raise ValueError('Cannot merge dirty instance.')
 
@@ -10,19 +16,34 @@ def merge(instance, version):
 
   mergeData = {}
   for attr in instance.attributes().values():
-    rawData = attr.mergeStrategy.merge(instance.version, version)
+    strategy = attr.mergeStrategy
+    if ancestor is None:
+      rawData = strategy.merge(instance.version, version)
+    else:
+      rawData = strategy.threeWayMerge(instance.version, version, ancestor)
     if rawData: # none value means no change, i.e. keep the local attribute.
       mergeData[attr.name] = rawData
 
   if not mergeData:
     return # nothing changed.
 
-  # merging checks out, actually make the changes.
+  # merging checks out, actually make the changes. strategies return the data
+  # of (trusted) versions, which may be shared with a store: copy it.
   for attrname, rawData in mergeData.iteritems():
     attr = instance.attributes()[attrname]
-    attr.setRawData(instance, rawData)
+    attr.setRawData(instance, copy.deepcopy(rawData))
 
-  instance.commit()
+  # the instance was not dirty, so the attributes not merged still equal their
+  # (clean) data in the current version. reuse it rather than cleaning anew.
+  cleanData = {}
+  for attrname in instance.attributes():
+    if attrname not in mergeData:
+      try:
+        cleanData[attrname] = instance.version.attribute(attrname)
+      except KeyError:
+        pass
+
+  instance._commit(cleanData)
 
 
 class MergeDirection:
@@ -51,6 +72,24 @@ class MergeStrategy(object):
     raise NotImplementedError('No implementation for %s.merge()', \
       self.__class__.__name__)
 
+  def threeWayMerge(self, local_version, remote_version, base_version):
+    '''merges this attribute in two versions, given their common ancestor.
+
+    Attributes the remote did not change since `base_version` are kept, and
+    attributes only the remote changed are taken. Only attributes changed on
+    both sides are decided by `merge`.
+    '''
+    attr_base = self._attribute_data(base_version)
+    attr_remote = self._attribute_data(remote_version)
+    if attr_remote == attr_base:
+      return None # remote did not change it. keep local
+
+    attr_local = self._attribute_data(local_version)
+    if attr_local == attr_base:
+      return attr_remote # only remote changed it. take theirs
+
+    return self.merge(local_version, remote_version)
+
   def setAttribute(self, instance, rawData, default=False):
     '''Called whenever this particular attribute is set to a new value.'''
     pass
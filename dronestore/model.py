@@ -118,8 +118,8 @@ class Version(object):
   the object snapshot. Versions are used as snapshot 'containers,' including
   all of the data of the particular object snapshot.
 
-  The current implementation does not use incremental changes, as the entire
-  version history of each object is not tracked.
+  The current implementation does not use incremental changes. Objects only
+  carry their latest version; past versions may be kept in a VersionHistory.
   '''
   BLANK_HASH = '0000000000000000000000000000000000000000'
   REP_FIELDS = ['key', 'hash', 'parent', 'created', 'committed', 'attributes', \
@@ -349,15 +349,27 @@ class Model(object):
     if version.type != self.__class__.__dstype__:
       raise ValueError('Type name provided does not match.')
 
+    # deep copies: version data may be shared with the datastore (see
+    # SerialRepresentation's `trusted`), so instances must not mutate it.
     for attr in self.attributes().values():
       try:
-        value = copy.copy(version.attributeValue(attr.name))
+        value = copy.deepcopy(version.attributeValue(attr.name))
       except KeyError:
         value = attr.default_value()
         if not value and attr.required:
           raise
+        attr.__set__(self, value)
+        continue
+
       attr.__set__(self, value)
 
+      # restore the stored metadata (e.g. merge strategy state), rather than
+      # the state of setting the value anew (e.g. fresh timestamps).
+      rawData = attr.rawData(self)
+      for meta, metaValue in version.attribute(attr.name).items():
+        if meta != 'value':
+          rawData[meta] = metaValue
+
 
     self._key = version.key
     self._version = version
@@ -424,6 +436,14 @@ class Model(object):
 
   def commit(self):
     '''Committing a version creates a snapshot of the current changes.'''
+    self._commit({})
+
+  def _commit(self, cleanData):
+    '''Commits, building the version document in one pass. `cleanData` maps
+    attribute names to data known to be clean and equal to their raw data
+    (e.g. the stored data of attributes a merge left untouched), which is
+    reused as is. All other attributes are cleaned.
+    '''
 
     # this is actually broken for collection attributes:
     # if not self.isDirty():
@@ -431,35 +451,42 @@ class Model(object):
 
     self.validate()
 
-    sr = serial.SerialRepresentation()
-    sr['hash'] = self.computedHash()
-    if sr['hash'] == self._version.hash:
+    hash = self.computedHash()
+    if hash == self._version.hash:
       self._isDirty = False
       return # false alarm, nothing to commit.
 
-    sr['key'] = str(self.key)
-    sr['type'] = self.__dstype__
-    sr['parent'] = self._version.hash
-    sr['created'] = self._version.created.nanoseconds()
-    sr['committed'] = nanotime.now().nanoseconds()
-    sr['attributes'] = {}
+    data = {}
+    data['hash'] = hash
+    data['key'] = str(self.key)
+    data['type'] = self.__dstype__
+    data['parent'] = self._version.hash
+    data['created'] = self._version.created.nanoseconds()
+    data['committed'] = nanotime.now().nanoseconds()
+    data['attributes'] = {}
 
-    if sr['created'] == 0: # from blank version
-      sr['created'] = sr['committed']
+    if data['created'] == 0: # from blank version
+      data['created'] = data['committed']
 
     for attr_name, attr in self.attributes().iteritems():
-      sr['attributes'][attr_name] = serial.clean(attr.rawData(self))
+      if attr_name in cleanData:
+        data['attributes'][attr_name] = cleanData[attr_name]
+      else:
+        data['attributes'][attr_name] = serial.clean(attr.rawData(self))
 
-    self._version = Version(sr)
+    self._version = Version(serial.SerialRepresentation(data, trusted=True))
 
     self._isPersisted = True
     self._isDirty = False
 
-  def merge(self, other):
+  def merge(self, other, ancestor=None):
+    if isinstance(ancestor, Model):
+      ancestor = ancestor.version
+
     if isinstance(other, Version):
-      merge.merge(self, other)
+      merge.merge(self, other, ancestor)
     elif isinstance(other, Model):
-      merge.merge(self, other.version)
+      merge.merge(self, other.version, ancestor)
     else:
       raise TypeError('Expected instance of %s or %s' % \
         (Version, self.__class__))
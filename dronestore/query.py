@@ -1,4 +1,10 @@
 
+import json
+import heapq
+import base64
+import operator
+import itertools
+
 from model import Key, Version, Model
 from util import serial
 
@@ -28,13 +34,60 @@ def _object_getattr(obj, field):
   return value
 
 
+def _compiled_getattr(field, shape):
+  '''Returns a function equivalent to _object_getattr(obj, field) for objects
+  of type `shape`. Decides once per type what _object_getattr probes for each
+  object, so filters run fast over many objects of the same shape.
+  '''
+
+  # raw dicts (and their SerialRepresentations): an item, or an attribute.
+  if issubclass(shape, dict):
+    def getter(obj):
+      if field in obj:
+        return obj[field]
+      try:
+        return obj['attributes'][field]['value']
+      except (KeyError, TypeError):
+        return None
+    return getter
+
+  if issubclass(shape, serial.SerialRepresentation):
+    getter = _compiled_getattr(field, dict)
+    return lambda obj: getter(obj.data())
+
+  # Versions: a property (key, committed, ...), or an attribute value.
+  if issubclass(shape, Version) and not hasattr(shape, field):
+    def getter(obj):
+      try:
+        return obj.attributeValue(field)
+      except KeyError:
+        return None
+    return getter
+
+  # Models (and other objects): an attribute.
+  if hasattr(shape, field):
+    return operator.attrgetter(field)
+
+  return lambda obj: _object_getattr(obj, field)
+
+
+def _object_key(obj):
+  '''Returns the Key of `obj` (an object, or a key).'''
+  if isinstance(obj, Key):
+    return obj
+  key = _object_getattr(obj, 'key')
+  return key if isinstance(key, Key) else Key(key)
+
+
 
 
 def allinstances(cls, droneOrDatastore):
-  '''Returns the result of querying `droneOrDatastore` with type `cls`'''
+  '''Returns the result of querying `droneOrDatastore` with type `cls`. The
+  query is issued lazily, so `Model.all(drone).count()` only aggregates.
+  '''
   if not issubclass(cls, Model):
     raise TypeError('cls must derive from %s' % Model)
-  return droneOrDatastore.query(Query(cls))
+  return InstanceIterator(None, Query(cls), droneOrDatastore)
 
 Model.all = classmethod(allinstances)
 
@@ -48,12 +101,12 @@ class Filter(object):
   '''
 
   CONDITIONAL_OPERATORS = {
-    "<"  : lambda a, b: a < b,
-    "<=" : lambda a, b: a <= b,
-    "="  : lambda a, b: a == b,
-    "!=" : lambda a, b: a != b,
-    ">=" : lambda a, b: a >= b,
-    ">"  : lambda a, b: a > b
+    "<"  : operator.lt,
+    "<=" : operator.le,
+    "="  : operator.eq,
+    "!=" : operator.ne,
+    ">=" : operator.ge,
+    ">"  : operator.gt
   }
 
   def __init__(self, field, op, value):
@@ -68,12 +121,26 @@ class Filter(object):
     '''Returns whether this version passes this filter.
     This method aggressively tries to find the appropriate value.
     '''
+    return self.predicate(type(obj))(obj)
 
-    value = _object_getattr(obj, self.field)
+  def predicate(self, shape):
+    '''Returns a function that tells whether objects of type `shape` pass
+    this filter. The field lookup and value coercion are resolved here, once.
+    '''
+    getter = _compiled_getattr(self.field, shape)
+    op = self.CONDITIONAL_OPERATORS[self.op]
+    value = self.value
+
+    # string filter values compare to stringified values (e.g. keys).
+    if isinstance(value, str):
+      def passes(obj):
+        objValue = getter(obj)
+        if not isinstance(objValue, str):
+          objValue = str(objValue)
+        return op(objValue, value)
+      return passes
 
-    if isinstance(self.value, str) and not isinstance(value, str):
-      value = str(value)
-    return self.valuePasses(value)
+    return lambda obj: op(getter(obj), value)
 
   def valuePasses(self, value):
     '''Returns whether this value passes this filter'''
@@ -97,10 +164,38 @@ class Filter(object):
     return hash(repr(self))
 
 
+  @classmethod
+  def compile(cls, filters, shape):
+    '''Returns a function to filter items of type `shape` with `filters`'''
+    predicates = [f.predicate(shape) for f in filters]
+    if not predicates:
+      return lambda item: True
+    if len(predicates) == 1:
+      return predicates[0]
+
+    def passes(item):
+      for predicate in predicates:
+        if not predicate(item):
+          return False
+      return True
+    return passes
+
   @classmethod
   def metaFilter(cls, filters):
-    '''Returns a function to filter an item with given `filters`'''
-    return lambda item: all([f(item) for f in filters])
+    '''Returns a function to filter an item with given `filters`. The filters
+    are compiled once for each type of item seen (see `compile`).
+    '''
+    filters = list(filters)
+    compiled = {} # shape -> predicate
+
+    def passes(item):
+      shape = type(item)
+      try:
+        predicate = compiled[shape]
+      except KeyError:
+        predicate = compiled[shape] = cls.compile(filters, shape)
+      return predicate(item)
+    return passes
 
   @classmethod
   def filter(cls, filters, items):
@@ -111,6 +206,38 @@ class Filter(object):
 
 
 
+class _Reversed(object):
+  '''Wraps a value to sort in reverse, within an (ascending) sort key.'''
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __ne__(self, other):
+    return self.value != other.value
+
+  def __lt__(self, other):
+    return cmp(self.value, other.value) > 0
+
+  def __gt__(self, other):
+    return cmp(self.value, other.value) < 0
+
+  def __le__(self, other):
+    return cmp(self.value, other.value) >= 0
+
+  def __ge__(self, other):
+    return cmp(self.value, other.value) <= 0
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
+
+
+
+
+
 class Order(object):
   '''Represents an Order upon a specific field, and a direction.
   Orders are used on queries to define how they operate on objects
@@ -176,10 +303,177 @@ class Order(object):
 
     return cmpfn
 
+  @classmethod
+  def compile(cls, orders, shape):
+    '''Returns a sort key function for items of type `shape`: it returns the
+    tuple of the items' values for `orders`, descending ones reversed. The
+    field lookups are resolved here, once.
+    '''
+    getters = [_compiled_getattr(o.field, shape) for o in orders]
+    if len(orders) == 1 and orders[0].isAscending():
+      return getters[0]
+
+    if all(o.isAscending() for o in orders):
+      return lambda item: tuple([getter(item) for getter in getters])
+
+    def reversed(getter):
+      return lambda item: _Reversed(getter(item))
+
+    getters = [g if o.isAscending() else reversed(g) \
+      for o, g in zip(orders, getters)]
+    return lambda item: tuple([getter(item) for getter in getters])
+
+  @classmethod
+  def metaKey(cls, orders):
+    '''Returns a sort key function ordering items according to `orders`. It
+    is compiled once for each type of item seen (see `compile`), so sorts
+    compute each item's key once, instead of looking up values on every
+    comparison.
+    '''
+    orders = list(orders)
+    compiled = {} # shape -> key function
+
+    def key(item):
+      shape = type(item)
+      try:
+        keyfn = compiled[shape]
+      except KeyError:
+        keyfn = compiled[shape] = cls.compile(orders, shape)
+      return keyfn(item)
+    return key
+
   @classmethod
   def sorted(cls, items, orders):
     '''Returns the elements in `items` sorted according to `orders`'''
-    return sorted(items, cmp=cls.metaOrder(orders))
+    return sorted(items, key=cls.metaKey(orders))
+
+
+
+
+
+class Aggregate(object):
+  '''Represents an aggregate function over a field of the objects matching a
+  query: count (of objects, or of objects with a value), sum, min, max, avg.
+  Objects without a value (None) for the field are skipped.
+
+  Aggregates are named by their string, e.g. 'count', 'sum(age)'. They are
+  computed from partial aggregates (avg is sum / count), which can be combined
+  across sources, e.g. shards.
+  '''
+
+  OPERATORS = ['count', 'sum', 'min', 'max', 'avg']
+
+  def __init__(self, op, field=None):
+    if op not in self.OPERATORS:
+      raise ValueError('"%s" is not a valid Aggregate Operator' % op)
+    if field is None and op != 'count':
+      raise ValueError('"%s" aggregates need a field' % op)
+
+    self.op = op
+    self.field = field
+
+  @classmethod
+  def make(cls, aggregate):
+    '''Returns `aggregate`, an Aggregate, op (e.g. 'count') or (op, field).'''
+    if isinstance(aggregate, cls):
+      return aggregate
+    if isinstance(aggregate, basestring):
+      return cls(aggregate)
+    return cls(*aggregate)
+
+
+  def __str__(self):
+    if self.field is None:
+      return self.op
+    return '%s(%s)' % (self.op, self.field)
+
+  def __repr__(self):
+    return "Aggregate('%s', %s)" % (self.op, repr(self.field))
+
+
+  def __eq__(self, other):
+    return self.op == other.op and self.field == other.field
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash(repr(self))
+
+
+  def partials(self):
+    '''Returns the partial aggregates this aggregate is computed from.'''
+    if self.op == 'avg':
+      return [Aggregate('sum', self.field), Aggregate('count', self.field)]
+    return [self]
+
+  def initial(self):
+    '''Returns the value of this (partial) aggregate over no objects.'''
+    return 0 if self.op in ['count', 'sum'] else None
+
+  def combine(self, a, b):
+    '''Returns the value of this (partial) aggregate over the union of the
+    objects aggregated in `a` and `b`.
+    '''
+    if self.op in ['count', 'sum']:
+      return a + b
+    if a is None or b is None:
+      return b if a is None else a
+    return min(a, b) if self.op == 'min' else max(a, b)
+
+  def result(self, partials):
+    '''Returns the value of this aggregate, given a dict of the values of
+    (at least) its partial aggregates, by name.
+    '''
+    if self.op != 'avg':
+      return partials[str(self)]
+    total, count = [partials[str(p)] for p in self.partials()]
+    return float(total) / count if count else None
+
+  @classmethod
+  def expand(cls, aggregates):
+    '''Returns the (distinct) partial aggregates of `aggregates`.'''
+    partials = []
+    for aggregate in aggregates:
+      for partial in aggregate.partials():
+        if partial not in partials:
+          partials.append(partial)
+    return partials
+
+  @classmethod
+  def results(cls, aggregates, partials):
+    '''Returns a dict of the values of `aggregates` by name, given a dict of
+    the values of their partials, by name.
+    '''
+    return dict((str(a), a.result(partials)) for a in aggregates)
+
+  @classmethod
+  def gather(cls, aggregates, results, grouped=False):
+    '''Returns the values of `aggregates` over many sources, given each
+    source's `results` for their partials (dicts of values by name, or, if
+    `grouped`, dicts of those by group).
+    '''
+    aggregates = map(cls.make, aggregates)
+    partials = cls.expand(aggregates)
+
+    def combine(results):
+      values = {}
+      for partial in partials:
+        name = str(partial)
+        value = partial.initial()
+        for result in results:
+          value = partial.combine(value, result[name])
+        values[name] = value
+      return cls.results(aggregates, values)
+
+    if not grouped:
+      return combine(results)
+
+    groups = {}
+    for result in results:
+      for group, values in result.items():
+        groups.setdefault(group, []).append(values)
+    return dict((g, combine(r)) for g, r in groups.items())
 
 
 
@@ -191,16 +485,28 @@ class Query(object):
   Queries are used to retrieve versions and instances matching a set of criteria
   from Datastores and Drones. Query objects themselves are simply descriptions,
   the actual implementations are left up to the Datastores.
+
+  A `limit` of 0 means no limit. Keys-only queries (`keysonly`) select the
+  Keys of the objects, rather than the objects.
+
+  Ordered queries can be paged with cursors rather than offsets (keyset
+  pagination): `cursor(obj)` returns an opaque cursor after `obj`, the last
+  object of a page, and a query with that `start_cursor` selects the objects
+  after it. Datastores translate cursors to range filters, so deep pages cost
+  as much as the first. Cursors need a total order, so ties in the query's
+  orders are broken by key (see `totalOrders`).
   '''
 
   DEFAULT_LIMIT = 2000
 
-  def __init__(self, dstype, limit=None, offset=0, keysonly=False):
+  def __init__(self, dstype, limit=None, offset=0, keysonly=False,
+    start_cursor=None):
     self.type = dstype if isinstance(dstype, basestring) else dstype.__dstype__
 
     self.limit = int(limit) if limit is not None else self.DEFAULT_LIMIT
     self.offset = int(offset)
     self.keysonly = bool(keysonly)
+    self.start_cursor = start_cursor
 
     self.filters = []
     self.orders = []
@@ -217,20 +523,165 @@ class Query(object):
     '''Returns the representation of this query. Enables eval(repr(.)).'''
     return 'Query.from_dict(%s)' % self.dict()
 
-  def __call__(self, sequence):
+  def __call__(self, sequence, ordered=False):
     '''Naively apply this query on a sequence of objects.
-    Applying a query converts versions to instances, applies filters, sorts
-    by the appropriate orders, and returns a limited set.
-
-    WARNING: due to the need to order the results, this function operates on
-             entire entity sequences directly, not just iterators. That means
-             the entire result set will be in memory. Datastores with large
-             objects and large query results should translate the Query and
-             perform their own optimizations.
+    Applying a query applies filters, sorts by the appropriate orders, and
+    returns a limited set.
+
+    Queries without orders (or on a sequence already `ordered` as the query
+    orders, e.g. read from an index) are applied lazily: the result is an
+    iterator pulling objects from `sequence` only as needed, which stops once
+    the limit is reached. Memory use is constant, however large the scan.
+
+    WARNING: due to the need to order the results, ordered queries consume
+             the entire sequence, keeping up to offset + limit objects in
+             memory (see `page`). Datastores with large objects and large
+             query results should translate the Query and perform their own
+             optimizations.
+    '''
+    sequence = itertools.ifilter(self.filterFn, sequence)
+    if ordered or not self.orders:
+      return self.project(self.slice(sequence))
+    return self.project(self.page(sequence))
+
+  def project(self, results):
+    '''Returns `results` as keys (see `keysonly`), or as they are.'''
+    if not self.keysonly:
+      return results
+    if isinstance(results, list):
+      return map(_object_key, results)
+    return itertools.imap(_object_key, results)
+
+  def slice(self, sequence):
+    '''Returns an iterator over the objects of (ordered) `sequence` this
+    query selects: skipping `offset` objects, up to `limit`.
     '''
-    sequence = filter(self.filterFn, sequence)
-    sequence = sorted(sequence, cmp=self.orderFn)
-    return sequence[self.offset:self.limit]
+    stop = self.offset + self.limit if self.limit else None
+    return itertools.islice(sequence, self.offset, stop)
+
+  def page(self, sequence):
+    '''Returns the page of `sequence` (of objects passing the filters) that
+    this query selects: ordered, skipping `offset` objects, up to `limit`.
+
+    Limited queries only keep the first offset + limit objects, in a bounded
+    heap, so time is O(n log k) and memory O(k) for pages of k objects.
+    '''
+    if not self.orders:
+      return list(self.slice(sequence))
+
+    start = self.offset
+    stop = start + self.limit if self.limit else None
+
+    key = self.keyFn
+    if stop is None:
+      sequence = sorted(sequence, key=key)
+    else:
+      sequence = heapq.nsmallest(stop, sequence, key=key)
+    return sequence[start:]
+
+  def merge(self, sequences):
+    '''Returns an iterator over the page this query selects from `sequences`
+    of objects passing its filters, each ordered by the query's orders (e.g.
+    shard results, see `prefix`). Ordered sequences are merged lazily, with a
+    heap of their next objects, so the page is produced in O(k log n) for k
+    objects from n sequences.
+    '''
+    if not self.orders:
+      return self.project(self.slice(itertools.chain(*sequences)))
+
+    key = self.keyFn
+    def decorate(index, sequence):
+      for count, item in enumerate(sequence):
+        yield key(item), index, count, item
+
+    merged = heapq.merge(*[decorate(i, s) for i, s in enumerate(sequences)])
+    merged = itertools.imap(operator.itemgetter(3), merged)
+    return self.project(self.slice(merged))
+
+  def aggregate(self, sequence, aggregates, groupby=None, filtered=False):
+    '''Naively computes `aggregates` (see Aggregate.make) over the objects of
+    `sequence` passing this query's filters (or all of them, if `filtered`).
+    Objects are streamed: memory use only grows with the number of groups.
+
+    Returns a dict of the aggregate values by name, e.g. {'count' : 3}. With a
+    field to `groupby`, returns a dict of those, by (hashable) group value.
+
+    NOTE: aggregates cover all the objects matching the query's filters. The
+          query's orders, offset, limit and cursor do not apply.
+    '''
+    aggregates = map(Aggregate.make, aggregates)
+    partials = Aggregate.expand(aggregates)
+    fields = [groupby] + [p.field for p in partials]
+    counts = [p.op == 'count' and p.field is None for p in partials]
+    combines = [p.combine for p in partials]
+    initial = [p.initial() for p in partials]
+
+    passes = self.filterFn if not filtered else None
+    compiled = {} # shape -> getters
+    groups = {}
+
+    for item in sequence:
+      if passes is not None and not passes(item):
+        continue
+
+      shape = type(item)
+      try:
+        getters = compiled[shape]
+      except KeyError:
+        getters = compiled[shape] = [_compiled_getattr(f, shape) \
+          if f is not None else None for f in fields]
+
+      group = getters[0](item) if groupby is not None else None
+      state = groups.get(group)
+      if state is None:
+        state = groups[group] = list(initial)
+
+      for i, getter in enumerate(getters[1:]):
+        if counts[i]:
+          state[i] += 1
+          continue
+        value = getter(item)
+        if value is not None:
+          state[i] = combines[i](state[i], 1 if partials[i].op == 'count' \
+            else value)
+
+    def results(state):
+      return Aggregate.results(aggregates,
+        dict((str(p), v) for p, v in zip(partials, state)))
+
+    if groupby is not None:
+      return dict((g, results(state)) for g, state in groups.items())
+    return results(groups.get(None, initial))
+
+  def scan(self):
+    '''Returns a query for all the objects passing this query's filters, in
+    no order (e.g. to aggregate them).
+    '''
+    query = Query(self.type, limit=0)
+    query.filters = list(self.filters)
+    return query
+
+  def copy(self):
+    '''Returns a copy of this query.'''
+    query = Query(self.type, self.limit, self.offset, self.keysonly,
+      self.start_cursor)
+    query.filters = list(self.filters)
+    query.orders = list(self.orders)
+    return query
+
+  def prefix(self):
+    '''Returns a query for all the objects up to the end of this query's page
+    (offset 0, limit offset + limit). Merging the prefixes of many sources
+    (e.g. shards), and then taking this query's page, yields this page.
+    Ordered prefixes select whole objects (not keys), to merge them in order.
+    '''
+    query = self.copy()
+    query.offset = 0
+    if self.orders:
+      query.keysonly = False
+    if self.limit:
+      query.limit = self.offset + self.limit
+    return query
 
   def order(self, order):
     '''Adds an Order to this query.
@@ -243,10 +694,91 @@ class Query(object):
     self.orders.append(order)
     return self
 
+  def totalOrders(self):
+    '''Returns the query's orders, followed by an order on key (in the
+    direction of the last order) to break ties, if they do not end with one.
+    Queries without orders stay unordered.
+    '''
+    if not self.orders or self.orders[-1].field == 'key':
+      return list(self.orders)
+    return self.orders + [Order(self.orders[-1].op + 'key')]
+
   @property
   def orderFn(self):
     '''Returns a function that orders items with the query's orders'''
-    return Order.metaOrder(self.orders)
+    return Order.metaOrder(self.totalOrders())
+
+  @property
+  def keyFn(self):
+    '''Returns a sort key function ordering items with the query's orders'''
+    return Order.metaKey(self.totalOrders())
+
+
+  def cursor(self, obj):
+    '''Returns the cursor positioned after `obj`, a result of this query.
+    Use it as the `start_cursor` of the query for the next page.
+    '''
+    if not self.orders:
+      raise ValueError('cursors need ordered queries. Order by key.')
+    orders = self.totalOrders()
+    values = [_object_getattr(obj, o.field) for o in orders[:-1]]
+    values.append(str(_object_getattr(obj, 'key')))
+    return base64.urlsafe_b64encode(json.dumps(serial.clean(values)))
+
+  def cursorFilters(self):
+    '''Returns the range `start_cursor` selects, for datastores to translate.
+    It is a list of (equal, range) pairs, one per total order, of filter
+    triples (field, op, value): an object is after the cursor if, for any
+    pair, it passes the `equal` filters (on the previous orders) and `range`.
+    '''
+    if self.start_cursor is None:
+      return []
+    try:
+      values = json.loads(base64.urlsafe_b64decode(str(self.start_cursor)))
+    except (TypeError, ValueError):
+      raise ValueError('invalid cursor %r' % self.start_cursor)
+
+    orders = self.totalOrders()
+    if not orders or len(values) != len(orders):
+      raise ValueError('cursor %r does not match %s' % \
+        (self.start_cursor, self))
+
+    ranges = []
+    for i, order in enumerate(orders):
+      equal = [(o.field, '=', v) for o, v in zip(orders[:i], values[:i])]
+      op = '>' if order.isAscending() else '<'
+      ranges.append((equal, (order.field, op, values[i])))
+    return ranges
+
+  def cursorFn(self):
+    '''Returns a function that tells whether an item is after the cursor.'''
+    ranges = self.cursorFilters()
+    if not ranges:
+      return lambda item: True
+
+    orders = self.totalOrders()
+    values = [v for equal, (field, op, v) in ranges]
+    cmps = [1 if o.isAscending() else -1 for o in orders]
+    fields = [o.field for o in orders]
+    compiled = {} # shape -> getters
+
+    def after(item):
+      shape = type(item)
+      try:
+        getters = compiled[shape]
+      except KeyError:
+        getters = compiled[shape] = [_compiled_getattr(f, shape) \
+          for f in fields]
+
+      last = len(getters) - 1
+      for i, getter in enumerate(getters):
+        value = getter(item)
+        value = str(value) if i == last else serial.clean(value)
+        comparison = cmp(value, values[i]) * cmps[i]
+        if comparison:
+          return comparison > 0
+      return False # the object at the cursor.
+    return after
 
 
   def filter(self, *args):
@@ -264,8 +796,15 @@ class Query(object):
 
   @property
   def filterFn(self):
-    '''Returns a function that filters an item with the query's filters'''
-    return Filter.metaFilter(self.filters)
+    '''Returns a function that filters an item with the query's filters (and
+    its start_cursor, if any).
+    '''
+    passes = Filter.metaFilter(self.filters)
+    if self.start_cursor is None:
+      return passes
+
+    after = self.cursorFn()
+    return lambda item: passes(item) and after(item)
 
 
   def __cmp__(self, other):
@@ -290,6 +829,8 @@ class Query(object):
       d['order'] = [str(o) for o in self.orders]
     if self.keysonly:
       d['keysonly'] = self.keysonly
+    if self.start_cursor is not None:
+      d['cursor'] = self.start_cursor
 
     return serial.clean(d)
 
@@ -311,6 +852,9 @@ class Query(object):
 
       elif key in ['limit', 'offset', 'keysonly']:
         setattr(query, key, value)
+
+      elif key == 'cursor':
+        query.start_cursor = value
     return query
 
 
@@ -320,11 +864,18 @@ class Query(object):
 class InstanceIterator(object):
   '''Wraps an iterator to convert Version SerialRepresentations to instances.
   Used mainly around queries to ensure iterating over the result iterator will
-  return instances, not raw version data.
+  return instances, not raw version data. Keys (of keys-only queries) are
+  returned as they are.
   '''
 
-  def __init__(self, iterable):
-    self.iter = iter(iterable)
+  def __init__(self, iterable, query=None, source=None):
+    '''Wraps `iterable`, the result of `query` on `source` (a drone or
+    datastore), if given. If `iterable` is None, `source` is queried lazily.
+    '''
+    self.iter = iter(iterable) if iterable is not None else None
+    self.query = query
+    self.source = source
+    self.returned = 0 # objects returned so far
 
   def __iter__(self):
     return self
@@ -332,10 +883,13 @@ class InstanceIterator(object):
   def next(self):
     '''Returns an instance of the version represented by the next object.'''
     if self.iter is None:
-      raise StopIteration
+      if self.source is None:
+        raise StopIteration
+      self.iter = iter(self.source.query(self.query))
 
     # if it returns none, return None as well. None is not necessarily the end.
     next = self.iter.next()
+    self.returned += 1
     if next is None:
       return None
 
@@ -354,4 +908,25 @@ class InstanceIterator(object):
     # return whatever it is we have!
     return next
 
-
+  def count(self):
+    '''Returns the number of objects left in this iterator: those the query
+    selects (after its start_cursor, skipping its offset, up to its limit)
+    less those already returned. They are counted by the source's aggregate
+    (once per cursor range). Without a source, counts (consuming) them.
+    '''
+    if self.source is None or not hasattr(self.source, 'aggregate'):
+      return sum(1 for item in self)
+
+    queries = []
+    for equal, range in self.query.cursorFilters():
+      query = self.query.scan()
+      for filter in equal + [range]:
+        query.filter(*filter)
+      queries.append(query)
+
+    queries = queries or [self.query]
+    total = sum(self.source.aggregate(q, ['count'])['count'] for q in queries)
+    total = max(0, total - self.query.offset)
+    if self.query.limit:
+      total = min(total, self.query.limit)
+    return max(0, total - self.returned)
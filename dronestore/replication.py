@@ -0,0 +1,193 @@
+
+import json
+import socket
+import threading
+import SocketServer
+
+from model import Key, Version
+from drone import Drone
+from datastore import Datastore, DictDatastore
+from util.serial import SerialRepresentation
+
+
+class Transport(object):
+  '''A Transport carries versions from a source drone to a Replicator.'''
+
+  def fetch(self, type, watermark, limit):
+    '''Returns up to `limit` versions of `type` committed after `watermark`,
+    as version data, in (committed, key) order. See Drone.committedSince.
+    '''
+    raise NotImplementedError
+
+  def close(self):
+    '''Releases any resources held by this transport.'''
+    pass
+
+
+
+class LocalTransport(Transport):
+  '''Fetches versions from a drone in this process.'''
+
+  def __init__(self, drone):
+    if not isinstance(drone, Drone):
+      raise ValueError('drone must be an instance of %s' % Drone)
+    self.drone = drone
+
+  def fetch(self, type, watermark, limit):
+    versions = self.drone.committedSince(type, watermark, limit)
+    return [v.serialRepresentation.data() for v in versions]
+
+
+
+class SocketTransport(Transport):
+  '''Fetches versions from a drone served by a ReplicationServer.
+
+  The protocol is line-delimited json over one TCP connection: each request is
+  { 'type' : ..., 'watermark' : ..., 'limit' : ... } and each response is
+  { 'versions' : [...] } (or { 'error' : ... }).
+  '''
+
+  def __init__(self, address, timeout=None):
+    '''Connects to the ReplicationServer at `address`, a (host, port) pair.'''
+    self.address = address
+    self._socket = socket.create_connection(address, timeout)
+    self._file = self._socket.makefile('rwb')
+    self._lock = threading.Lock()
+
+  def fetch(self, type, watermark, limit):
+    request = { 'type' : type, 'watermark' : watermark, 'limit' : limit }
+    with self._lock:
+      self._file.write(json.dumps(request) + '\n')
+      self._file.flush()
+      line = self._file.readline()
+
+    if not line:
+      raise IOError('connection to %s:%d closed' % self.address)
+    response = json.loads(line)
+    if 'error' in response:
+      raise IOError('replication server error: %s' % response['error'])
+    return response['versions']
+
+  def close(self):
+    self._file.close()
+    self._socket.close()
+
+
+
+class _ReplicationHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    drone = self.server.drone
+    for line in iter(self.rfile.readline, ''):
+      try:
+        request = json.loads(line)
+        versions = drone.committedSince(request['type'],
+          request['watermark'], request['limit'])
+        response = { 'versions' : \
+          [v.serialRepresentation.data() for v in versions] }
+      except Exception, e:
+        response = { 'error' : '%s: %s' % (e.__class__.__name__, e) }
+
+      self.wfile.write(json.dumps(response) + '\n')
+      self.wfile.flush()
+
+
+class ReplicationServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  '''Serves the versions of `drone` to SocketTransports, from a thread per
+  connection. Use `serve_forever` (e.g. in a thread), and `shutdown`.
+  '''
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, drone, address=('localhost', 0)):
+    '''Binds to `address` (by default, any free port; see server_address).'''
+    if not isinstance(drone, Drone):
+      raise ValueError('drone must be an instance of %s' % Drone)
+    self.drone = drone
+    SocketServer.TCPServer.__init__(self, address, _ReplicationHandler)
+
+
+
+class Replicator(object):
+  '''A Replicator keeps a target drone in sync with a source drone.
+
+  It fetches (through a Transport) the versions committed at the source after
+  a watermark -- the (committed, key) of the last version replicated -- and
+  merges them into the target in batches (Drone.merge_many). After each batch,
+  the watermark is checkpointed in the `checkpoints` datastore, so replication
+  resumes where it left off, even in another process.
+
+  Merging is idempotent, so replaying a batch (e.g. after a crash between the
+  merge and the checkpoint) is harmless.
+
+  NOTE: deletions are not replicated. Use a ChangeFeed to follow them.
+  '''
+
+  DEFAULT_BATCHSIZE = 100
+
+  def __init__(self, name, transport, target, types, checkpoints=None,
+    batchsize=DEFAULT_BATCHSIZE):
+    '''Initializes the replicator `name` of `types` (model classes or type
+    names) from `transport` into drone `target`.
+    '''
+    if not isinstance(transport, Transport):
+      raise ValueError('transport must be an instance of %s' % Transport)
+    if not isinstance(target, Drone):
+      raise ValueError('target must be an instance of %s' % Drone)
+    if checkpoints is None:
+      checkpoints = DictDatastore()
+    if not isinstance(checkpoints, Datastore):
+      raise ValueError('checkpoints must be an instance of %s' % Datastore)
+    if batchsize < 1:
+      raise ValueError('batchsize must be at least 1')
+
+    self.name = name
+    self.transport = transport
+    self.target = target
+    self.types = [t if isinstance(t, basestring) else t.__dstype__ \
+      for t in types]
+    self.checkpoints = checkpoints
+    self.batchsize = batchsize
+
+  def _checkpointKey(self, type):
+    return Key('/ReplicationCheckpoint/%s:%s' % (self.name, type))
+
+  def watermark(self, type):
+    '''Returns the (committed, key) of the last replicated version of `type`,
+    or None if none has been replicated.
+    '''
+    checkpoint = self.checkpoints.get(self._checkpointKey(type))
+    if checkpoint is None:
+      return None
+    return (checkpoint['committed'], checkpoint['key'])
+
+  def replicateBatch(self, type):
+    '''Replicates one batch of versions of `type`. Returns the number of
+    versions replicated (0 when the target has caught up).
+    '''
+    datas = self.transport.fetch(type, self.watermark(type), self.batchsize)
+    if not datas:
+      return 0
+
+    # version data is read back from the source datastore: already clean.
+    versions = [Version(SerialRepresentation(d, trusted=True)) for d in datas]
+    self.target.merge_many(versions)
+
+    last = datas[-1]
+    checkpoint = { 'committed' : last['committed'], 'key' : last['key'] }
+    self.checkpoints.put(self._checkpointKey(type), checkpoint)
+    return len(versions)
+
+  def replicate(self):
+    '''Replicates all versions committed since the watermarks, until caught
+    up. Returns the number of versions replicated.
+    '''
+    total = 0
+    for type in self.types:
+      while True:
+        count = self.replicateBatch(type)
+        total += count
+        if count == 0:
+          break
+    return total
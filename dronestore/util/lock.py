@@ -0,0 +1,49 @@
+
+import threading
+import contextlib
+
+from . import fasthash
+
+
+class StripedLock(object):
+  '''A StripedLock guards a large (unbounded) set of keys with a fixed number
+  of locks, or stripes. Each key maps to one stripe, by hash. Operations on the
+  same key serialize, while operations on different keys mostly proceed in
+  parallel (unless their keys happen to share a stripe).
+
+  Stripes are reentrant, so a thread holding a key's lock may lock it again.
+  '''
+
+  DEFAULT_STRIPES = 64
+
+  def __init__(self, stripes=DEFAULT_STRIPES):
+    if stripes < 1:
+      raise ValueError('stripes must be at least 1')
+    self._locks = [threading.RLock() for i in range(0, stripes)]
+
+  def __len__(self):
+    return len(self._locks)
+
+  def stripe(self, key):
+    '''Returns the index of the stripe guarding `key`.'''
+    return fasthash.hash(key) % len(self._locks)
+
+  def lock(self, key):
+    '''Returns the lock guarding `key`. Use it in a with statement.'''
+    return self._locks[self.stripe(key)]
+
+  @contextlib.contextmanager
+  def locks(self, keys):
+    '''Context manager holding the locks guarding all `keys`. Stripes are
+    always acquired in the same order, so concurrent callers cannot deadlock.
+    '''
+    stripes = sorted(set(map(self.stripe, keys)))
+    acquired = []
+    try:
+      for stripe in stripes:
+        self._locks[stripe].acquire()
+        acquired.append(stripe)
+      yield
+    finally:
+      for stripe in reversed(acquired):
+        self._locks[stripe].release()
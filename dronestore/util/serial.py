@@ -43,10 +43,20 @@ def clean(value):
 
 class SerialRepresentation(object):
 
-  def __init__(self, data=None):
+  def __init__(self, data=None, trusted=False):
+    '''Initializes the representation of `data`. Unless `trusted`, data is
+    cleaned first. Trust only data that is already clean (e.g. read back from
+    a datastore, or assembled from clean parts), as cleaning copies it all.
+    Trusted data is not copied: it must not be mutated (models copy the
+    attribute values they load from versions).
+    '''
     # internal representation is a dict.
     # consider moving to bson document object (once this is made proper)
-    self._data = clean(data) if data else {}
+    if not data:
+      data = {}
+    elif not trusted:
+      data = clean(data)
+    self._data = data
     self._dirty = True
     self._json = None
     self._bson = None
@@ -0,0 +1,151 @@
+
+import time
+import threading
+
+
+class Histogram(object):
+  '''A Histogram records the distribution of non-negative integer values
+  (e.g. latencies in microseconds) in constant space and time per value.
+
+  Like an HDR histogram, buckets are log-linear: values below 2 * `subbuckets`
+  are counted exactly, and each power of two above is split into `subbuckets`
+  equal buckets. Percentiles are thus within 1 / `subbuckets` of the truth.
+  '''
+
+  DEFAULT_SUBBUCKETS = 32
+  PERCENTILES = (50, 90, 99, 99.9)
+
+  def __init__(self, subbuckets=DEFAULT_SUBBUCKETS):
+    '''Initializes the histogram. `subbuckets` must be a power of two.'''
+    if subbuckets < 1 or subbuckets & (subbuckets - 1):
+      raise ValueError('subbuckets must be a power of two')
+
+    self._subbuckets = subbuckets
+    self._bits = subbuckets.bit_length() # bits of values counted exactly.
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    '''Forgets all recorded values.'''
+    with self._lock:
+      self._counts = {} # bucket -> count
+      self.count = 0
+      self.total = 0
+      self.min = None
+      self.max = None
+
+  def _bucket(self, value):
+    shift = value.bit_length() - self._bits
+    if shift <= 0:
+      return value
+    return shift * self._subbuckets + (value >> shift)
+
+  def _highest(self, bucket):
+    '''Returns the highest value counted in `bucket`.'''
+    shift = max(0, bucket // self._subbuckets - 1)
+    low = (bucket - shift * self._subbuckets) << shift
+    return low + (1 << shift) - 1
+
+  def record(self, value):
+    '''Records one occurrence of `value`.'''
+    value = int(value)
+    if value < 0:
+      raise ValueError('cannot record negative values')
+
+    bucket = self._bucket(value)
+    with self._lock:
+      self._counts[bucket] = self._counts.get(bucket, 0) + 1
+      self.count += 1
+      self.total += value
+      if self.min is None or value < self.min:
+        self.min = value
+      if self.max is None or value > self.max:
+        self.max = value
+
+  def mean(self):
+    return float(self.total) / self.count if self.count else None
+
+  def percentile(self, percent):
+    '''Returns the value below which `percent` of the recorded values fall.'''
+    with self._lock:
+      if not self.count:
+        return None
+
+      rank = max(1, int(round(self.count * percent / 100.0)))
+      seen = 0
+      for bucket in sorted(self._counts):
+        seen += self._counts[bucket]
+        if seen >= rank:
+          return min(self._highest(bucket), self.max)
+
+  def snapshot(self):
+    '''Returns a dict describing the recorded values.'''
+    snapshot = { 'count' : self.count, 'min' : self.min, 'max' : self.max,
+      'mean' : self.mean() }
+    for percent in self.PERCENTILES:
+      snapshot['p%s' % percent] = self.percentile(percent)
+    return snapshot
+
+
+
+class _Timer(object):
+  '''Context manager recording the time spent in its block.'''
+  __slots__ = ('histogram', 'start')
+
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc_info):
+    self.histogram.record((time.time() - self.start) * 1000000)
+
+
+
+class Stats(object):
+  '''Stats keeps a named set of latency histograms (in microseconds), and
+  derives throughput from their counts:
+
+    with stats.timer('get'):
+      ...
+
+    stats.snapshot()['timers']['get']['p99']
+  '''
+
+  def __init__(self, subbuckets=Histogram.DEFAULT_SUBBUCKETS):
+    self._subbuckets = subbuckets
+    self._histograms = {}
+    self._lock = threading.Lock()
+    self._started = time.time()
+
+  def histogram(self, name):
+    '''Returns the histogram named `name`, creating it if needed.'''
+    histogram = self._histograms.get(name)
+    if histogram is None:
+      with self._lock:
+        histogram = self._histograms.setdefault(name,
+          Histogram(self._subbuckets))
+    return histogram
+
+  def timer(self, name):
+    '''Returns a context manager recording the time its block takes.'''
+    return _Timer(self.histogram(name))
+
+  def reset(self):
+    '''Forgets all recorded values.'''
+    with self._lock:
+      for histogram in self._histograms.values():
+        histogram.reset()
+      self._started = time.time()
+
+  def snapshot(self):
+    '''Returns a dict with the elapsed seconds since the stats were (re)set,
+    and a snapshot of each histogram, with its `rate` per second.
+    '''
+    elapsed = time.time() - self._started
+    timers = {}
+    for name, histogram in self._histograms.items():
+      timers[name] = histogram.snapshot()
+      timers[name]['rate'] = timers[name]['count'] / elapsed if elapsed else 0
+    return { 'elapsed' : elapsed, 'timers' : timers }
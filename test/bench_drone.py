@@ -0,0 +1,140 @@
+
+'''Drone benchmarks. Not part of the test suite; run directly:
+
+    python test/bench_drone.py
+'''
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dronestore import Drone, ThreadSafeDrone, Key, Query
+from dronestore.datastore import DictDatastore, ShimDatastore
+from dronestore.replication import LocalTransport, SocketTransport
+from dronestore.replication import ReplicationServer, Replicator
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_merge import PersonM
+
+
+class LatentDatastore(ShimDatastore):
+  '''Simulates a network-backed datastore, sleeping `latency` seconds on I/O.'''
+
+  def __init__(self, datastore, latency=0.001):
+    super(LatentDatastore, self).__init__(datastore)
+    self.latency = latency
+
+  def get(self, key):
+    time.sleep(self.latency)
+    return super(LatentDatastore, self).get(key)
+
+  def put(self, key, value):
+    time.sleep(self.latency)
+    super(LatentDatastore, self).put(key, value)
+
+
+class GlobalLockDrone(Drone):
+  '''The workaround: a single lock around every merge.'''
+
+  def __init__(self, *args, **kwargs):
+    super(GlobalLockDrone, self).__init__(*args, **kwargs)
+    self._lock = threading.Lock()
+
+  def merge(self, newVersionOrEntity):
+    with self._lock:
+      return super(GlobalLockDrone, self).merge(newVersionOrEntity)
+
+
+def timed(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+
+def bench_merge_throughput(num_threads=16, num_keys=64, merges=50):
+  '''Merges per second with concurrent threads, over distinct keys.'''
+  print 'merge throughput (%d threads, %d keys, %d merges per thread):' % \
+    (num_threads, num_keys, merges)
+
+  for cls in [GlobalLockDrone, ThreadSafeDrone]:
+    drone = cls('/Bench', LatentDatastore(DictDatastore()))
+
+    def work(index):
+      for i in range(0, merges):
+        p = PersonM('p%d' % ((index * merges + i) % num_keys))
+        p.first = 'thread%d' % index
+        p.commit()
+        drone.merge(p)
+
+    def run():
+      threads = [threading.Thread(target=work, args=(i,)) \
+        for i in range(0, num_threads)]
+      map(lambda t: t.start(), threads)
+      map(lambda t: t.join(), threads)
+
+    elapsed = timed(run)
+    total = num_threads * merges
+    print '  %-16s %8.1f merges/s' % (cls.__name__, total / elapsed)
+
+
+def bench_replication_catchup(num_keys=5000, changed=50, batchsize=500):
+  '''Time for a replica to catch up: from scratch, and after `changed`
+  versions change at the source. Compares replicating since a watermark with
+  re-copying everything.
+  '''
+  print 'replication catch-up (%d keys, %d changed, batches of %d):' % \
+    (num_keys, changed, batchsize)
+
+  source = Drone('/Source', DictDatastore())
+  people = []
+  for i in range(0, num_keys):
+    p = PersonM('p%d' % i)
+    p.age = i
+    p.commit()
+    people.append(p)
+  source.put_many(people)
+
+  def change():
+    for p in people[:changed]:
+      p.age += 1
+      p.commit()
+    source.put_many(people[:changed])
+
+  def recopy(target):
+    query = Query(PersonM, limit=0)
+    return lambda: target.merge_many(list(source.query(query)))
+
+  target = Drone('/Target', DictDatastore())
+  full = timed(recopy(target))
+  change()
+  print '  %-16s %8.3fs initial %8.3fs catch-up' % \
+    ('full copy', full, timed(recopy(target)))
+
+  server = ReplicationServer(source)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  transports = [('local', LocalTransport(source)),
+    ('socket', SocketTransport(server.server_address))]
+  for name, transport in transports:
+    target = Drone('/Target', DictDatastore())
+    replicator = Replicator(name, transport, target, [PersonM],
+      batchsize=batchsize)
+    initial = timed(replicator.replicate)
+    change()
+    catchup = timed(replicator.replicate)
+    print '  %-16s %8.3fs initial %8.3fs catch-up' % \
+      (name + ' replicator', initial, catchup)
+    transport.close()
+
+  server.shutdown()
+  server.server_close()
+
+
+if __name__ == '__main__':
+  bench_merge_throughput()
+  bench_replication_catchup()
@@ -0,0 +1,89 @@
+'''Query benchmarks. Not part of the test suite; run directly:
+
+    python test/bench_query.py
+'''
+
+import os
+import sys
+import time
+import random
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dronestore import Key, Query
+from dronestore.datastore import DictDatastore
+
+
+def timed(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+
+def bench_parallel_scan(num_objects=400000, repeat=3):
+  '''Scan time of a filtered top-k query, by number of scanning processes.'''
+  print 'parallel scan (%d objects, %d cores):' % \
+    (num_objects, multiprocessing.cpu_count())
+
+  store = DictDatastore()
+  for i in range(0, num_objects):
+    key = Key('/Item/%d' % i)
+    store.put(key, { 'key' : str(key), 'attributes' : {
+      'age' : { 'value' : random.randint(0, 100) },
+      'name' : { 'value' : 'name%d' % random.randint(0, 1000) },
+      'score' : { 'value' : random.random() } } })
+
+  # string filters stringify each value: comparatively expensive.
+  query = Query('Item', limit=100).order('-score')
+  query.filter('age', '>=', 20).filter('age', '<', 80)
+  query.filter('name', '>', 'name5')
+
+  baseline = None
+  counts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+  for processes in counts:
+    store.processes = processes
+    elapsed = min(timed(lambda: list(store.query(query))) \
+      for i in range(0, repeat))
+    baseline = baseline or elapsed
+    print '  %2d processes: %7.3fs  (%.2fx)' % \
+      (processes, elapsed, baseline / elapsed)
+
+
+def bench_columnar(num_objects=400000, repeat=3):
+  '''Query time of filtered (and ordered) queries, by datastore.'''
+  from dronestore.datastore import columnar
+  print 'columnar (%d objects, numpy: %s):' % \
+    (num_objects, columnar.numpy is not None)
+
+  stores = [('dict', DictDatastore()),
+    ('columnar', columnar.ColumnarDatastore())]
+  for i in range(0, num_objects):
+    key = Key('/Item/%d' % i)
+    value = { 'key' : str(key), 'attributes' : {
+      'age' : { 'value' : random.randint(0, 100) },
+      'name' : { 'value' : 'name%d' % random.randint(0, 1000) },
+      'score' : { 'value' : random.random() } } }
+    for name, store in stores:
+      store.put(key, value)
+
+  queries = [('filter', Query('Item', limit=0).filter('age', '>=', 20)
+      .filter('age', '<', 80).filter('name', '>', 'name5')),
+    ('top-k', Query('Item', limit=100).filter('age', '>=', 20).order('-score')),
+    ('sort', Query('Item', limit=0).filter('age', '<', 50).order('name'))]
+
+  for name, store in stores:
+    list(store.query(queries[0][1])) # builds the columns.
+
+  for qname, query in queries:
+    times = []
+    for name, store in stores:
+      times.append(min(timed(lambda: list(store.query(query))) \
+        for i in range(0, repeat)))
+    print '  %-7s dict: %7.3fs  columnar: %7.3fs  (%.1fx)' % \
+      (qname, times[0], times[1], times[0] / times[1])
+
+
+if __name__ == '__main__':
+  bench_parallel_scan()
+  bench_columnar()
@@ -0,0 +1,139 @@
+
+import unittest
+
+from dronestore import Drone, Key, Version, AncestryIndex
+from dronestore.datastore import DictDatastore
+
+from test_merge import PersonM
+
+
+class TestAncestryIndex(unittest.TestCase):
+
+  def test_common_ancestor(self):
+    index = AncestryIndex()
+
+    base = PersonM('A')
+    base.commit()
+    index.add(base.version)
+
+    a1 = PersonM(base.version)
+    a1.first = 'One'
+    a1.commit()
+    index.add(a1.version)
+
+    a2 = PersonM(base.version)
+    a2.last = 'Two'
+    a2.commit()
+    index.add(a2.version)
+
+    key = base.key
+    self.assertTrue(index.contains(key, a1.version.hash))
+    self.assertEqual(index.version(key, a2.version.hash), a2.version)
+    self.assertEqual(index.parents(key, base.version.hash), ())
+    self.assertEqual(index.parents(key, a1.version.hash), (base.version.hash,))
+
+    self.assertEqual(index.commonAncestor(key, a1.version.hash,
+      a2.version.hash), base.version)
+    self.assertEqual(index.commonAncestor(key, a1.version.hash,
+      base.version.hash), base.version)
+    self.assertEqual(index.commonAncestor(key, a1.version.hash,
+      a1.version.hash), a1.version)
+    self.assertEqual(index.commonAncestor(Key('/PersonM/B'),
+      a1.version.hash, a2.version.hash), None)
+
+    # merged versions descend from both sides.
+    a1.merge(a2)
+    index.add(a1.version, parents=[a1.version.parent, a2.version.hash])
+    self.assertEqual(index.commonAncestor(key, a1.version.hash,
+      a2.version.hash), a2.version)
+
+    index.remove(key)
+    self.assertEqual(len(index), 0)
+    self.assertFalse(index.contains(key, a1.version.hash))
+
+  def test_bounded(self):
+    index = AncestryIndex(size=5)
+
+    p = PersonM('A')
+    p.commit()
+    first = p.version
+    index.add(first)
+    for i in range(0, 10):
+      p.age = i + 1
+      p.commit()
+      index.add(p.version)
+
+    self.assertEqual(len(index), 5)
+    self.assertFalse(index.contains(p.key, first.hash))
+    self.assertEqual(len(list(index.ancestors(p.key, p.version.hash))), 5)
+    self.assertEqual(index.commonAncestor(p.key, first.hash,
+      p.version.hash), None)
+
+    self.assertRaises(ValueError, AncestryIndex, 0)
+    self.assertRaises(TypeError, index.add, p)
+
+
+class TestThreeWayMerge(unittest.TestCase):
+
+  def test_model_merge(self):
+    base = PersonM('A')
+    base.gender = 'Male'
+    base.commit()
+
+    remote = PersonM(base.version)
+    remote.gender = 'Female'
+    remote.commit()
+
+    local = PersonM(base.version)
+    local.first = 'Local'
+    local.commit()
+
+    # two-way: local was committed later, so the remote change is lost.
+    twoway = PersonM(local.version)
+    twoway.merge(remote)
+    self.assertEqual(twoway.gender, 'Male')
+
+    # three-way: only remote changed gender, so it is taken.
+    threeway = PersonM(local.version)
+    threeway.merge(remote, base)
+    self.assertEqual(threeway.gender, 'Female')
+    self.assertEqual(threeway.first, 'Local')
+
+    # merging an ancestor changes nothing.
+    hash = local.version.hash
+    local.merge(base, base)
+    self.assertEqual(local.version.hash, hash)
+
+  def test_drone_merge(self):
+    store = DictDatastore()
+    drone = Drone('/DroneA', store, ancestry=AncestryIndex())
+
+    base = PersonM('A')
+    base.gender = 'Male'
+    base.commit()
+    drone.put(base)
+
+    remote = PersonM(base.version)
+    remote.gender = 'Female'
+    remote.commit()
+
+    local = drone.get(base.key)
+    local.first = 'Local'
+    local.commit()
+    drone.put(local)
+
+    merged = drone.merge(remote)
+    self.assertEqual(merged.gender, 'Female')
+    self.assertEqual(merged.first, 'Local')
+    self.assertEqual(drone.get(base.key), merged)
+
+    # merging the same remote again changes nothing.
+    self.assertEqual(drone.merge(remote).version, merged.version)
+
+    drone.delete(base.key)
+    self.assertEqual(drone.get(base.key), None)
+    self.assertRaises(ValueError, Drone, '/DroneB', store, ancestry={})
+
+
+if __name__ == '__main__':
+  unittest.main()
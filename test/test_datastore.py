@@ -91,6 +91,26 @@ class TestDatastore(unittest.TestCase):
 
     checkLength(0)
 
+    # batched operations, on half the elems (and half missing keys).
+    keys = [pkey.child(value) for value in range(0, numelems)]
+    half = numelems / 2
+    items = [(key, value) for value, key in enumerate(keys[:half])]
+    for sn in stores:
+      self.assertEqual(sn.contains_many(keys), [False] * numelems)
+      self.assertEqual(sn.get_many(keys), [None] * numelems)
+
+      sn.put_many(items)
+      self.assertEqual(sn.contains_many(keys),
+        [True] * half + [False] * (numelems - half))
+      self.assertEqual(sn.get_many(keys),
+        range(0, half) + [None] * (numelems - half))
+      self.assertEqual(sn.get_many([]), [])
+
+      sn.delete_many(keys)
+      self.assertEqual(sn.contains_many(keys), [False] * numelems)
+
+    checkLength(0)
+
   def test_tiered(self):
 
     s1 = datastore.DictDatastore()
@@ -152,6 +172,16 @@ class TestDatastore(unittest.TestCase):
     self.assertFalse(ts.contains(k2))
     self.assertFalse(ts.contains(k3))
 
+    # batched gets fill the upper stores too.
+    s2.put(k2, '2')
+    s3.put(k3, '3')
+    self.assertEqual(ts.get_many([k1, k2, k3]), [None, '2', '3'])
+    self.assertEqual(s1.get_many([k1, k2, k3]), [None, '2', '3'])
+    self.assertEqual(s2.get_many([k1, k2, k3]), [None, '2', '3'])
+    self.assertEqual(ts.contains_many([k1, k2, k3]), [False, True, True])
+    ts.delete_many([k2, k3])
+    self.assertEqual(ts.contains_many([k1, k2, k3]), [False, False, False])
+
     self.test_simple([ts])
 
   def test_sharded(self, numelems=1000):
@@ -310,6 +340,640 @@ class TestDatastore(unittest.TestCase):
 
     self.test_simple(lrus)
 
+    # reads while consuming a query's results do not reorder them.
+    for value in range(0, 5):
+      lru1.put(Key('/LRU/%d' % value), value)
+    for query in [Query('LRU', limit=0), Query('LRU', limit=0, keysonly=True)]:
+      results = []
+      for result in lru1.query(query):
+        results.append(result)
+        lru1.get(Key('/LRU/%d' % (len(results) % 5)))
+      self.assertEqual(len(set(results)), 5)
+
+
+  def test_content(self):
+
+    from dronestore.datastore import content
+
+    s1 = datastore.DictDatastore()
+    blobs = datastore.DictDatastore()
+    c1 = content.ContentAddressedDatastore(s1)
+    c2 = content.ContentAddressedDatastore(datastore.DictDatastore(), blobs)
+    self.test_simple([c1, c2])
+
+    people = []
+    for i in range(0, 10):
+      p = Person('person%d' % i)
+      p.first = 'Shared'
+      p.age = i
+      p.commit()
+      people.append(p)
+      c2.put(p.key, p.version.serialRepresentation.data())
+
+    # default (and equal) attribute values are stored once.
+    self.assertEqual(len(blobs), 10 + 4)
+    for p in people:
+      self.assertEqual(c2.get(p.key), p.version.serialRepresentation.data())
+
+    result = list(c2.query(Query(Person).filter('age', '>=', 5)))
+    self.assertEqual(len(result), 5)
+    self.assertTrue(all([r['attributes']['first']['value'] == 'Shared' \
+      for r in result]))
+
+    # aggregates are of the resolved objects, not the child's records.
+    query = Query(Person).filter('age', '>=', 7)
+    self.assertEqual(c2.aggregate(query, ['count', ('sum', 'age')]),
+      {'count' : 3, 'sum(age)' : 24})
+    self.assertEqual(c2.aggregate(Query(Person), ['count']), {'count' : 10})
+
+    for p in people[:5]:
+      p.first = 'Changed'
+      p.commit()
+      c2.put(p.key, p.version.serialRepresentation.data())
+    self.assertEqual(len(blobs), 10 + 5)
+
+    for p in people:
+      c2.delete(p.key)
+    self.assertEqual(len(blobs), 0)
+
+  def test_async(self):
+
+    from dronestore.datastore import asynchronous
+
+    stores = [datastore.DictDatastore() for i in range(0, 3)]
+    threaded = [asynchronous.ThreadedDatastore(s, threads=4) for s in stores]
+    tiered = asynchronous.AsyncTieredDatastore(threaded)
+    sharded = asynchronous.AsyncShardedDatastore(threaded)
+
+    keys = [Key('/Async/%d' % i) for i in range(0, 100)]
+    for store in [tiered, sharded]:
+      results = [store.put(key, i) for i, key in enumerate(keys)]
+      map(lambda r: r.get(), results)
+
+      results = [store.get(key) for key in keys]
+      self.assertEqual([r.get() for r in results], range(0, 100))
+      self.assertTrue(all([store.contains(key).get() for key in keys]))
+
+      result = store.query(Query('Async', limit=0))
+      self.assertEqual(sorted(result.get()), range(0, 100))
+
+      map(lambda r: r.get(), [store.delete(key) for key in keys])
+      self.assertFalse(any([store.contains(key).get() for key in keys]))
+      self.assertEqual(store.get(keys[0]).get(), None)
+
+    # tiered gets consult lower stores only on misses, and fill upper ones.
+    stores[2].put(keys[0], 'low')
+    self.assertEqual(tiered.get(keys[0]).get(), 'low')
+    self.assertEqual(stores[0].get(keys[0]), 'low')
+
+    self.assertRaises(TypeError, asynchronous.ThreadedDatastore, {})
+    self.assertRaises(TypeError, asynchronous.AsyncTieredDatastore, stores)
+
+    # gathered results wait for `timeout` overall, not for each result.
+    import time
+    import multiprocessing
+    pool = threaded[0].pool
+    results = [pool.apply_async(time.sleep, (t,)) for t in [0.1, 0.2, 0.3]]
+    gathered = asynchronous.GatheredResult(results)
+    self.assertRaises(multiprocessing.TimeoutError, gathered.get, 0.15)
+    self.assertEqual(gathered.get(1), [None] * 3)
+
+    # chained results advance when polled, and wait for `timeout` overall.
+    def later(value):
+      return lambda: pool.apply_async(lambda: time.sleep(0.1) or value)
+    chained = asynchronous.ChainedResult([later(None), later('found')],
+      lambda value: value is not None)
+    deadline = time.time() + 1
+    while not chained.ready() and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertTrue(chained.ready())
+    self.assertEqual(chained.get(0), 'found')
+
+    chained = asynchronous.ChainedResult([later(None), later('found')],
+      lambda value: value is not None)
+    self.assertRaises(multiprocessing.TimeoutError, chained.get, 0.15)
+    self.assertEqual(chained.get(1), 'found')
+
+    for store in threaded:
+      store.close()
+    self.assertFalse(any(w.is_alive() for w in threaded[0].pool._pool))
+
+  def test_put_if(self, stores=[]):
+
+    from dronestore.datastore import lrucache, content
+
+    if len(stores) == 0:
+      s1 = datastore.DictDatastore()
+      stores = [s1, lrucache.LRUCache(100),
+        datastore.TieredDatastore([datastore.DictDatastore(), s1]),
+        datastore.ShardedDatastore([datastore.DictDatastore() for i in [1, 2]]),
+        content.ContentAddressedDatastore(datastore.DictDatastore())]
+
+    p = Person('A')
+    p.commit()
+    v1 = p.version.serialRepresentation.data()
+    p.first = 'B'
+    p.commit()
+    v2 = p.version.serialRepresentation.data()
+
+    for sn in stores:
+      self.assertFalse(sn.put_if(p.key, v1, v2['hash']))
+      self.assertEqual(sn.get(p.key), None)
+      self.assertTrue(sn.put_if(p.key, v1, None))
+      self.assertFalse(sn.put_if(p.key, v1, None))
+      self.assertEqual(sn.get(p.key), v1)
+
+      self.assertFalse(sn.put_if(p.key, v2, v2['hash']))
+      self.assertEqual(sn.get(p.key), v1)
+      self.assertTrue(sn.put_if(p.key, v2, v1['hash']))
+      self.assertEqual(sn.get(p.key), v2)
+
+      sn.delete(p.key)
+      sn.put(p.key, 1)
+      self.assertRaises(TypeError, sn.put_if, p.key, v1, None)
+      sn.delete(p.key)
+
+  def test_keysonly(self, stores=[]):
+    from dronestore.datastore import lrucache
+    if len(stores) == 0:
+      stores = [datastore.DictDatastore(), lrucache.LRUCache(100),
+        datastore.ShardedDatastore([datastore.DictDatastore() for i in [0, 1]])]
+
+    keys = [Key('/Thing/t%02d' % i) for i in range(0, 20)]
+    for sn in stores:
+      for i, key in enumerate(keys):
+        sn.put(key, {'key' : str(key), 'n' : i % 5})
+
+      result = list(sn.query(Query('Thing', keysonly=True)))
+      self.assertEqual(sorted(result), keys)
+
+      q = Query('Thing', limit=4, keysonly=True).filter('n', '=', 2)
+      self.assertEqual(sorted(sn.query(q)), [keys[i] for i in [2, 7, 12, 17]])
+
+      q = Query('Thing', limit=5, offset=2, keysonly=True).order('-key')
+      self.assertEqual(list(sn.query(q)), keys[::-1][2:7])
+
+      sn.delete_many(keys)
+      if isinstance(sn, datastore.ShardedDatastore):
+        sn.close()
+
+  def test_parallel_scan(self):
+    from dronestore.datastore import lrucache, parallel
+    serial = datastore.DictDatastore()
+    stores = [datastore.DictDatastore(processes=3),
+      lrucache.LRUCache(1000, processes=2)]
+    for store in stores:
+      store.PARALLEL_SCAN_SIZE = 100
+
+    for i in range(0, 500):
+      key = Key('/Item/%03d' % i)
+      value = {'key' : str(key), 'n' : (i * 7) % 50, 'odd' : i % 2}
+      for store in [serial] + stores:
+        store.put(key, value)
+
+    queries = [Query('Item', limit=0).filter('odd', '=', 1),
+      Query('Item', limit=10, offset=5).filter('n', '>', 20).order('key'),
+      Query('Item', limit=7, offset=30).order('-n').filter('odd', '=', 0),
+      Query('Item', limit=0, keysonly=True).order('n').filter('n', '<', 3)]
+    cursor = queries[2].copy()
+    cursor.start_cursor = cursor.cursor(list(serial.query(queries[2]))[-1])
+    queries.append(cursor)
+
+    for query in queries:
+      expected = list(serial.query(query))
+      for store in stores:
+        result = list(store.query(query))
+        if not query.orders:
+          result, expected = sorted(result), sorted(expected)
+        self.assertEqual(result, expected)
+
+    items = serial._items.values()
+    query = Query('Item', limit=0).order('n').order('key')
+    self.assertEqual(list(parallel.scan(query, items, 2, partitions=7)),
+      list(query(items)))
+
+  def test_indexed(self):
+    import random
+    from dronestore.datastore.indexed import IndexedDatastore, _SortedList
+    from test_merge import PersonM
+
+    self.test_simple([IndexedDatastore(datastore.DictDatastore(),
+      [('dfadasfdsafdas', 'value')])])
+
+    # sorted indexes stay sorted as blocks split and empty.
+    class SmallBlocks(_SortedList):
+      LOAD = 3
+    entries = SmallBlocks([(i % 7, str(i)) for i in range(0, 20)])
+    expected = sorted((i % 7, str(i)) for i in range(0, 20))
+    for i in range(0, 200):
+      entry = (random.randint(0, 9), str(random.randint(0, 50)))
+      if entry in expected:
+        entries.remove(entry)
+        expected.remove(entry)
+      else:
+        entries.add(entry)
+        expected.append(entry)
+        expected.sort()
+      self.assertEqual(list(entries), expected)
+      self.assertEqual(len(entries), len(expected))
+    start, stop = entries.position((3,)), entries.position((7,))
+    self.assertEqual(list(entries.slice(start, stop)),
+      [e for e in expected if 3 <= e[0] < 7])
+    self.assertEqual(list(entries.slice(start, stop, reverse=True)),
+      [e for e in reversed(expected) if 3 <= e[0] < 7])
+    self.assertRaises(ValueError, entries.remove, (100, '0'))
+
+    plain = datastore.DictDatastore()
+    indexed = IndexedDatastore(datastore.DictDatastore(),
+      [(PersonM, 'age'), (PersonM, 'first'), ('PersonM', 'committed')])
+
+    people = []
+    for i in range(0, 200):
+      p = PersonM('p%d' % i)
+      p.age = random.randint(0, 20)
+      p.first = random.choice(['A', 'B', 'C', 'D'])
+      p.commit()
+      people.append(p)
+      plain.put(p.key, p.version.serialRepresentation.data())
+      indexed.put(p.key, p.version.serialRepresentation.data())
+
+    def check(query, plan):
+      self.assertEqual(indexed.plan(query), plan)
+      expected = list(plain.query(query))
+      result = list(indexed.query(query))
+      if query.orders:
+        key = lambda o: [o['attributes'][f.field]['value'] \
+          if f.field in o['attributes'] else o[f.field] for f in query.orders]
+        self.assertEqual(map(key, result), map(key, expected))
+      else:
+        key = lambda o: o['key']
+        self.assertEqual(sorted(map(key, result)), sorted(map(key, expected)))
+
+    def subtest_queries():
+      q = Query(PersonM, limit=0).filter('age', '=', 7)
+      check(q, {'index' : 'age', 'lookup' : 7})
+
+      q = Query(PersonM, limit=0).filter('age', '=', 7)
+      q.filter('first', '=', 'A')
+      self.assertTrue('lookup' in indexed.plan(q))
+      check(q, indexed.plan(q))
+
+      q = Query(PersonM, limit=0).filter('age', '>', 5).filter('age', '<=', 15)
+      check(q, {'index' : 'age', 'range' : q.filters, 'ordered' : False})
+
+      q = Query(PersonM, limit=10).filter('age', '>=', 5).order('-age')
+      check(q, {'index' : 'age', 'range' : q.filters, 'ordered' : True})
+
+      q = Query(PersonM, limit=5, offset=3).order('committed')
+      check(q, {'index' : 'committed', 'range' : [], 'ordered' : True})
+
+      q = Query(PersonM, limit=0).filter('phone', '=', 'N/A')
+      check(q, {'scan' : True})
+
+      # string filters on non-string indexes compare stringified values.
+      q = Query(PersonM, limit=0).filter('age', '=', '7')
+      check(q, {'scan' : True})
+
+      # cursors page through walks of the index, ties in key order, each
+      # page starting at its cursor: fetching only its own objects.
+      child = indexed.child_datastore
+      fetched = []
+      child.get_many = lambda keys: fetched.extend(keys) or \
+        datastore.DictDatastore.get_many(child, keys)
+      indexed.FETCH_BATCH = 1
+      for order in ['age', '-age']:
+        q = Query(PersonM, limit=0).order(order)
+        expected = [o['key'] for o in plain.query(q)]
+        q.limit = 9
+        keys = []
+        del fetched[:]
+        while True:
+          page = list(indexed.query(q))
+          if not page:
+            break
+          keys.extend(o['key'] for o in page)
+          q.start_cursor = q.cursor(page[-1])
+        self.assertEqual(keys, expected)
+        self.assertEqual(len(fetched), len(expected))
+      del child.get_many
+      del indexed.FETCH_BATCH
+
+    subtest_queries()
+
+    # indexes follow updates and deletes.
+    for p in people[:100]:
+      p.age = random.randint(0, 20)
+      p.commit()
+    items = [(p.key, p.version.serialRepresentation.data()) for p in people]
+    plain.put_many(items)
+    indexed.put_many(items)
+    for p in people[100:150]:
+      plain.delete(p.key)
+      indexed.delete(p.key)
+    self.assertEqual(len(indexed.index(PersonM, 'age')), 150)
+    subtest_queries()
+
+    # indexes are rebuilt from the child.
+    indexed = IndexedDatastore(indexed.child_datastore,
+      [(PersonM, 'age'), (PersonM, 'first'), ('PersonM', 'committed')])
+    self.assertEqual(len(indexed.index(PersonM, 'age')), 150)
+    subtest_queries()
+
+  def test_query_cache(self):
+    from dronestore.datastore.querycache import QueryCacheDatastore
+
+    self.test_simple([QueryCacheDatastore(datastore.DictDatastore())])
+
+    child = datastore.DictDatastore()
+    cache = QueryCacheDatastore(child, size=3)
+    for i in range(0, 20):
+      cache.put(Key('/Item/%d' % i), {'key' : '/Item/%d' % i, 'n' : i})
+
+    def put(i, n):
+      cache.put(Key('/Item/%d' % i), {'key' : '/Item/%d' % i, 'n' : n})
+
+    def check(query):
+      expected = list(child.query(query))
+      self.assertEqual(list(cache.query(query)), expected)
+
+    low = Query('Item', limit=0).filter('n', '<', 5)
+    top = Query('Item', limit=3).order('-n')
+    check(low)
+    check(low)
+    check(top)
+    check(top)
+    self.assertEqual(cache.stats()['hits'], 2)
+    self.assertEqual(cache.stats()['misses'], 2)
+
+    # writes only invalidate the queries they might change.
+    put(10, 11)
+    self.assertEqual(len(cache), 1)
+    put(3, 4)
+    self.assertEqual(len(cache), 0)
+    check(low)
+    check(top)
+    put(19, 30)
+    self.assertEqual(len(cache), 1)
+    check(low)
+    check(top)
+    cache.delete(Key('/Item/3'))
+    self.assertEqual(cache.stats()['invalidations'], 5)
+    check(low)
+    check(top)
+
+    # objects leaving results cut by the limit invalidate them too.
+    some = Query('Item', limit=2).filter('n', '<', 5)
+    check(some)
+    outside = [i for i in [0, 1, 2, 4] if '/Item/%d' % i not in \
+      [o['key'] for o in cache.query(some)]][0]
+    put(outside, 50)
+    check(some)
+    self.assertEqual(cache.stats()['invalidations'], 8)
+
+    # the cache is bounded.
+    for i in range(0, 5):
+      check(Query('Item', limit=0).filter('n', '=', i))
+    self.assertEqual(len(cache), 3)
+
+    # large results are not cached.
+    cache = QueryCacheDatastore(child, maxresults=5)
+    check(Query('Item', limit=0))
+    self.assertEqual(len(cache), 0)
+
+  def test_columnar(self):
+    import random
+    from dronestore.datastore import columnar
+
+    self.test_simple([columnar.ColumnarDatastore()])
+    self.test_keysonly([columnar.ColumnarDatastore()])
+
+    def value(i):
+      return {'key' : '/Item/%03d' % i, 'attributes' : {
+        'n' : {'value' : random.choice([0, 1, 2, 3.5, -4, None])},
+        'name' : {'value' : random.choice(['a', 'b', u'c', 'None', None])},
+        'mixed' : {'value' : random.choice([1, 'one', [1], None])},
+        'big' : {'value' : random.choice([2 ** 53 + 1, 2 ** 53, 3, None])}}}
+
+    def subtest_queries(plain, store):
+      queries = [Query('Item', limit=0).filter('n', '>=', 1),
+        Query('Item', limit=0).filter('n', '<', 2).filter('name', '!=', 'b'),
+        Query('Item', limit=0).filter('name', '<=', u'b'),
+        Query('Item', limit=0).filter('name', '<', 'c'),
+        Query('Item', limit=0).filter('n', '=', '2'),
+        Query('Item', limit=0).filter('mixed', '>', 'one'),
+        Query('Item', limit=0).filter('missing', '<', 3),
+        Query('Item', limit=0).filter('big', '>', float(2 ** 53)),
+        Query('Item', limit=0).filter('big', '<', float(2 ** 53)),
+        Query('Item', limit=20, offset=5).order('-n').filter('n', '!=', 0),
+        Query('Item', limit=30).order('name').order('-n'),
+        Query('Item', limit=0, keysonly=True).order('mixed'),
+        Query('Item', limit=0).order('missing').order('-key')]
+      cursor = queries[-3].copy()
+      cursor.start_cursor = cursor.cursor(list(plain.query(queries[-3]))[-1])
+      queries.append(cursor)
+
+      for query in queries:
+        expected = list(plain.query(query))
+        result = list(store.query(query))
+        if not query.orders:
+          result, expected = sorted(result), sorted(expected)
+        self.assertEqual(result, expected)
+
+    for vectorized in [True, False]:
+      numpy = columnar.numpy
+      if not vectorized:
+        columnar.numpy = None
+      try:
+        plain = datastore.DictDatastore()
+        store = columnar.ColumnarDatastore()
+        for i in range(0, 300):
+          v = value(i)
+          plain.put(Key(v['key']), v)
+          store.put(Key(v['key']), v)
+          store.put(Key('/Other/%03d' % i), v)
+        subtest_queries(plain, store)
+
+        # ints put in float columns are stored as floats.
+        column = store._tables['Item'].column('n')
+        for i in range(0, 300, 5):
+          v = value(i)
+          v['attributes']['n']['value'] = i
+          plain.put(Key(v['key']), v)
+          store.put(Key(v['key']), v)
+        self.assertEqual(column.kind, 'float')
+        subtest_queries(plain, store)
+
+        # columns follow updates (changing kinds) and deletes.
+        for i in range(0, 300, 3):
+          v = value(i)
+          v['attributes']['n']['value'] = random.choice([2.5, 'x', 2 ** 70])
+          plain.put(Key(v['key']), v)
+          store.put(Key(v['key']), v)
+        for i in range(0, 300, 4):
+          plain.delete(Key('/Item/%03d' % i))
+          store.delete(Key('/Item/%03d' % i))
+
+        # strings of deleted rows (here, not ascii) do not affect filters.
+        v = value(0)
+        v['attributes']['name']['value'] = u'\xe9'
+        store.put(Key(v['key']), v)
+        store.delete(Key(v['key']))
+        subtest_queries(plain, store)
+      finally:
+        columnar.numpy = numpy
+
+    # tables drop deleted rows when compacted.
+    for i in range(0, 300):
+      store.delete(Key('/Other/%03d' % i))
+    store._tables['Other'].compact()
+    self.assertEqual(len(store._tables['Other'].docs), 0)
+    self.assertEqual(list(store.query(Query('Other'))), [])
+
+  def test_sharded_query(self):
+    stores = [datastore.DictDatastore() for i in range(0, 5)]
+    sharded = datastore.ShardedDatastore(stores)
+
+    values = [{'key' : '/Item/%d' % i, 'n' : (i * 7) % 100} \
+      for i in range(0, 100)]
+    for value in values:
+      sharded.put(Key(value['key']), value)
+
+    ordered = sorted(values, key=lambda v: v['n'])
+    for offset, limit in [(0, 10), (15, 10), (95, 10), (0, 0), (30, 0)]:
+      query = Query('Item', offset=offset, limit=limit).order('n')
+      expected = ordered[offset:offset + limit if limit else None]
+      self.assertEqual(list(sharded.query(query)), expected)
+
+      query = Query('Item', offset=offset, limit=limit).order('-n')
+      expected = ordered[::-1][offset:offset + limit if limit else None]
+      self.assertEqual(list(sharded.query(query)), expected)
+
+    # shards are queried concurrently.
+    import time
+    class SlowDatastore(datastore.ShimDatastore):
+      def query(self, query):
+        time.sleep(0.1)
+        return self.child_datastore.query(query)
+
+    sharded.close()
+    sharded = datastore.ShardedDatastore([SlowDatastore(s) for s in stores])
+    start = time.time()
+    query = Query('Item', offset=15, limit=10).order('n')
+    self.assertEqual(list(sharded.query(query)), ordered[15:25])
+    self.assertTrue(time.time() - start < 0.3)
+
+    # cursors page through the shards.
+    query = Query('Item', limit=8).order('-n')
+    expected = sorted(values, key=lambda v: (v['n'], v['key']), reverse=True)
+    results = []
+    while True:
+      page = list(sharded.query(query))
+      if not page:
+        break
+      results.extend(page)
+      query.start_cursor = query.cursor(page[-1])
+    self.assertEqual(results, expected)
+    sharded.close()
+
+  def test_writebehind(self):
+
+    import time
+    from dronestore.datastore import buffered
+
+    s1 = datastore.DictDatastore()
+    wb = buffered.WriteBehindDatastore(s1, flushsize=10)
+
+    keys = [Key('/WriteBehind/%d' % i) for i in range(0, 25)]
+    for i, key in enumerate(keys[:9]):
+      wb.put(key, i)
+      wb.put(key, i + 1) # coalesced
+    self.assertEqual(wb.pending(), 9)
+    self.assertEqual(len(s1), 0)
+
+    # reads see buffered writes.
+    self.assertEqual(wb.get(keys[0]), 1)
+    self.assertTrue(wb.contains(keys[0]))
+    self.assertEqual(wb.get_many(keys[:2]), [1, 2])
+    wb.delete(keys[0])
+    self.assertEqual(wb.get(keys[0]), None)
+    self.assertFalse(wb.contains(keys[0]))
+    self.assertEqual(wb.contains_many(keys[:2]), [False, True])
+
+    # filling the buffer flushes it.
+    wb.put(keys[9], 10)
+    self.assertEqual(wb.pending(), 0)
+    self.assertEqual(len(s1), 9)
+    self.assertEqual(s1.get(keys[1]), 2)
+    self.assertFalse(s1.contains(keys[0]))
+
+    wb.put(keys[10], 11)
+    wb.flush()
+    self.assertEqual(s1.get(keys[10]), 11)
+
+    self.test_simple([buffered.WriteBehindDatastore(datastore.DictDatastore(),
+      flushsize=10)])
+
+    # background flushes.
+    wb = buffered.WriteBehindDatastore(s1, interval=0.01)
+    wb.put(keys[20], 21)
+    for i in range(0, 100):
+      if s1.contains(keys[20]):
+        break
+      time.sleep(0.01)
+    self.assertEqual(s1.get(keys[20]), 21)
+
+    wb.put(keys[21], 22)
+    wb.close()
+    self.assertEqual(s1.get(keys[21]), 22)
+
+    # failed background flushes keep the writes, and the thread, and raise.
+    class Failing(datastore.DictDatastore):
+      down = True
+      def put_many(self, items):
+        if self.down:
+          raise IOError('unavailable')
+        super(Failing, self).put_many(items)
+
+    failing = Failing()
+    wb = buffered.WriteBehindDatastore(failing, interval=0.01)
+    wb.put(keys[0], 1)
+    for i in range(0, 100):
+      if wb._error is not None:
+        break
+      time.sleep(0.01)
+    self.assertRaises(IOError, wb.flush)
+    self.assertEqual(wb.pending(), 1)
+    failing.down = False
+    for i in range(0, 100):
+      if failing.contains(keys[0]):
+        break
+      time.sleep(0.01)
+    self.assertEqual(failing.get(keys[0]), 1)
+    self.assertTrue(wb._thread.is_alive())
+    wb.close()
+
+    # merges (compare-and-set) are buffered and coalesced too.
+    from dronestore import Drone
+    from test_merge import PersonM
+    s1 = datastore.DictDatastore()
+    wb = buffered.WriteBehindDatastore(s1, flushsize=10)
+    drone = Drone('/DroneWB/', wb)
+    for age in range(0, 5):
+      p = PersonM('wb')
+      p.age = age
+      p.commit()
+      drone.merge(p)
+    self.assertEqual(wb.pending(), 1)
+    self.assertEqual(len(s1), 0)
+    self.assertEqual(drone.get(p.key).age, 4)
+
+    data = wb.get(p.key)
+    self.assertFalse(wb.put_if(p.key, data, 'stale'))
+    self.assertTrue(wb.put_if(p.key, None, data['hash']))
+    self.assertEqual(wb.get(p.key), None)
+    self.assertTrue(wb.put_if(p.key, data, None))
+    wb.flush()
+    self.assertEqual(s1.get(p.key), data)
 
   def test_mongo(self):
 
@@ -329,6 +993,42 @@ class TestDatastore(unittest.TestCase):
     finally:
       conn.drop_database('dronestore_datastore_testdb')
 
+  def test_parse(self):
+
+    from dronestore.datastore import parse
+
+    # a connection answering queries as Parse does: at most 1000 objects.
+    class Connection(object):
+      queries = []
+      def query(self, type, query):
+        self.queries.append(query)
+        keys = query['where']['key']['$in'][:min(query['limit'], 1000)]
+        fields = dict.fromkeys(parse.VERSION_FIELDS, 'v')
+        return {'results' : [dict(fields, key=k) for k in keys]}
+
+    store = parse.ParseDatastore('appid', 'masterkey')
+    store.parseconn = Connection()
+    keys = [Key('/Item/%d' % i) for i in range(0, 2500)]
+    values = store.get_many(keys)
+    self.assertEqual([v['key'] for v in values], map(str, keys))
+    self.assertEqual(len(Connection.queries), 3)
+
+    # filters on one field are merged.
+    translate = parse.QueryTranslate.query
+    n, s = map(parse.QueryTranslate.field, ['n', 's'])
+    query = Query('Item').filter('n', '>', 1).filter('n', '<', 5)
+    query.filter('n', '<=', 3).filter('s', '=', 'a')
+    self.assertEqual(translate(query)['where'],
+      {n : {'$gt' : 1, '$lt' : 5, '$lte' : 3}, s : 'a'})
+
+    query = Query('Item').filter('n', '=', 2).filter('n', '!=', 3)
+    query.filter('n', '!=', 4).filter('n', '>=', 0)
+    self.assertEqual(translate(query)['where'],
+      {n : {'$in' : [2], '$nin' : [3, 4], '$gte' : 0}})
+
+    query = Query('Item').filter('n', '=', 2).filter('n', '=', 3)
+    self.assertEqual(translate(query)['where'], {n : {'$in' : []}})
+
   def test_fs(self):
 
     import os
@@ -347,6 +1047,36 @@ class TestDatastore(unittest.TestCase):
       # fs3 = filesystem.FSDatastore(directory + '/bson', serializer=bson)
 
       self.test_simple([fs1, fs2, fs3], numelems=100)
+      self.test_put_if([fs1, fs2, fs3])
+      self.test_keysonly([fs1, fs2])
+
+      # keys-only queries return keys as stored (filenames are lowercased).
+      key = Key('/Person/Alice')
+      fs1.put(key, {'key' : str(key)})
+      self.assertEqual(list(fs1.query(Query('Person', keysonly=True))), [key])
+
+      # the directory of a key's children is not the key.
+      parent, child = Key('/Dir/a'), Key('/Dir/a/b')
+      fs1.put(child, 'b')
+      self.assertFalse(fs1.contains(parent))
+      self.assertEqual(fs1.contains_many([parent, child]), [False, True])
+
+      # locks of dead processes are released. held locks time out.
+      key = Key('/Lock/a')
+      v1 = {'key' : str(key), 'hash' : 'h1'}
+      v2 = {'key' : str(key), 'hash' : 'h2'}
+      pid = os.fork()
+      if pid == 0:
+        fs1.acquire_lock(fs1.lock_path(key))
+        os._exit(0) # dies holding the lock.
+      os.waitpid(pid, 0)
+      self.assertTrue(fs1.put_if(key, v1, None))
+
+      held = fs1.acquire_lock(fs1.lock_path(key))
+      fs1.LOCK_TIMEOUT = 0.05
+      self.assertRaises(IOError, fs1.put_if, key, v2, 'h1')
+      fs1.release_lock(held)
+      self.assertTrue(fs1.put_if(key, v2, 'h1'))
 
     finally:
       os.system('rm -rf %s' % directory)
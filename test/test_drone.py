@@ -5,9 +5,14 @@ import random
 import unittest
 
 from dronestore.datastore.lrucache import LRUCache
-from dronestore import Key, Model, Drone, Query
+from dronestore import Key, Model, Drone, Query, MergeConflictError
 
 from test_merge import PersonM
+from dronestore.attribute import ListAttribute
+
+
+class Tagged(Model):
+  tags = ListAttribute(list)
 
 
 class TestDrone(unittest.TestCase):
@@ -57,6 +62,346 @@ class TestDrone(unittest.TestCase):
     self.assertEqual(p2, res[0])
 
 
+  def test_many(self):
+    drone = Drone('/DroneA/', LRUCache(100))
+
+    people = []
+    for i in range(0, 10):
+      p = PersonM('person%d' % i)
+      p.first = 'first%d' % i
+      p.commit()
+      people.append(p)
+
+    keys = [p.key for p in people]
+    self.assertEqual(drone.get_many(keys), [None] * 10)
+
+    drone.put_many(people[:5])
+    self.assertEqual(drone.get_many(keys), people[:5] + [None] * 5)
+
+    updates = []
+    for p in people:
+      p2 = PersonM(p.version)
+      p2.last = 'last'
+      p2.commit()
+      updates.append(p2)
+
+    # a key may be merged more than once in a batch.
+    again = PersonM(updates[0].version)
+    again.phone = 'phone'
+    again.commit()
+
+    merged = drone.merge_many(updates + [again])
+    self.assertEqual(len(merged), 11)
+    self.assertEqual(drone.get_many(keys), merged[:10])
+    self.assertEqual(drone.get(keys[0]).phone, 'phone')
+    self.assertTrue(all([p.last == 'last' for p in drone.get_many(keys)]))
+
+    self.assertRaises(ValueError, drone.get_many, ['/PersonM/person0'])
+
+    # versions other writers store in between are merged, not overwritten.
+    class Racing(LRUCache):
+      writes = []
+      def put_if(self, key, value, expected_hash):
+        if self.writes:
+          other = self.writes.pop()
+          self.put(other.key, other.version.serialRepresentation.data())
+        return super(Racing, self).put_if(key, value, expected_hash)
+
+    drone = Drone('/DroneA/', Racing(100))
+    drone.put(people[0])
+    other = PersonM(people[0].version)
+    other.phone = 'other'
+    other.commit()
+    Racing.writes.append(other)
+    merged = drone.merge_many([updates[0]])
+    self.assertEqual(merged, [drone.get(keys[0])])
+    self.assertEqual(merged[0].phone, 'other')
+    self.assertEqual(merged[0].last, 'last')
+
+    for i in range(0, drone.MERGE_ATTEMPTS):
+      other = PersonM(other.version)
+      other.phone = 'other%d' % i
+      other.commit()
+      Racing.writes.insert(0, other)
+    late = PersonM(people[0].version)
+    late.first = 'late'
+    late.commit()
+    self.assertRaises(MergeConflictError, drone.merge_many, [late])
+
+  def test_cache(self):
+    store = LRUCache(100)
+    drone = Drone('/DroneA/', store, cachesize=2)
+
+    p = PersonM('A')
+    p.first = 'A'
+    p.commit()
+    drone.put(p)
+
+    # repeated reads share the decoded version, but not the instances.
+    p1 = drone.get(p.key)
+    p2 = drone.get(p.key)
+    self.assertEqual(p1, p)
+    self.assertTrue(p1.version is p2.version)
+    self.assertFalse(p1 is p2)
+
+    p2.first = 'B'
+    p2.commit()
+    self.assertEqual(drone.get(p.key).first, 'A')
+
+    # writes through the drone invalidate.
+    drone.merge(p2)
+    self.assertEqual(drone.get(p.key).first, 'B')
+
+    # writes behind the drone's back are caught by the version check.
+    store.put(p.key, p.version.serialRepresentation.data())
+    self.assertEqual(drone.get(p.key).first, 'A')
+
+    drone.delete(p.key)
+    self.assertEqual(drone.get(p.key), None)
+
+    # the cache is bounded.
+    for name in ['B', 'C', 'D']:
+      q = PersonM(name)
+      q.commit()
+      drone.put(q)
+      drone.get(q.key)
+    self.assertEqual(len(drone._cache), 2)
+
+    self.assertRaises(ValueError, Drone, '/DroneB/', store, cachesize=-1)
+
+    # instances do not share nested values with the store or the cache.
+    t = Tagged('t')
+    t.tags = [[1, 2]]
+    t.commit()
+    drone.put(t)
+    t1 = drone.get(t.key)
+    t1.tags[0].append(99)
+    self.assertEqual(store.get(t.key)['attributes']['tags']['value'], [[1, 2]])
+    self.assertEqual(drone.get(t.key).tags, [[1, 2]])
+    self.assertEqual(Drone('/DroneC/', store).get(t.key).tags, [[1, 2]])
+
+    # nor do instances merged from a version read from another store.
+    remote = LRUCache(100)
+    t2 = Tagged(t.version)
+    t2.tags = [[1, 2], [3]]
+    t2.commit()
+    Drone('/DroneD/', remote).put(t2)
+    merged = drone.merge(Drone('/DroneD/', remote).get(t.key))
+    merged.tags[0].append(99)
+    self.assertEqual(remote.get(t.key)['attributes']['tags']['value'],
+      [[1, 2], [3]])
+
+  def test_async(self):
+    from dronestore import AsyncDrone
+    from dronestore.datastore.asynchronous import ThreadedDatastore
+
+    drone = AsyncDrone('/DroneA/', ThreadedDatastore(LRUCache(100)))
+
+    people = []
+    for i in range(0, 10):
+      p = PersonM('person%d' % i)
+      p.first = 'first%d' % i
+      p.commit()
+      people.append(p)
+
+    keys = [p.key for p in people]
+    self.assertEqual(drone.get_many(keys).get(), [None] * 10)
+    self.assertFalse(drone.contains(keys[0]).get())
+
+    map(lambda r: r.get(), [drone.put(p) for p in people])
+    self.assertEqual(drone.get_many(keys).get(), people)
+
+    updates = []
+    for p in people:
+      p2 = PersonM(p.version)
+      p2.last = 'last'
+      p2.commit()
+      updates.append(p2)
+
+    merged = [r.get() for r in [drone.merge(p) for p in updates]]
+    self.assertEqual(drone.get_many(keys).get(), merged)
+
+    q = Query(PersonM).filter('last', '=', 'last')
+    self.assertEqual(len(list(drone.query(q).get())), 10)
+
+    drone.delete(keys[0]).get()
+    self.assertEqual(drone.get(keys[0]).get(), None)
+
+    drone.close()
+    drone._store.close()
+
+  def test_threadsafe(self):
+    import threading
+    from dronestore import ThreadSafeDrone
+    from dronestore.attribute import StringAttribute
+    from dronestore.merge import LatestStrategy
+
+    num_threads = 8
+    num_keys = 5
+
+    # each thread owns one attribute. a lost update loses that attribute.
+    attrs = dict([('f%d' % i, StringAttribute(strategy=LatestStrategy)) \
+      for i in range(0, num_threads)])
+    Striped = type('Striped', (Model,), attrs)
+
+    drone = ThreadSafeDrone('/DroneA/', LRUCache(100), stripes=4, cachesize=2)
+    errors = []
+
+    def work(index):
+      try:
+        for rounds in range(0, 20):
+          for k in range(0, num_keys):
+            s = Striped('key%d' % k)
+            setattr(s, 'f%d' % index, 'round%d' % rounds)
+            s.commit()
+            drone.merge(s)
+      except Exception, e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,)) \
+      for i in range(0, num_threads)]
+    map(lambda t: t.start(), threads)
+    map(lambda t: t.join(), threads)
+
+    self.assertEqual(errors, [])
+    for k in range(0, num_keys):
+      s = drone.get(Key('/Striped/key%d' % k))
+      for i in range(0, num_threads):
+        self.assertEqual(getattr(s, 'f%d' % i), 'round19')
+
+  def test_optimistic(self):
+    import shutil
+    import tempfile
+    import threading
+    from dronestore.attribute import StringAttribute
+    from dronestore.merge import LatestStrategy
+    from dronestore.datastore import DictDatastore
+    from dronestore.datastore.filesystem import FSDatastore
+
+    num_drones = 4
+
+    # each drone owns one attribute. a lost update loses that attribute.
+    attrs = dict([('f%d' % i, StringAttribute(strategy=LatestStrategy)) \
+      for i in range(0, num_drones)])
+    Optimistic = type('Optimistic', (Model,), attrs)
+
+    directory = tempfile.mkdtemp()
+    try:
+      for store in [DictDatastore(), FSDatastore(directory)]:
+        # unlocked drones sharing one store, as separate processes would.
+        drones = [Drone('/Drone%d' % i, store) for i in range(0, num_drones)]
+        errors = []
+
+        def work(index):
+          try:
+            for rounds in range(0, 10):
+              o = Optimistic('key')
+              setattr(o, 'f%d' % index, 'round%d' % rounds)
+              o.commit()
+              drones[index].merge(o)
+          except Exception, e:
+            errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) \
+          for i in range(0, num_drones)]
+        map(lambda t: t.start(), threads)
+        map(lambda t: t.join(), threads)
+
+        self.assertEqual(errors, [])
+        o = drones[0].get(Key('/Optimistic/key'))
+        for i in range(0, num_drones):
+          self.assertEqual(getattr(o, 'f%d' % i), 'round9')
+    finally:
+      shutil.rmtree(directory)
+
+  def test_stats(self):
+    drone = Drone('/DroneA/', LRUCache(100))
+
+    p = PersonM('A')
+    p.commit()
+    drone.put(p)
+    for i in range(0, 5):
+      drone.get(p.key)
+    p.first = 'B'
+    p.commit()
+    drone.merge(p)
+
+    timers = drone.stats(reset=True)['timers']
+    self.assertEqual(timers['put']['count'], 1)
+    self.assertEqual(timers['get']['count'], 5) # merges do not count gets.
+    self.assertEqual(timers['merge']['count'], 1)
+    self.assertEqual(timers['merging']['count'], 1)
+    self.assertEqual(timers['decoding']['count'], 6)
+    self.assertEqual(timers['storing']['count'], 8)
+    self.assertTrue(timers['get']['p50'] <= timers['get']['max'])
+
+    self.assertEqual(drone.stats()['timers']['get']['count'], 0)
+
+    # query latency covers consuming the results, recorded once exhausted.
+    import time
+    class SlowCache(LRUCache):
+      def query(self, query):
+        for item in super(SlowCache, self).query(query):
+          time.sleep(0.05)
+          yield item
+
+    drone = Drone('/DroneA/', SlowCache(100))
+    drone.put(p)
+    results = drone.query(Query(PersonM))
+    self.assertEqual(drone.stats()['timers']['query']['count'], 0)
+    self.assertEqual(len(list(results)), 1)
+    self.assertEqual(list(results), [])
+    timers = drone.stats()['timers']
+    self.assertEqual(timers['query']['count'], 1)
+    self.assertTrue(timers['query']['min'] >= 50000)
+
+  def test_aggregate(self):
+    from dronestore.datastore import DictDatastore, ShardedDatastore
+    stores = [DictDatastore() for i in range(0, 3)]
+    for store in [DictDatastore(), ShardedDatastore(stores)]:
+      drone = Drone('/DroneA/', store)
+      people = []
+      for i in range(0, 30):
+        p = PersonM('p%d' % i)
+        p.age = i
+        p.first = 'first%d' % (i % 2)
+        p.commit()
+        people.append(p)
+      drone.put_many(people)
+
+      self.assertEqual(PersonM.all(drone).count(), 30)
+      self.assertEqual(len(list(PersonM.all(drone))), 30)
+      self.assertEqual(PersonM.all(store).count(), 30)
+
+      q = Query(PersonM, limit=0, keysonly=True)
+      self.assertEqual(sorted(drone.query(q)), sorted(p.key for p in people))
+
+      # counts are of the objects left to iterate.
+      q = Query(PersonM, limit=0, offset=4).filter('age', '<', 10)
+      self.assertEqual(drone.query(q).count(), 6)
+      q.offset = 12
+      self.assertEqual(drone.query(q).count(), 0)
+      q = Query(PersonM, limit=4).filter('age', '<', 10).order('-age')
+      q.start_cursor = q.cursor(list(drone.query(q))[-1])
+      self.assertEqual(drone.query(q).count(), 4)
+      q.limit = 0
+      self.assertEqual(drone.query(q).count(), 6)
+      results = drone.query(q)
+      results.next()
+      self.assertEqual(results.count(), 5)
+      self.assertEqual(len(list(results)), 5)
+
+      q = Query(PersonM, limit=3).filter('age', '<', 10)
+      self.assertEqual(drone.query(q).count(), 3)
+      self.assertEqual(drone.aggregate(q, ['count', ('avg', 'age')]),
+        {'count' : 10, 'avg(age)' : 4.5})
+
+      groups = drone.aggregate(q, [('max', 'age')], groupby='first')
+      self.assertEqual(groups, {'first0' : {'max(age)' : 8},
+        'first1' : {'max(age)' : 9}})
+    self.assertEqual(drone.stats()['timers']['aggregate']['count'], 12)
+    store.close()
+
   def test_stress(self):
     num_drones = 5
     num_people = 10
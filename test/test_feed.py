@@ -0,0 +1,99 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dronestore import Drone, Key, Change, ChangeLog, ChangeFeed
+from dronestore.datastore import DictDatastore
+
+from test_merge import PersonM
+
+
+class TestChangeFeed(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_log(self):
+    path = os.path.join(self.tmpdir, 'feed', 'changes.log')
+    log = ChangeLog(path)
+    self.assertEqual(log.cursor(), 0)
+    self.assertEqual(log.read(), ([], 0))
+
+    changes = [Change(Key('/A/%d' % i), 'hash%d' % i, i, Change.PUT) \
+      for i in range(0, 10)]
+    changes.append(Change.deletion(Key('/A/0')))
+    cursors = map(log.append, changes)
+    self.assertEqual(cursors[-1], log.cursor())
+
+    self.assertEqual(list(log), changes)
+    self.assertEqual(log.read(), (changes, cursors[-1]))
+    self.assertEqual(log.read(0, 3), (changes[:3], cursors[2]))
+    self.assertEqual(log.read(cursors[2], 3), (changes[3:6], cursors[5]))
+    self.assertEqual(log.read(cursors[-1]), ([], cursors[-1]))
+
+    # resumes after reopening.
+    log.close()
+    log = ChangeLog(path)
+    self.assertEqual(log.read(cursors[5]), (changes[6:], cursors[-1]))
+    change = Change(Key('/A/11'), 'hash11', 11, Change.MERGE)
+    cursor = log.append(change)
+    self.assertEqual(log.read(cursors[-1]), ([change], cursor))
+
+    # partially written lines are not read.
+    with open(path, 'ab') as f:
+      f.write('{"key": "/A/12"')
+    self.assertEqual(log.read(cursors[-1]), ([change], cursor))
+    log.close()
+
+  def test_drone(self):
+    log = ChangeLog(os.path.join(self.tmpdir, 'changes.log'))
+    drone = Drone('/DroneA/', DictDatastore(), feed=ChangeFeed(log))
+
+    seen = []
+    drone.subscribe(seen.append)
+
+    p = PersonM('A')
+    p.first = 'A'
+    p.commit()
+    drone.put(p)
+
+    p2 = PersonM('B')
+    p2.commit()
+    drone.merge(p2)
+    p.first = 'AA'
+    p.commit()
+    merged = drone.merge(p)
+    drone.merge(p) # nothing changed, so no change published.
+
+    drone.delete(p.key)
+
+    expected = [
+      (p.key, Change.PUT),
+      (p2.key, Change.MERGE),
+      (p.key, Change.MERGE),
+      (p.key, Change.DELETE),
+    ]
+    self.assertEqual([(c.key, c.op) for c in seen], expected)
+    self.assertEqual(seen[2].hash, merged.version.hash)
+    self.assertEqual(seen[2].committed,
+      merged.version.committed.nanoseconds())
+    self.assertEqual(seen[3].hash, None)
+    self.assertEqual(list(log), seen)
+
+    # unsubscribed functions see no more changes.
+    drone.unsubscribe(seen.append)
+    drone.put_many([p2])
+    self.assertEqual(len(seen), 4)
+    self.assertEqual(list(log)[-1], Change.from_version(p2.version, Change.PUT))
+
+    self.assertRaises(TypeError, drone.subscribe, 'notcallable')
+    self.assertRaises(ValueError, ChangeFeed, 'notalog')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,145 @@
+
+import time
+import unittest
+import nanotime
+
+from dronestore import Drone, Key, VersionHistory
+from dronestore.datastore import DictDatastore
+
+from test_merge import PersonM
+
+
+class TestVersionHistory(unittest.TestCase):
+
+  def test_simple(self):
+    history = VersionHistory()
+
+    p = PersonM('A')
+    versions = []
+    for i in range(0, 10):
+      p.age = i
+      p.commit()
+      versions.append(p.version)
+      history.append(p.version)
+
+    # appending the same version twice records it once.
+    history.append(p.version)
+    self.assertEqual(history.versions(p.key), versions)
+
+    before = versions[0].committed.nanoseconds() - 1
+    self.assertEqual(history.versionAt(p.key, before), None)
+    for version in versions:
+      self.assertEqual(history.versionAt(p.key, version.committed), version)
+      ns = version.committed.nanoseconds()
+      self.assertEqual(history.versionAt(p.key, ns), version)
+    self.assertEqual(history.versionAt(p.key, nanotime.now()), versions[-1])
+
+    # deletions are recorded as tombstones.
+    history.delete(p.key)
+    self.assertEqual(history.versionAt(p.key, nanotime.now()), None)
+    self.assertEqual(history.versionAt(p.key, versions[-1].committed),
+      versions[-1])
+    self.assertEqual(history.versions(p.key), versions)
+
+    history.remove(p.key)
+    self.assertEqual(history.versions(p.key), [])
+    self.assertRaises(ValueError, history.append, PersonM('B').version)
+    self.assertRaises(TypeError, history.append, p)
+
+  def test_retention(self):
+    history = VersionHistory(maxVersions=5, maxAge=1000)
+
+    p = PersonM('A')
+    versions = []
+    for i in range(0, 10):
+      time.sleep(0.001) # ensure distinct committed times.
+      p.age = i
+      p.commit()
+      versions.append(p.version)
+      history.append(p.version)
+
+    self.assertEqual(history.versions(p.key), versions[-5:])
+
+    # the version current at the cutoff survives compaction.
+    now = versions[-2].committed.nanoseconds() + 1000
+    history.compact(p.key, now=now)
+    self.assertEqual(history.versions(p.key), versions[-2:])
+    self.assertEqual(history.versionAt(p.key, now - 1000), versions[-2])
+
+    deleted = versions[-1].committed.nanoseconds() + 1
+    history.delete(p.key, when=deleted)
+    history.compact(p.key, now=deleted + 1000)
+    self.assertEqual(history.versions(p.key), [])
+
+    self.assertRaises(ValueError, VersionHistory, maxVersions=0)
+
+    # dropped versions' records are deleted.
+    store = DictDatastore()
+    history = VersionHistory(store, maxVersions=3)
+    for version in versions:
+      history.append(version)
+    self.assertEqual(history.versions(p.key), versions[-3:])
+    self.assertEqual(len(store), 3 + 1) # records and the index.
+
+  def test_concurrent(self):
+    # appends racing on the same key (e.g. in other processes) are all kept.
+    class Racing(DictDatastore):
+      appends = []
+      def put_if(self, key, value, expected_hash):
+        if self.appends:
+          self.appends.pop()()
+        return super(Racing, self).put_if(key, value, expected_hash)
+
+    store = Racing()
+    history = VersionHistory(store)
+    other = VersionHistory(store)
+
+    p = PersonM('A')
+    versions = []
+    for i in range(0, 4):
+      time.sleep(0.001) # ensure distinct committed times.
+      p.age = i
+      p.commit()
+      versions.append(p.version)
+
+    history.append(versions[0])
+    Racing.appends.append(lambda: other.append(versions[1]))
+    history.append(versions[2])
+    Racing.appends.append(lambda: other.append(versions[3]))
+    history.delete(p.key, when=versions[3].committed.nanoseconds() + 1)
+    self.assertEqual(history.versions(p.key), versions)
+    self.assertEqual(history.versionAt(p.key, nanotime.now()), None)
+
+
+class TestDroneHistory(unittest.TestCase):
+
+  def test_time_travel(self):
+    drone = Drone('/DroneA', DictDatastore(), history=VersionHistory())
+
+    p = PersonM('A')
+    p.first = 'First'
+    p.commit()
+    drone.put(p)
+    t1 = nanotime.now()
+
+    p.first = 'Second'
+    p.commit()
+    drone.merge(p)
+    t2 = nanotime.now()
+
+    drone.delete(p.key)
+
+    self.assertEqual(drone.get(p.key), None)
+    self.assertEqual(drone.get(p.key, at=t1).first, 'First')
+    self.assertEqual(drone.get(p.key, at=t2).first, 'Second')
+    self.assertEqual(drone.get(p.key, at=nanotime.now()), None)
+    self.assertEqual([m.first for m in drone.history(p.key)],
+      ['First', 'Second'])
+
+    nohistory = Drone('/DroneB', DictDatastore())
+    self.assertRaises(ValueError, nohistory.get, p.key, at=t1)
+    self.assertRaises(ValueError, nohistory.history, p.key)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -325,3 +325,27 @@ class MergeTests(unittest.TestCase):
     self.assertEqual(a1.version.hash, a3.version.hash)
     self.assertEqual(a1.version.hash, a4.version.hash)
 
+  def test_merge_reuses_data(self):
+    a1 = PersonM('A')
+    a1.first = 'first'
+    a1.last = 'last'
+    a1.commit()
+
+    a2 = PersonM(a1.version)
+    a2.first = 'changed'
+    a2.commit()
+
+    version = a1.version
+    a1.merge(a2)
+    self.assertEqual(a1.first, 'changed')
+    self.assertEqual(a1.version.hash, a1.computedHash())
+    self.assertEqual(a1.version.parent, version.hash)
+
+    # attributes the merge did not change reuse the stored data.
+    self.assertTrue(a1.version.attribute('last') is version.attribute('last'))
+    self.assertEqual(a1.version.attribute('first'),
+      a2.version.attribute('first'))
+
+    # the instance does not share (mutable) data with its version.
+    a1.last = 'mutated'
+    self.assertEqual(a1.version.attributeValue('last'), 'last')
@@ -5,11 +5,16 @@ import hashlib
 import nanotime
 
 from dronestore.model import Key, Version, Model
-from dronestore.query import Filter, Order, Query
+from dronestore.query import Filter, Order, Query, Aggregate
 from dronestore.util import serial
+from dronestore.attribute import StringAttribute
 from dronestore import model
 
 
+class Hurr(Model):
+  str = StringAttribute()
+
+
 def versions():
   sr = serial.SerialRepresentation()
   sr['key'] = '/ABCD'
@@ -261,6 +266,37 @@ class TestFilter(unittest.TestCase):
     self.assertNotEqual(hash(f4), hash(Filter('committed', '=', t1)))
     self.assertNotEqual(hash(f3), hash(Filter('committed', '>=', t2)))
 
+  def test_shapes(self):
+    v1, v2, v3 = versions()
+
+    # filters compiled per shape agree on every representation of the data.
+    shapes = [
+      lambda v: v,
+      lambda v: v.serialRepresentation,
+      lambda v: v.serialRepresentation.data(),
+      lambda v: Hurr(v),
+    ]
+
+    filters = [
+      [Filter('key', '=', '/ABCD')],
+      [Filter('str', '>', 'derp')],
+      [Filter('str', '!=', 'derp'), Filter('committed', '>', v1.committed)],
+      [Filter('str', '=', 'lerp'), Filter('committed', '<', v1.committed)],
+    ]
+    expected = [[v1, v2, v3], [v1, v3], [v3], []]
+
+    for shape in shapes:
+      items = map(shape, [v1, v2, v3])
+      for fs, vs in zip(filters, expected):
+        passed = Filter.filter(fs, items)
+        self.assertEqual(passed, map(shape, vs))
+        self.assertEqual(passed, [i for i in items if all([f(i) for f in fs])])
+
+    # fields missing from raw data resolve to None.
+    self.assertTrue(Filter('missing', '=', None)({'attributes' : None}))
+    self.assertTrue(Filter('missing', '=', None)(v1))
+    self.assertEqual(Filter.filter([], [v1, v2]), [v1, v2])
+
 
 
 class TestOrder(unittest.TestCase):
@@ -340,6 +376,19 @@ class TestOrder(unittest.TestCase):
     self.assertNotEqual(hash(Order('+committed')), hash(Order('+key')))
 
 
+  def test_keys(self):
+    import random
+    items = [{'key' : '/Item/%d' % i, 'a' : random.randint(0, 5),
+      'b' : random.choice([None, 'x', 'y', 'z']), 'c' : random.random()} \
+      for i in range(0, 200)]
+
+    # sort keys order items as the comparison functions do.
+    for fields in [['a'], ['-a'], ['a', '-b'], ['-b', '-a', 'c'], ['b', 'c']]:
+      orders = map(Order, fields)
+      expected = sorted(items, cmp=Order.metaOrder(orders))
+      self.assertEqual(Order.sorted(items, orders), expected)
+
+
 class TestQuery(unittest.TestCase):
 
   def test_basic(self):
@@ -381,6 +430,156 @@ class TestQuery(unittest.TestCase):
     self.assertEqual(q2, eval(repr(q2)))
     self.assertEqual(q3, eval(repr(q3)))
 
+  def test_page(self):
+    items = [{'key' : '/Item/%d' % i, 'n' : (i * 37) % 100, 'odd' : i % 2} \
+      for i in range(0, 100)]
+    ordered = sorted(items, key=lambda i: (i['n'], i['key']))
+
+    for offset, limit in [(0, 10), (10, 10), (95, 10), (200, 10), (0, 0),
+      (50, 0)]:
+      stop = offset + limit if limit else None
+
+      q = Query('Item', offset=offset, limit=limit).order('n').order('key')
+      self.assertEqual(q(items), ordered[offset:stop])
+
+      q = Query('Item', offset=offset, limit=limit).order('-n').order('-key')
+      self.assertEqual(q(items), ordered[::-1][offset:stop])
+
+      # without orders, items keep their order.
+      q = Query('Item', offset=offset, limit=limit).filter('odd', '=', 1)
+      self.assertEqual(list(q(items)), items[1::2][offset:stop])
+
+      # merging prefixes yields the page.
+      q = Query('Item', offset=offset, limit=limit).order('n').order('key')
+      prefix = q.prefix()
+      self.assertEqual(prefix.offset, 0)
+      self.assertEqual(prefix.limit, offset + limit if limit else 0)
+      merged = prefix(items[:50]) + prefix(items[50:])
+      self.assertEqual(q.page(merged), ordered[offset:stop])
+      merged = q.merge([prefix(items[:30]), prefix(items[30:]), []])
+      self.assertEqual(list(merged), ordered[offset:stop])
+
+  def test_keysonly(self):
+    items = [{'key' : '/Item/%d' % i, 'n' : i % 10} for i in range(0, 30)]
+    q = Query('Item', limit=3, keysonly=True).filter('n', '=', 4)
+    self.assertEqual(list(q(items)), map(Key, ['/Item/4', '/Item/14',
+      '/Item/24']))
+
+    q = Query('Item', limit=2, keysonly=True).order('-n')
+    self.assertEqual(q(items), [Key('/Item/9'), Key('/Item/29')])
+
+    # ordered prefixes select objects, to merge them.
+    self.assertFalse(q.prefix().keysonly)
+    merged = q.merge([q.prefix()(items[:10]), q.prefix()(items[10:])])
+    self.assertEqual(list(merged), [Key('/Item/9'), Key('/Item/29')])
+
+  def test_streaming(self):
+    pulled = []
+    def scan():
+      for i in range(0, 1000):
+        pulled.append(i)
+        yield {'key' : '/Item/%d' % i, 'n' : i}
+
+    # unordered queries pull objects only until the limit is reached.
+    q = Query('Item', offset=5, limit=10).filter('n', '>=', 10)
+    self.assertEqual([o['n'] for o in q(scan())], range(15, 25))
+    self.assertEqual(len(pulled), 25)
+
+    # as do queries on sequences already in order.
+    del pulled[:]
+    q = Query('Item', limit=3).order('n')
+    self.assertEqual([o['n'] for o in q(scan(), ordered=True)], [0, 1, 2])
+    self.assertEqual(len(pulled), 3)
+
+    del pulled[:]
+    self.assertEqual([o['n'] for o in q(scan())], [0, 1, 2])
+    self.assertEqual(len(pulled), 1000)
+
+  def test_cursor(self):
+    items = [{'key' : '/Item/%02d' % i, 'n' : i % 7, 'm' : i % 3} \
+      for i in range(0, 50)]
+
+    def pages(query, items, size):
+      results = []
+      cursor = None
+      while True:
+        q = query.copy()
+        q.limit = size
+        q.start_cursor = cursor
+        page = q(items)
+        if not page:
+          return results
+        results.extend(page)
+        cursor = q.cursor(page[-1])
+
+    for orders in [['n'], ['-n'], ['n', '-m'], ['-m', 'key'], ['key']]:
+      q = Query('Item', limit=0)
+      for order in orders:
+        q.order(order)
+      expected = q(items)
+      for size in [1, 7, 50]:
+        self.assertEqual(pages(q, items, size), expected)
+
+      # filters still apply, and cursors survive dict round trips.
+      q.filter('m', '!=', 1)
+      q.start_cursor = q.cursor(expected[10])
+      self.assertEqual(Query.from_dict(q.dict()).start_cursor, q.start_cursor)
+      after = [i for i in expected[11:] if i['m'] != 1]
+      self.assertEqual(q(items), after)
+
+    # ties are broken by key, in the direction of the last order.
+    q = Query('Item').order('-n')
+    self.assertEqual(q.totalOrders(), [Order('-n'), Order('-key')])
+    self.assertEqual(Query('Item').totalOrders(), [])
+
+    self.assertRaises(ValueError, Query('Item').cursor, items[0])
+    q.start_cursor = 'garbage'
+    self.assertRaises(ValueError, q, items)
+    q.start_cursor = Query('Item').order('n').order('m').cursor(items[0])
+    self.assertRaises(ValueError, q, items)
+
+  def test_aggregate(self):
+    items = [{'key' : '/Item/%d' % i, 'n' : i, 'g' : i % 3, \
+      'm' : i if i % 4 else None} for i in range(0, 20)]
+    q = Query('Item', limit=5).filter('n', '>=', 5).order('n')
+    selected = [i for i in items if i['n'] >= 5]
+
+    def expected(items):
+      ms = [i['m'] for i in items if i['m'] is not None]
+      return { 'count' : len(items), 'count(m)' : len(ms),
+        'sum(n)' : sum(i['n'] for i in items), 'min(m)' : min(ms),
+        'max(n)' : max(i['n'] for i in items),
+        'avg(m)' : float(sum(ms)) / len(ms) }
+
+    aggregates = ['count', ('count', 'm'), ('sum', 'n'), ('min', 'm'),
+      Aggregate('max', 'n'), ('avg', 'm')]
+
+    # limits and orders do not apply. objects are streamed.
+    result = q.aggregate(iter(items), aggregates)
+    self.assertEqual(result, expected(selected))
+
+    groups = q.aggregate(items, aggregates, groupby='g')
+    self.assertEqual(sorted(groups.keys()), [0, 1, 2])
+    for g in groups:
+      self.assertEqual(groups[g],
+        expected([i for i in selected if i['g'] == g]))
+
+    # partial aggregates of parts gather into the aggregates of the whole.
+    partials = Aggregate.expand(map(Aggregate.make, aggregates))
+    parts = [q.aggregate(items[:7], partials), q.aggregate(items[7:], partials)]
+    self.assertEqual(Aggregate.gather(aggregates, parts), expected(selected))
+    parts = [q.aggregate(items[:7], partials, 'g'),
+      q.aggregate(items[7:], partials, 'g')]
+    self.assertEqual(Aggregate.gather(aggregates, parts, grouped=True), groups)
+
+    empty = q.aggregate([], aggregates)
+    self.assertEqual(empty, { 'count' : 0, 'count(m)' : 0, 'sum(n)' : 0,
+      'min(m)' : None, 'max(n)' : None, 'avg(m)' : None })
+    self.assertEqual(q.aggregate([], aggregates, 'g'), {})
+
+    self.assertRaises(ValueError, Aggregate, 'median', 'n')
+    self.assertRaises(ValueError, Aggregate, 'sum')
+
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
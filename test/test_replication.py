@@ -0,0 +1,109 @@
+
+import threading
+import unittest
+
+from dronestore import Drone, Key
+from dronestore.datastore import DictDatastore
+from dronestore.replication import LocalTransport, SocketTransport
+from dronestore.replication import ReplicationServer, Replicator
+
+from test_merge import PersonM
+
+
+class TestReplication(unittest.TestCase):
+
+  def people(self, drone, count, prefix='p'):
+    people = []
+    for i in range(0, count):
+      p = PersonM('%s%d' % (prefix, i))
+      p.first = 'first%d' % i
+      p.age = i
+      p.commit()
+      people.append(p)
+    drone.put_many(people)
+    return people
+
+  def test_committed_since(self):
+    drone = Drone('/DroneA/', DictDatastore())
+    people = self.people(drone, 30)
+
+    # ties in committed times must neither stall nor skip versions.
+    tie = people[10].version.serialRepresentation
+    for p in people[10:20]:
+      p.version.serialRepresentation['created'] = tie['created']
+      p.version.serialRepresentation['committed'] = tie['committed']
+    drone.put_many(people[10:20])
+
+    expected = sorted(people, \
+      key=lambda p: (p.version.serialRepresentation['committed'], str(p.key)))
+    expected = [p.version for p in expected]
+
+    seen = []
+    watermark = None
+    while True:
+      versions = drone.committedSince(PersonM, watermark, 3)
+      if not versions:
+        break
+      self.assertTrue(len(versions) <= 3)
+      seen.extend(versions)
+      last = versions[-1].serialRepresentation
+      watermark = (last['committed'], last['key'])
+    self.assertEqual(seen, expected)
+
+    self.assertEqual(drone.committedSince(PersonM, None, 100), expected)
+    self.assertEqual(drone.committedSince('OtherType'), [])
+    self.assertRaises(ValueError, drone.committedSince, PersonM, None, 0)
+
+  def subtest_replicate(self, transport, source):
+    checkpoints = DictDatastore()
+    target = Drone('/DroneB/', DictDatastore())
+    replicator = Replicator('AtoB', transport, target, [PersonM],
+      checkpoints, batchsize=7)
+
+    self.assertEqual(replicator.watermark('PersonM'), None)
+    people = self.people(source, 20)
+    self.assertEqual(replicator.replicate(), 20)
+    self.assertEqual(replicator.replicate(), 0)
+    for p in people:
+      self.assertEqual(target.get(p.key), p)
+
+    last = people[-1].version.serialRepresentation
+    self.assertEqual(replicator.watermark('PersonM'),
+      (last['committed'], last['key']))
+
+    # only versions committed since the watermark are replicated.
+    people[3].first = 'changed'
+    people[3].commit()
+    source.merge(people[3])
+    more = self.people(source, 5, 'q')
+
+    # progress is checkpointed, so a new replicator resumes.
+    replicator = Replicator('AtoB', transport, target, [PersonM], checkpoints)
+    self.assertEqual(replicator.replicate(), 6)
+    self.assertEqual(target.get(people[3].key).first, 'changed')
+    for p in more:
+      self.assertEqual(target.get(p.key), p)
+
+  def test_local(self):
+    source = Drone('/DroneA/', DictDatastore())
+    self.subtest_replicate(LocalTransport(source), source)
+
+  def test_socket(self):
+    source = Drone('/DroneA/', DictDatastore())
+    server = ReplicationServer(source)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    transport = SocketTransport(server.server_address)
+    try:
+      self.subtest_replicate(transport, source)
+      self.assertRaises(IOError, transport.fetch, 'PersonM', None, 0)
+    finally:
+      transport.close()
+      server.shutdown()
+      server.server_close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -43,6 +43,12 @@ class TestSerial(unittest.TestCase):
     self.assertEqual(len(sr1), 0)
     self.assertEqual(len(sr1), len(sr2))
 
+    # trusted data is used as is, rather than cleaned (copied).
+    data = {'a':{'b':[1, 2]}}
+    self.assertTrue(SR(data, trusted=True).data() is data)
+    self.assertFalse(SR(data).data()['a'] is data['a'])
+    self.assertEqual(SR(data, trusted=True), SR(data))
+
   def __subtest_conversions(self, data):
     print 'Testing', data
     self.assertEqual(SR(data), SR(data))
@@ -0,0 +1,56 @@
+import random
+import unittest
+
+from dronestore.util.stats import Histogram, Stats
+
+
+class TestStats(unittest.TestCase):
+
+  def test_histogram(self):
+    h = Histogram()
+    self.assertEqual(h.percentile(50), None)
+    self.assertEqual(h.snapshot()['count'], 0)
+    self.assertRaises(ValueError, h.record, -1)
+    self.assertRaises(ValueError, Histogram, 12)
+
+    # small values are exact.
+    for value in range(1, 65):
+      h.record(value)
+    self.assertEqual(h.count, 64)
+    self.assertEqual((h.min, h.max), (1, 64))
+    self.assertEqual(h.mean(), 32.5)
+    self.assertEqual(h.percentile(50), 32)
+    self.assertEqual(h.percentile(100), 64)
+
+    # large values are within 1 / subbuckets.
+    values = [random.randint(0, 10 ** 7) for i in range(0, 10000)]
+    h.reset()
+    map(h.record, values)
+    values.sort()
+    for percent in [1, 10, 50, 90, 99, 99.9, 100]:
+      exact = values[max(0, int(round(len(values) * percent / 100.0)) - 1)]
+      self.assertTrue(exact <= h.percentile(percent) <= exact * 1.04)
+    self.assertEqual(h.percentile(100), values[-1])
+
+    snapshot = h.snapshot()
+    self.assertEqual(snapshot['count'], len(values))
+    self.assertEqual(snapshot['p99'], h.percentile(99))
+
+  def test_stats(self):
+    stats = Stats()
+    for i in range(0, 10):
+      with stats.timer('a'):
+        pass
+    stats.histogram('b').record(5)
+
+    snapshot = stats.snapshot()
+    self.assertEqual(snapshot['timers']['a']['count'], 10)
+    self.assertEqual(snapshot['timers']['b']['max'], 5)
+    self.assertTrue(snapshot['timers']['a']['rate'] > 0)
+
+    stats.reset()
+    self.assertEqual(stats.snapshot()['timers']['a']['count'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()